@@ -0,0 +1,13 @@
+"""
+Configuracion de gunicorn del proceso web (Procfile).
+Los workers gevent atienden las conexiones de Server-Sent Events (watchapp.stream) como greenlets. psycopg2 es una
+extension en C que gevent no puede parchear: sin psycogreen cada consulta bloquea el worker con todas sus conexiones.
+Las tareas de CPU (PDF de reportes, importaciones) las hacen report_worker e import_worker, no los workers web.
+"""
+worker_class = 'gevent'
+worker_connections = 2000
+
+def post_fork(server, worker):
+    # Las consultas de psycopg2 ceden el control a los demas greenlets mientras esperan a la base de datos
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -42,6 +42,9 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # Primero, para medir la peticion completa (watchapp.metrics)
+    'watchapp.metrics.RequestMetricsMiddleware',
+    'watchapp.invalidation.InvalidationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -51,6 +54,18 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+TEMPLATE_CONTEXT_PROCESSORS = (
+    'django.contrib.auth.context_processors.auth',
+    'django.core.context_processors.debug',
+    'django.core.context_processors.i18n',
+    'django.core.context_processors.media',
+    'django.core.context_processors.static',
+    'django.core.context_processors.tz',
+    'django.contrib.messages.context_processors.messages',
+    # Grupos del usuario autenticado (user_groups) desde el cache de watchapp.access
+    'watchapp.access.roles',
+)
+
 ROOT_URLCONF = 'smarthome.urls'
 
 WSGI_APPLICATION = 'smarthome.wsgi.application'
@@ -109,6 +124,82 @@ EMAIL_PORT = 587
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
 
+#Configuracion de la cola de notificaciones (comando notification_worker)
+SMS_BACKEND = 'watchapp.sms.BlowerBackend'
+#Cliente del gateway de SMS (watchapp.sms_gateway): conexiones por host, tiempos maximos de conexion y lectura en segundos,
+#reintentos con espera aleatoria y fallos seguidos antes de abrir el circuito por SMS_CIRCUIT_RESET segundos
+SMS_POOL_SIZE = 10
+SMS_CONNECT_TIMEOUT = 3.05
+SMS_TIMEOUT = 10
+SMS_RETRIES = 2
+SMS_RETRY_BACKOFF = 0.5
+SMS_CIRCUIT_THRESHOLD = 5
+SMS_CIRCUIT_RESET = 30
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_DELAY = 30
+NOTIFICATION_LEASE = 300
+#Segundos de la ventana de agrupacion de alertas por inmueble, sensor y severidad (0 notifica cada evento)
+NOTIFICATION_ALERT_WINDOW = 300
+
+#Directorio de los reportes PDF generados (cache por contenido) y tiempo maximo de un trabajo de report_worker.
+#report_worker escribe los PDF y los procesos web los leen: deben correr en el mismo host o REPORT_ROOT debe ser un
+#volumen compartido (los dynos de Heroku no comparten disco)
+REPORT_ROOT = os.environ.get('REPORT_ROOT', os.path.join(BASE_DIR, 'reports'))
+REPORT_JOB_LEASE = 600
+#report_worker borra los PDF sin usar en REPORT_MAX_AGE segundos y los mas antiguos si pasan de REPORT_ROOT_MAX_MB
+REPORT_MAX_AGE = 7 * 24 * 3600
+REPORT_ROOT_MAX_MB = 1024
+#Eventos por bloque al generar los PDF (cada bloque se convierte por separado y se unen con PyPDF2)
+REPORT_PDF_CHUNK_SIZE = 500
+
+#Cache en memoria de los destinatarios de notificaciones por inmueble (watchapp.recipients)
+RECIPIENTS_CACHE_SIZE = 1024
+RECIPIENTS_CACHE_TTL = 300
+
+#Segundos que se guardan en cache los grupos de un usuario (watchapp.access), se invalidan al cambiar sus grupos
+GROUPS_CACHE_TTL = 300
+#Segundos que se guardan en cache los inmuebles de un usuario (watchapp.access.user_properties)
+USER_PROPERTIES_CACHE_TTL = 300
+
+#Invalidacion de los caches locales entre procesos (watchapp.invalidation): segundos entre lecturas de las
+#invalidaciones nuevas en cada proceso web, segundos que se conservan (mayor que los TTL de los caches) y segundos
+#que se vuelven a leer en cada lectura (mayor que la transaccion mas larga que publica y que la diferencia de reloj
+#entre servidores)
+CACHE_INVALIDATION_INTERVAL = 2
+CACHE_INVALIDATION_KEEP = 3600
+CACHE_INVALIDATION_MARGIN = 300
+
+#Streams de Server-Sent Events por inmueble (watchapp.stream): mensajes en cola por navegador, segundos entre
+#comentarios keepalive y duracion maxima de una conexion antes de que el navegador se reconecte
+SSE_QUEUE_SIZE = 100
+SSE_HEARTBEAT = 15
+SSE_MAX_DURATION = 300
+
+#Cache del estado de los sensores (watchapp.sensor_state): segundos entre escrituras de los valores pendientes
+#(0 escribe cada cambio de inmediato), vigencia de los sensores en cache y prefijos de codigo de los sensores
+#de alarma, que siempre se escriben de inmediato
+SENSOR_FLUSH_INTERVAL = 2
+SENSOR_STATE_TTL = 60
+SENSOR_SYNC_CODE_PREFIXES = ('p', 'm', 'h')
+
+#Filas por bloque (y por transaccion) en la importacion masiva de inmuebles (watchapp.importer)
+IMPORT_CHUNK_SIZE = 1000
+#Directorio local de los archivos pendientes de importar, tiempo sin avance tras el cual otro import_worker retoma
+#un trabajo y maximo de filas omitidas o con error que se guardan en el trabajo
+IMPORT_ROOT = os.path.join(BASE_DIR, 'imports')
+IMPORT_JOB_LEASE = 300
+IMPORT_MAX_ISSUES = 1000
+
+#Archivo de eventos (watchapp.archive): dias que los eventos se quedan en la tabla Event antes de que archive_events
+#los mueva a EventArchive y eventos movidos por transaccion
+EVENT_ARCHIVE_AFTER_DAYS = 180
+EVENT_ARCHIVE_BATCH_SIZE = 500
+
+#Metricas de las peticiones (watchapp.metrics): segundos a partir de los cuales una peticion se registra como lenta
+#y numero de consultas mas lentas que se registran con ella
+METRICS_SLOW_REQUEST_SECONDS = 1.0
+METRICS_SLOW_QUERIES = 5
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': True,
@@ -117,6 +208,17 @@ LOGGING = {
             'format' : "[%(asctime)s] %(levelname)s [%(name)s:%(lineno)s] %(message)s",
             'datefmt' : "%d/%b/%Y %H:%M:%S"
         },
+        # Una linea JSON por registro en el archivo de log
+        'json': {
+            '()': 'watchapp.logpipe.JSONFormatter',
+        },
+    },
+    'filters': {
+        # Deja pasar uno de cada LOG_DEBUG_SAMPLE_EVERY mensajes DEBUG por linea de codigo (ej. update_sensor)
+        'sample_debug': {
+            '()': 'watchapp.logpipe.SamplingFilter',
+            'every': int(os.environ.get('LOG_DEBUG_SAMPLE_EVERY', '10')),
+        },
     },
     'handlers': {
         'null': {
@@ -125,17 +227,27 @@ LOGGING = {
         },
         'logfile': {
             'level':'DEBUG',
-            'class':'logging.handlers.RotatingFileHandler',
+            'class':'watchapp.logpipe.BatchRotatingFileHandler',
             'filename': BASE_DIR + "/logfile",
-            'maxBytes': 50000,
-            'backupCount': 2,
-            'formatter': 'standard',
+            'maxBytes': 5 * 1024 * 1024,
+            'backupCount': 5,
+            'formatter': 'json',
         },
         'console':{
             'level':'INFO',
-            'class':'logging.StreamHandler',
+            'class':'watchapp.logpipe.BatchStreamHandler',
             'formatter': 'standard'
         },
+        # Las peticiones solo encolan los registros, un hilo los escribe por lotes en console y logfile
+        'queue': {
+            'level': 'DEBUG',
+            'class': 'watchapp.logpipe.QueueHandler',
+            'handlers': ['console', 'logfile'],
+            'queue_size': 10000,
+            'batch_size': 200,
+            'flush_interval': 0.5,
+            'filters': ['sample_debug'],
+        },
     },
     'loggers': {
         'django': {
@@ -143,9 +255,10 @@ LOGGING = {
             'propagate': True,
             'level':'WARN',
         },
+        # En DEBUG registra cada consulta; las consultas de las peticiones lentas las registra watchapp.metrics
         'django.db.backends': {
             'handlers': ['console'],
-            'level': 'DEBUG',
+            'level': 'INFO',
             'propagate': False,
         },
         'django.request': {
@@ -154,12 +267,48 @@ LOGGING = {
             'propagate': True,
         },
         'MYAPP': {
-            'handlers': ['console', 'logfile'],
+            'handlers': ['queue'],
             'level': 'DEBUG',
         },
         'watchapp.views': {
-            'handlers': ['console', 'logfile'],
+            'handlers': ['queue'],
             'level': 'DEBUG',
         },
+        'watchapp.models': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+        },
+        'watchapp.alerts': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+        },
+        'watchapp.mailer': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+        },
+        'watchapp.sms_gateway': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+        },
+        'watchapp.notifications': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+        },
+        'watchapp.management.commands': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+        },
+        'watchapp.report_jobs': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+        },
+        'watchapp.import_jobs': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+        },
+        'watchapp.metrics': {
+            'handlers': ['queue'],
+            'level': 'WARNING',
+        },
     }
 }
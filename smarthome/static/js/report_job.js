@@ -0,0 +1,33 @@
+//Función para solicitar un reporte en pdf como trabajo en segundo plano (lo genera el comando report_worker)
+function submit_report_job(kind, dataFilter) {
+    dataFilter.kind = kind;
+    $.ajax({
+        url: "/watchapp/report_jobs/", // Endpoint
+        type: "POST", // Método http
+        contentType: "application/json;charset=utf-8",
+        data: JSON.stringify(dataFilter),//Datos
+        success: function (job) {
+            poll_report_job(job);
+        },
+        error: function (xhr, errmsg, err) {
+            $("#divRpt").css('display', 'block');
+        }
+    });
+}
+
+//Función que consulta el estado del trabajo hasta que el pdf este listo
+function poll_report_job(job) {
+    if (job.empty || job.failed) {
+        //Si no se encuentran registros se muestra el div de información
+        $("#divRpt").css('display', 'block');
+        return;
+    }
+    if (job.done) {
+        //Muestra el reporte en pdf en otra página
+        window.open(job.download_url);
+        return;
+    }
+    setTimeout(function () {
+        $.getJSON("/watchapp/report_jobs/" + job.job_id + "/", poll_report_job);
+    }, 2000);
+}
@@ -24,30 +24,8 @@ function get_report() {
         dateFinal: $("#dateFinal").val() + ' 23:59:59-05',
     };
 
-    //Consume el método que genera el reporte
-    $.ajax({
-        url: "/watchapp/get_report_admin_all_property/", // Endpoint
-        type: "POST", // Método http
-        contentType: "application/json;charset=utf-8",
-        data: JSON.stringify(dataFilter),//Datos
-        async: 'true',
-        success: function (data) {
-            if (data === '0') {
-                //Si no se encuentran registros se muestra el div de información
-                $("#divRpt").css('display', 'block');
-            }
-            else {
-                //Oculta el div de información
-                $("#divRpt").css('display', 'none');
-                //Muestra el reporte en pdf en otra página
-                window.open("data:application/pdf," + escape(data));
-            }
-        },
-        error: function (xhr, errmsg, err) {
-                $("#divRpt").css('display', 'block');
-		$('#tableEvents tbody').html("");
-        }
-    });
+    //Solicita el reporte como trabajo en segundo plano y espera a que el pdf este listo
+    submit_report_job('1', dataFilter);
 }
 
 //Función para crear el reporte en formato pdf
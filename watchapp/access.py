@@ -0,0 +1,143 @@
+"""
+Roles de los usuarios (Groups 'constructoras' y 'usuarios') e inmuebles a los que tienen acceso.
+Los nombres de los grupos de un usuario se consultan una vez y se guardan en el cache de Django y en el objeto user
+de la peticion. Los inmuebles de un usuario (como propietario o residente) se guardan igual en el cache.
+El cache de Django es local a cada worker y estos datos deciden el acceso, por eso se invalidan en todos los procesos
+(watchapp.invalidation): los grupos con m2m_changed de User.groups o al renombrar o borrar un grupo, los inmuebles con
+m2m_changed de properties_as_owner / properties_as_resident, al modificar un inmueble o desde import_worker. Los
+demas workers aplican la invalidacion a lo sumo CACHE_INVALIDATION_INTERVAL segundos despues.
+"""
+from django.conf import settings
+from django.contrib.auth.decorators import user_passes_test
+from django.contrib.auth.models import User, Group
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.dispatch import receiver
+from watchapp.models import Property, UserProfile
+from watchapp import invalidation
+
+CONSTRUCTORAS = 'constructoras'
+USUARIOS = 'usuarios'
+
+def groups_cache_key(user_id):
+    return 'watchapp:groups:%s' % user_id
+
+def user_groups(user):
+    """
+    Nombres de los grupos del usuario, a lo sumo una consulta por usuario mientras no cambien sus grupos
+        @param user
+    """
+    if not user.is_authenticated():
+        return frozenset()
+    groups = getattr(user, '_watchapp_groups', None)
+    if groups is None:
+        key = groups_cache_key(user.pk)
+        groups = cache.get(key)
+        if groups is None:
+            groups = frozenset(user.groups.values_list('name', flat=True))
+            cache.set(key, groups, getattr(settings, 'GROUPS_CACHE_TTL', 300))
+        user._watchapp_groups = groups
+    return groups
+
+def has_group(user, name):
+    """
+    True si el usuario pertenece al grupo name
+        @param user
+        @param name
+    """
+    return name in user_groups(user)
+
+def group_required(name, login_url='/watchapp/login/'):
+    """
+    Decorador de vistas que exige que el usuario autenticado pertenezca al grupo name
+        @param name
+        @param login_url
+    """
+    return user_passes_test(lambda u: has_group(u, name), login_url=login_url)
+
+def roles(request):
+    """
+    Context processor con los grupos del usuario autenticado (user_groups) para los templates
+        @param request
+    """
+    return {'user_groups': sorted(user_groups(request.user)) if hasattr(request, 'user') else []}
+
+def properties_cache_key(user_id):
+    return 'watchapp:properties:%s' % user_id
+
+def user_properties(user):
+    """
+    Inmuebles del usuario como propietario o residente, sin repetir y ordenados por id, con una sola consulta
+    mientras no cambien sus inmuebles
+        @param user
+    """
+    key = properties_cache_key(user.pk)
+    properties = cache.get(key)
+    if properties is None:
+        properties = list(Property.objects.filter(
+            Q(properties_as_owner__user=user) | Q(properties_as_resident__user=user)).distinct().order_by('id'))
+        cache.set(key, properties, getattr(settings, 'USER_PROPERTIES_CACHE_TTL', 300))
+    return properties
+
+def invalidate_users(user_ids):
+    cache.delete_many([groups_cache_key(user_id) for user_id in user_ids])
+
+USER_GROUPS = 'user_groups'
+invalidation.register(USER_GROUPS, invalidate_users)
+
+def invalidate_user_properties(user_ids):
+    cache.delete_many([properties_cache_key(user_id) for user_id in user_ids])
+
+USER_PROPERTIES = 'user_properties'
+invalidation.register(USER_PROPERTIES, invalidate_user_properties)
+
+def property_user_ids(property_id):
+    """
+    Ids de los usuarios propietarios o residentes de un inmueble
+        @param property_id
+    """
+    return UserProfile.objects.filter(Q(properties_as_owner=property_id) | Q(properties_as_resident=property_id)).values_list('user_id', flat=True).distinct()
+
+####################### Invalidacion del cache #######################
+
+# Los grupos y los inmuebles de un usuario deciden a que tiene acceso: se invalidan en todos los procesos
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_groups_on_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        invalidation.publish(USER_GROUPS, [instance.pk])
+    elif action == 'pre_clear':
+        # group.user_set.clear(): los usuarios se leen antes de borrar la relacion
+        invalidation.publish(USER_GROUPS, instance.user_set.values_list('pk', flat=True))
+    else:
+        invalidation.publish(USER_GROUPS, pk_set or [])
+
+@receiver(post_save, sender=Group)
+@receiver(pre_delete, sender=Group)
+def invalidate_groups_on_group_change(sender, instance, **kwargs):
+    # Renombrar o borrar un grupo cambia los nombres de grupo de todos sus usuarios
+    if instance.pk and not kwargs.get('created'):
+        invalidation.publish(USER_GROUPS, instance.user_set.values_list('pk', flat=True))
+
+def invalidate_properties_on_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        invalidation.publish(USER_PROPERTIES, [instance.user_id])
+    elif action == 'pre_clear':
+        invalidation.publish(USER_PROPERTIES, property_user_ids(instance.pk))
+    else:
+        invalidation.publish(USER_PROPERTIES, UserProfile.objects.filter(pk__in=pk_set or []).values_list('user_id', flat=True))
+
+m2m_changed.connect(invalidate_properties_on_m2m, sender=UserProfile.properties_as_owner.through)
+m2m_changed.connect(invalidate_properties_on_m2m, sender=UserProfile.properties_as_resident.through)
+
+@receiver(post_save, sender=Property)
+@receiver(pre_delete, sender=Property)
+def invalidate_properties_on_property_change(sender, instance, **kwargs):
+    # La lista en cache guarda los objetos Property, un cambio en el inmueble la invalida para sus usuarios
+    if not kwargs.get('created'):
+        invalidation.publish(USER_PROPERTIES, property_user_ids(instance.pk))
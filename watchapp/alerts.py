@@ -0,0 +1,114 @@
+"""
+Agrupacion de las alertas por (inmueble, sensor, severidad) para que un sensor intermitente no sature el correo y los SMS.
+La primera alerta se notifica de inmediato y abre una ventana de NOTIFICATION_ALERT_WINDOW segundos; los eventos
+siguientes de la ventana solo se cuentan y al cerrarse se encola un unico correo de resumen (flush_digests, lo llama
+notification_worker, o el evento que abre la ventana siguiente).
+Las ventanas se guardan en AlertWindow, compartida entre los workers. Cada proceso guarda en memoria el vencimiento de
+las ventanas que conoce, asi un evento dentro de una ventana abierta cuesta un solo UPDATE.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from watchapp.models import AlertWindow, NotificationOutbox
+from watchapp.recipients import LRUCache, get_property_contacts
+from watchapp import mailer
+import datetime
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# (inmueble, sensor, severidad) -> vencimiento de la ventana en segundos desde epoch
+windows = LRUCache(getattr(settings, 'NOTIFICATION_ALERT_CACHE_SIZE', 10000))
+
+def window_seconds():
+    return getattr(settings, 'NOTIFICATION_ALERT_WINDOW', 300)
+
+def admit(event, severity, contacts):
+    """
+    Retorna True si la alerta del evento se debe notificar (abre una ventana) o False si se agrupa en la ventana abierta.
+    Con NOTIFICATION_ALERT_WINDOW en 0 todas las alertas se notifican.
+        @param event
+        @param severity AlertWindow.CRITICAL o AlertWindow.FATAL
+        @param contacts datos de contacto del inmueble (recipients.get_property_contacts)
+    """
+    seconds = window_seconds()
+    if seconds <= 0:
+        return True
+    key = (event.property_id, event.sensor_id, severity)
+    expires = windows.get(key)
+    now = timezone.now()
+    if expires is not None and expires > time.time():
+        # Si la ventana ya no existe (la cerro flush_digests) se abre una nueva
+        if AlertWindow.objects.filter(property=event.property_id, sensor=event.sensor_id, severity=severity, expires__gt=now).update(
+                suppressed=F('suppressed') + 1, last_description=event.description[:200]):
+            return False
+    with transaction.atomic():
+        window, created = AlertWindow.objects.select_for_update().get_or_create(
+            property_id=event.property_id, sensor_id=event.sensor_id, severity=severity,
+            defaults={'opened': now, 'expires': now + datetime.timedelta(seconds=seconds)})
+        if created:
+            admitted = True
+        elif window.expires > now:
+            window.suppressed += 1
+            window.last_description = event.description[:200]
+            window.save(update_fields=['suppressed', 'last_description'])
+            admitted = False
+        else:
+            if window.suppressed:
+                try_queue_digest(window, contacts)
+            window.opened = now
+            window.expires = now + datetime.timedelta(seconds=seconds)
+            window.suppressed = 0
+            window.save(update_fields=['opened', 'expires', 'suppressed'])
+            admitted = True
+    windows.set(key, time.time() + (window.expires - now).total_seconds())
+    return admitted
+
+def queue_digest(window, contacts):
+    """
+    Encola el correo de resumen de los eventos agrupados en la ventana: a la constructora si son criticos,
+    tambien al contacto del inmueble si son fatales
+        @param window
+        @param contacts
+    """
+    recipients = [contacts.mail_constructora]
+    if window.severity == AlertWindow.FATAL:
+        recipients.insert(0, contacts.mail_to_notify)
+    context = {'constructora': contacts.constructora, 'address_to_notify': contacts.address, 'name_to_notify': contacts.name,
+               'sensor': window.sensor.description, 'severity': window.get_severity_display(), 'suppressed': window.suppressed,
+               'opened': window.opened, 'expires': window.expires, 'last_description': window.last_description}
+    subject = 'Resumen de alertas en el inmueble ' + contacts.label
+    log.info("queue_digest: %s alertas agrupadas del sensor %s del inmueble %s", window.suppressed, window.sensor_id, window.property_id)
+    return NotificationOutbox.queue_email(subject, mailer.render('watchapp/email_digest.html', context), [r for r in recipients if r])
+
+def try_queue_digest(window, contacts=None):
+    """
+    queue_digest en su propio savepoint. Si falla se registra el error y se retorna None: el resumen se pierde pero la
+    ventana se cierra igual, asi una ventana con datos malos no se reintenta para siempre ni detiene la cola.
+        @param window
+        @param contacts None para consultarlos
+    """
+    try:
+        with transaction.atomic():
+            return queue_digest(window, contacts or get_property_contacts(window.property_id))
+    except Exception:
+        log.exception("try_queue_digest: no se pudo encolar el resumen del sensor %s del inmueble %s", window.sensor_id, window.property_id)
+        return None
+
+def flush_digests(now=None):
+    """
+    Encola los resumenes de las ventanas vencidas con alertas agrupadas y borra las ventanas vencidas.
+    Retorna el numero de resumenes encolados.
+        @param now
+    """
+    now = now or timezone.now()
+    queued = 0
+    with transaction.atomic():
+        pending = list(AlertWindow.objects.select_for_update().filter(expires__lte=now, suppressed__gt=0).select_related('sensor'))
+        for window in pending:
+            if try_queue_digest(window) is not None:
+                queued += 1
+        AlertWindow.objects.filter(expires__lte=now).delete()
+    return queued
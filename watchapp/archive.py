@@ -0,0 +1,104 @@
+"""
+Archivo de eventos antiguos. El comando archive_events mueve por bloques los eventos anteriores a una fecha de la
+tabla Event a EventArchive, conservando su id. Las consultas de los reportes se construyen con events(), que solo
+incluye el archivo cuando el rango de fechas llega a los eventos archivados; asi las consultas de eventos recientes
+solo leen Event. Los acumulados (EventRollupHour, EventRollupDay) no cambian al archivar.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from watchapp.models import Event, EventArchive
+from watchapp import rollups
+import datetime
+import itertools
+
+class EventSet(object):
+    """
+    Eventos de un rango repartidos entre EventArchive y Event. Se filtra como un queryset y se recorre por partes
+    (un queryset por tabla, primero el archivo), ver parts().
+    """
+    def __init__(self, parts):
+        self.parts = parts
+
+    def filter(self, *args, **kwargs):
+        return EventSet([part.filter(*args, **kwargs) for part in self.parts])
+
+    def select_related(self, *fields):
+        return EventSet([part.select_related(*fields) for part in self.parts])
+
+    def order_by(self, *fields):
+        return EventSet([part.order_by(*fields) for part in self.parts])
+
+    def __iter__(self):
+        return itertools.chain(*self.parts)
+
+def parts(events):
+    """
+    Querysets que componen los eventos de un reporte
+        @param events queryset de Event o EventSet
+    """
+    if isinstance(events, EventSet):
+        return events.parts
+    return [events]
+
+def boundary():
+    """
+    Fecha del evento archivado mas reciente, o None si no hay eventos archivados
+    """
+    return EventArchive.objects.aggregate(last=Max('date'))['last']
+
+def reaches_archive(date_init):
+    """
+    Indica si un rango que empieza en date_init incluye eventos archivados
+        @param date_init fecha inicial del rango (datetime o texto como '2015-03-01 00:00:00-05')
+    """
+    last = boundary()
+    if last is None:
+        return False
+    if not isinstance(date_init, datetime.datetime):
+        date_init = rollups.parse_date_param(date_init)
+    # Con una fecha que no se puede interpretar se consulta tambien el archivo
+    return date_init is None or date_init <= last
+
+def events(date_init, date_final, **filters):
+    """
+    Eventos del rango [date_init, date_final] con los filtros dados. Retorna un queryset de Event o un EventSet
+    con el archivo cuando el rango llega a los eventos archivados.
+        @param date_init
+        @param date_final
+        @param filters filtros del queryset (property__in, property_id, type...)
+    """
+    recent = Event.objects.filter(date__range=[date_init, date_final], **filters)
+    if not reaches_archive(date_init):
+        return recent
+    archived = EventArchive.objects.filter(date__range=[date_init, date_final], **filters)
+    return EventSet([archived, recent])
+
+def cutoff(days):
+    """
+    Fecha antes de la cual se archivan los eventos
+        @param days antiguedad en dias
+    """
+    return timezone.now() - datetime.timedelta(days=days)
+
+def archive_events(before, batch_size=None):
+    """
+    Mueve a EventArchive los eventos anteriores a before, un bloque de batch_size eventos por transaccion
+    (settings.EVENT_ARCHIVE_BATCH_SIZE). Los eventos se recorren por id, que sigue el orden de llegada.
+    Retorna el numero de eventos archivados.
+        @param before datetime con zona horaria
+        @param batch_size
+    """
+    batch_size = batch_size or getattr(settings, 'EVENT_ARCHIVE_BATCH_SIZE', 500)
+    fields = [f.attname for f in EventArchive._meta.concrete_fields]
+    total = 0
+    while True:
+        with transaction.atomic():
+            rows = list(Event.objects.filter(date__lt=before).order_by('pk').values(*fields)[:batch_size])
+            if not rows:
+                break
+            EventArchive.objects.bulk_create([EventArchive(**row) for row in rows])
+            Event.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+        total += len(rows)
+    return total
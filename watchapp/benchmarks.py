@@ -0,0 +1,215 @@
+"""
+Utilidades para los comandos de benchmark (benchmark_*): generacion de datos sinteticos y medicion de tiempos.
+"""
+from django.core.mail.backends import locmem
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from watchapp.models import Event
+from contextlib import contextmanager
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import bisect
+import datetime
+import os
+import random
+import resource
+import socket
+import threading
+import time
+
+def check_benchmark_database():
+    """
+    Lanza CommandError si la base de datos configurada no es de pruebas ni de benchmark. Los comandos que siembran
+    datos, encolan notificaciones (el notification_worker de produccion las enviaria) o eliminan indices solo corren
+    sobre sqlite en memoria o una base de datos cuyo nombre contiene test o bench
+    (ej. DATABASE_URL=postgres://localhost/watchapp_bench).
+    """
+    name = connection.settings_dict.get('NAME') or ''
+    base = os.path.basename(str(name)).lower()
+    if name == ':memory:' or base.startswith('file:memorydb') or 'test' in base or 'bench' in base:
+        return
+    raise CommandError('La base de datos %s no es de pruebas: use una base de datos con test o bench en el nombre '
+                       '(DATABASE_URL) para este benchmark' % (name or '<sin nombre>'))
+
+@contextmanager
+def writable_event_dates():
+    """
+    Desactiva temporalmente auto_now_add de Event.date para poder sembrar eventos en fechas pasadas
+    """
+    field = Event._meta.get_field('date')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+def seed_events(sensors, count, days=365, batch_size=5000, critical_ratio=0.05, fatal_ratio=0.01, type_weights=None, seed=None, weights=None):
+    """
+    Inserta count eventos distribuidos uniformemente en los ultimos days dias sobre los sensores dados.
+        @param sensors lista de Sensor con su property_id
+        @param type_weights diccionario {tipo de evento: peso}
+        @param weights lista con el peso de cada sensor, None para elegirlos de manera uniforme
+    """
+    rnd = random.Random(seed)
+    types = type_weights or dict((t, 1) for t, label in Event.EVENT_CHOICES)
+    type_keys = list(types.keys())
+    type_cumulative = cumulative_weights([types[key] for key in type_keys])
+    sensor_cumulative = cumulative_weights(weights) if weights else None
+    end = timezone.now()
+    span = days * 86400
+    created = 0
+    with writable_event_dates():
+        while created < count:
+            batch = []
+            for i in range(min(batch_size, count - created)):
+                if sensor_cumulative is None:
+                    sensor = rnd.choice(sensors)
+                else:
+                    sensor = sensors[weighted_index(sensor_cumulative, rnd)]
+                event_type = type_keys[weighted_index(type_cumulative, rnd)]
+                batch.append(Event(
+                    date=end - datetime.timedelta(seconds=rnd.random() * span),
+                    description='Evento sintetico',
+                    value=rnd.randint(0, 100),
+                    type=event_type,
+                    is_critical=rnd.random() < critical_ratio,
+                    is_fatal=rnd.random() < fatal_ratio,
+                    property_id=sensor.property_id,
+                    sensor_id=sensor.id))
+            with transaction.atomic():
+                Event.objects.bulk_create(batch)
+            created += len(batch)
+    return created
+
+def cumulative_weights(weights):
+    total = 0
+    cumulative = []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+def weighted_index(cumulative, rnd):
+    """
+    Indice elegido al azar con probabilidad proporcional a su peso
+        @param cumulative pesos acumulados (cumulative_weights)
+        @param rnd random.Random
+    """
+    return min(bisect.bisect_right(cumulative, rnd.random() * cumulative[-1]), len(cumulative) - 1)
+
+def percentile(values, pct):
+    """
+    Percentil pct (0-100) de una lista de valores, por el metodo del rango mas cercano
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+def time_call(fn, repeat=5):
+    """
+    Ejecuta fn repeat veces y retorna la mediana del tiempo en milisegundos
+    """
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        timings.append((time.time() - start) * 1000.0)
+    return percentile(timings, 50)
+
+def peak_rss():
+    """
+    Memoria residente maxima en MB de este proceso y del mayor de sus procesos hijos terminados (Linux reporta KB)
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    return own, children
+
+class CountingEmailBackend(locmem.EmailBackend):
+    """
+    Backend de correo en memoria que cuenta las conexiones abiertas, para comparar el envio por mensaje y por lote
+    """
+    connections = 0
+
+    def open(self):
+        CountingEmailBackend.connections += 1
+        return True
+
+class _StubSMSHandler(BaseHTTPRequestHandler):
+    """
+    Responde 201 a los POST /messages de watchapp.sms.BlowerBackend sin enviar nada, o los codigos de server.statuses
+    en orden mientras queden. Mantiene la conexion abierta (HTTP/1.1) para probar la reutilizacion de conexiones.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with self.server.lock:
+            self.server.received += 1
+            self.server.ports.add(self.client_address[1])
+            status = self.server.statuses.pop(0) if self.server.statuses else 201
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class StubSMSServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def close_connections(self):
+        """
+        Cierra las conexiones que los clientes mantienen abiertas (keep-alive), asi terminan los hilos que las atienden
+        """
+        with self.lock:
+            for request in self.connections:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self.connections.clear()
+
+    def handle_error(self, request, client_address):
+        # El cliente cerro la conexion antes de la respuesta (timeout de lectura)
+        pass
+
+@contextmanager
+def stub_sms_gateway(statuses=None, delay=0):
+    """
+    Levanta un gateway de SMS local en un hilo y apunta BLOWERIO_URL a el mientras dura el bloque.
+    El servidor cuenta los mensajes recibidos en received y los puertos de los clientes en ports.
+        @param statuses codigos de respuesta de los primeros mensajes, los siguientes reciben 201
+        @param delay segundos de espera antes de responder cada mensaje
+    """
+    server = StubSMSServer(('127.0.0.1', 0), _StubSMSHandler)
+    server.received = 0
+    server.ports = set()
+    server.connections = set()
+    server.statuses = list(statuses or [])
+    server.delay = delay
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    previous = os.environ.get('BLOWERIO_URL')
+    os.environ['BLOWERIO_URL'] = 'http://127.0.0.1:%d' % server.server_address[1]
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.close_connections()
+        server.server_close()
+        if previous is None:
+            del os.environ['BLOWERIO_URL']
+        else:
+            os.environ['BLOWERIO_URL'] = previous
@@ -0,0 +1,122 @@
+"""
+Trabajos de importacion masiva de inmuebles y sensores fuera de los workers web.
+process_file guarda el archivo en IMPORT_ROOT y crea el trabajo; el comando import_worker lo importa por bloques
+(watchapp.importer). Cada bloque y el avance del trabajo se confirman en la misma transaccion, asi un worker que
+retoma un trabajo despues de una caida continua desde la ultima linea confirmada (last_line).
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from watchapp.models import ImportJob
+from watchapp import importer
+import datetime
+import json
+import logging
+import os
+import uuid
+
+log = logging.getLogger(__name__)
+
+def import_root():
+    if not os.path.isdir(settings.IMPORT_ROOT):
+        os.makedirs(settings.IMPORT_ROOT)
+    return settings.IMPORT_ROOT
+
+def submit(user, uploaded_file):
+    """
+    Guarda el archivo en disco y crea el trabajo de importacion
+        @param user
+        @param uploaded_file
+    """
+    fmt = importer.file_format(uploaded_file.name)
+    path = os.path.join(import_root(), uuid.uuid4().hex + '.' + fmt)
+    total_rows = 0
+    last = ''
+    with open(path, 'wb') as dest:
+        for chunk in uploaded_file.chunks():
+            dest.write(chunk)
+            total_rows += chunk.count('\n')
+            last = chunk[-1:] or last
+    if last and last != '\n':
+        total_rows += 1
+    if fmt == 'json':
+        # En el JSON las filas son los elementos de las listas, un JSON no valido falla al importarlo
+        try:
+            with open(path, 'rb') as lines:
+                total_rows = len(list(importer.read_rows(lines, fmt)))
+        except ValueError:
+            total_rows = 0
+    return ImportJob.objects.create(user=user, path=path, filename=uploaded_file.name[:200], total_rows=total_rows)
+
+def claim_batch(limit):
+    """
+    Toma hasta limit trabajos pendientes. Los que quedaron Procesando sin avance por IMPORT_JOB_LEASE segundos
+    (worker caido) se vuelven a tomar y continuan desde la ultima linea confirmada.
+        @param limit
+    """
+    now = timezone.now()
+    expired = now - datetime.timedelta(seconds=getattr(settings, 'IMPORT_JOB_LEASE', 300))
+    with transaction.atomic():
+        pending = ImportJob.objects.select_for_update().filter(status=ImportJob.PENDING)
+        stale = ImportJob.objects.select_for_update().filter(status=ImportJob.RUNNING, heartbeat__lt=expired)
+        batch = list(pending.order_by('created')[:limit]) + list(stale.order_by('created')[:limit])
+        batch = batch[:limit]
+        ImportJob.objects.filter(pk__in=[j.id for j in batch]).update(status=ImportJob.RUNNING, heartbeat=now)
+        ImportJob.objects.filter(pk__in=[j.id for j in batch], started__isnull=True).update(started=now)
+    for job in batch:
+        job.status = ImportJob.RUNNING
+        job.heartbeat = now
+    return batch
+
+def record_chunk(job, results):
+    """
+    Suma el resultado de un bloque al trabajo, se llama dentro de la transaccion del bloque
+        @param job
+        @param results resultados de importer.import_chunk
+    """
+    job.last_line = results[-1]['line']
+    job.processed += len(results)
+    job.inserted += len([r for r in results if r['status'] == importer.INSERTED])
+    job.skipped += len([r for r in results if r['status'] == importer.SKIPPED])
+    job.failed += len([r for r in results if r['status'] == importer.FAILED])
+    issues = json.loads(job.issues)
+    max_issues = getattr(settings, 'IMPORT_MAX_ISSUES', 1000)
+    issues.extend([r for r in results if r['status'] != importer.INSERTED][:max(max_issues - len(issues), 0)])
+    job.issues = json.dumps(issues)
+    job.heartbeat = timezone.now()
+    job.save(update_fields=['last_line', 'processed', 'inserted', 'skipped', 'failed', 'issues', 'heartbeat'])
+
+def finish(job, status, error=''):
+    job.status = status
+    job.error = error
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'error', 'finished'])
+    if status == ImportJob.DONE and os.path.exists(job.path):
+        os.remove(job.path)
+
+def run_job(job, chunk_size=None):
+    """
+    Importa el archivo del trabajo desde la ultima linea confirmada
+        @param job
+        @param chunk_size
+    """
+    with open(job.path, 'rb') as lines:
+        for chunk in importer.iter_chunks(lines, chunk_size, after_line=job.last_line, fmt=importer.file_format(job.path)):
+            with transaction.atomic():
+                record_chunk(job, importer.import_chunk(chunk))
+    finish(job, ImportJob.DONE)
+
+def run_batch(limit, chunk_size=None):
+    """
+    Procesa un lote de trabajos. Retorna el numero de trabajos procesados.
+        @param limit
+        @param chunk_size
+    """
+    batch = claim_batch(limit)
+    for job in batch:
+        try:
+            run_job(job, chunk_size)
+        except Exception as inst:
+            log.exception("run_batch: trabajo de importacion %s", job.id)
+            finish(job, ImportJob.FAILED, str(inst))
+    return len(batch)
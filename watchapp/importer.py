@@ -0,0 +1,335 @@
+"""
+Importacion masiva de inmuebles y sensores desde un archivo CSV o JSON.
+Filas de inmueble: nombre, direccion, telefono, plano, usuario del propietario.
+Filas de sensor: SENSOR, nombre del inmueble, prefijo del codigo (p, m, h, t, l), descripcion, tipo (0 sensor,
+1 actuador), ubicacion en el plano y opcionalmente es discreto (1/0). El inmueble debe estar en una fila anterior
+del archivo o registrado en el sistema.
+El JSON tiene la forma {"properties": [{name, address, fixed_phone, plan, owner}], "sensors": [{property, code,
+description, type, location_in_plan, is_discrete}]} y se convierte a las mismas filas.
+El archivo se lee una sola vez por bloques de IMPORT_CHUNK_SIZE filas. Por bloque se consultan en una sola consulta
+los inmuebles existentes, los propietarios y los sensores, y se insertan los inmuebles, la relacion con el
+propietario y los sensores con bulk_create. El resultado incluye el estado de cada fila.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from watchapp.models import Property, UserProfile, Sensor
+from watchapp import access, invalidation, sensor_state
+import csv
+import json
+import os
+import uuid
+
+PROPERTY_COLUMNS = 5
+SENSOR_COLUMNS = 6
+SENSOR_ROW = 'sensor'
+# Prefijos de codigo de sensor con la descripcion por defecto, los mismos del configurador del plano (scriptSensor.js)
+SENSOR_PREFIXES = {
+    'p': u'Sensor de Puertas',
+    'm': u'Sensor de Movimiento',
+    'h': u'Sensor de Humo',
+    't': u'Actuador de Temperatura',
+    'l': u'Actuador de Luz',
+}
+# Valor con el que se crean los sensores, el mismo de set_position_ajax
+SENSOR_INITIAL_VALUE = '0'
+
+INSERTED = 'inserted'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+class ImportReport(object):
+    """
+    Resultado de una importacion: conteos y estado de cada fila {line, status, message}
+    """
+    def __init__(self):
+        self.rows = []
+        self.counts = {INSERTED: 0, SKIPPED: 0, FAILED: 0}
+
+    def add(self, results):
+        for result in results:
+            self.counts[result['status']] += 1
+            self.rows.append(result)
+
+    def processed(self):
+        return len(self.rows)
+
+    def upload_status(self):
+        if self.counts[INSERTED] == 0:
+            return "failed"
+        if self.counts[SKIPPED] or self.counts[FAILED]:
+            return "partial"
+        return "complete"
+
+    def message(self):
+        status = self.upload_status()
+        if status == "complete":
+            return "Propiedades registradas."
+        if status == "partial":
+            return "Carga Parcial. Algunas de las propiedades ya estan registradas o el propietario no existe"
+        if self.processed() == 0:
+            return "El archivo no tiene datos"
+        return "Las propiedades ya estan registradas en el sistema o los propietarios no estan registrados"
+
+    def as_dict(self):
+        return {"upload_status": self.upload_status(), "message": self.message(), "processed": self.processed(),
+                "inserted": self.counts[INSERTED], "skipped": self.counts[SKIPPED], "failed": self.counts[FAILED],
+                "rows": self.rows}
+
+def file_format(filename):
+    return 'json' if os.path.splitext(filename)[1].lower() == '.json' else 'csv'
+
+def json_rows(data):
+    """
+    Convierte el JSON de importacion en filas con el formato del CSV (valores en UTF-8)
+        @param data diccionario {"properties": [...], "sensors": [...]}
+    """
+    if not isinstance(data, dict):
+        raise ValueError("El JSON debe ser un objeto con las listas properties y sensors")
+    def text(value):
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        return unicode(value).encode('utf-8')
+    for item in data.get('properties') or []:
+        yield [text(item.get(key)) for key in ('name', 'address', 'fixed_phone', 'plan', 'owner')]
+    for item in data.get('sensors') or []:
+        yield [SENSOR_ROW] + [text(item.get(key)) for key in ('property', 'code', 'description', 'type', 'location_in_plan', 'is_discrete')]
+
+def read_rows(lines, fmt='csv'):
+    """
+    Retorna las filas del archivo
+        @param lines archivo o iterable de lineas
+        @param fmt csv o json
+    """
+    if fmt == 'json':
+        return json_rows(json.loads(''.join(lines)))
+    return csv.reader(lines, delimiter=',')
+
+def iter_chunks(lines, chunk_size=None, after_line=0, fmt='csv'):
+    """
+    Lee el archivo una sola vez y genera bloques de a lo sumo chunk_size filas [(numero de linea, fila)].
+    Las lineas vacias y las lineas hasta after_line (ya importadas) se omiten. En el JSON el numero de linea es la
+    posicion del elemento (primero los inmuebles y luego los sensores).
+        @param lines archivo o iterable de lineas
+        @param chunk_size
+        @param after_line
+        @param fmt csv o json
+    """
+    chunk_size = chunk_size or getattr(settings, 'IMPORT_CHUNK_SIZE', 1000)
+    chunk = []
+    for line, row in enumerate(read_rows(lines, fmt), 1):
+        if line <= after_line or not any(value.strip() for value in row):
+            continue
+        chunk.append((line, row))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def decode_values(row, columns):
+    if len(row) < columns:
+        raise ValueError("Estructura no valida: se esperaban %d columnas" % columns)
+    try:
+        return [value.decode('utf-8').strip() for value in row]
+    except UnicodeDecodeError:
+        raise ValueError("El archivo debe estar en UTF-8")
+
+def is_sensor_row(row):
+    return bool(row) and row[0].strip().lower() == SENSOR_ROW
+
+def parse_row(row):
+    """
+    Retorna (llave del inmueble (nombre, direccion, telefono, plano), usuario del propietario) o lanza ValueError
+        @param row
+    """
+    values = decode_values(row[:PROPERTY_COLUMNS], PROPERTY_COLUMNS)
+    if not values[0]:
+        raise ValueError("El nombre del inmueble es obligatorio")
+    return tuple(values[:4]), values[4]
+
+def parse_sensor_row(row):
+    """
+    Retorna (nombre del inmueble, prefijo, descripcion, tipo, ubicacion en el plano, es discreto) o lanza ValueError
+        @param row
+    """
+    values = decode_values(row[1:SENSOR_COLUMNS + 1], SENSOR_COLUMNS - 1)
+    name, code, description, sensor_type, location = values[:5]
+    prefix = code[:1].lower()
+    if not name:
+        raise ValueError("El nombre del inmueble es obligatorio")
+    if prefix not in SENSOR_PREFIXES:
+        raise ValueError("Prefijo de sensor no valido: " + code)
+    if sensor_type not in dict(Sensor.SENSOR_TYPES_CHOICES):
+        raise ValueError("Tipo de sensor no valido: " + sensor_type)
+    if not location:
+        raise ValueError("La ubicacion en el plano es obligatoria")
+    if len(location) > Sensor._meta.get_field('location_in_plan').max_length:
+        raise ValueError("Ubicacion en el plano no valida: " + location)
+    description = (description or SENSOR_PREFIXES[prefix])[:Sensor._meta.get_field('description').max_length]
+    is_discrete = len(values) > 5 and values[5].lower() in ('1', 'true', 'si')
+    return name, prefix, description, sensor_type, location, is_discrete
+
+def import_chunk(chunk):
+    """
+    Importa un bloque de filas. Primero los inmuebles y luego los sensores, asi un sensor puede usar un inmueble
+    del mismo bloque. Retorna el resultado de cada fila.
+        @param chunk lista de (numero de linea, fila)
+    """
+    results = import_property_rows([(line, row) for line, row in chunk if not is_sensor_row(row)])
+    results.update(import_sensor_rows([(line, row) for line, row in chunk if is_sensor_row(row)]))
+    return [results[line] for line, row in chunk]
+
+def import_property_rows(rows):
+    """
+    Importa las filas de inmuebles en una transaccion. Retorna {numero de linea: resultado}.
+        @param rows lista de (numero de linea, fila)
+    """
+    parsed = []
+    results = {}
+    if not rows:
+        return results
+    for line, row in rows:
+        try:
+            parsed.append((line,) + parse_row(row))
+        except ValueError as inst:
+            results[line] = {"line": line, "status": FAILED, "message": str(inst)}
+    names = set(key[0] for line, key, username in parsed)
+    # Los campos nulos se comparan como vacios, igual que las columnas vacias del archivo
+    existing = set(tuple(value or u'' for value in key) for key in
+                   Property.objects.filter(name__in=names).values_list('name', 'address', 'fixed_phone', 'plan'))
+    owners = dict((username, (profile_id, user_id)) for username, profile_id, user_id in
+                  UserProfile.objects.filter(user__username__in=set(p[2] for p in parsed)).values_list('user__username', 'id', 'user_id'))
+    new_rows = []
+    for line, key, username in parsed:
+        if key in existing:
+            results[line] = {"line": line, "status": SKIPPED, "message": "El inmueble ya esta registrado"}
+        elif username not in owners:
+            results[line] = {"line": line, "status": FAILED, "message": "El propietario no existe: " + username}
+        else:
+            # Las filas repetidas dentro del archivo cuentan como inmuebles ya registrados
+            existing.add(key)
+            new_rows.append((line, key, owners[username]))
+    if new_rows:
+        with transaction.atomic():
+            property_ids = insert_properties([key for line, key, owner in new_rows])
+            Through = UserProfile.properties_as_owner.through
+            Through.objects.bulk_create([Through(userprofile_id=owner[0], property_id=property_ids[key]) for line, key, owner in new_rows])
+        for line, key, owner in new_rows:
+            results[line] = {"line": line, "status": INSERTED, "message": "Inmueble registrado", "property_id": property_ids[key]}
+        # bulk_create no dispara m2m_changed y este proceso no es el que atiende las peticiones: los inmuebles en
+        # cache de los propietarios se invalidan en todos los procesos. Los destinatarios no se invalidan, un
+        # inmueble nuevo no puede estar en cache.
+        invalidation.publish(access.USER_PROPERTIES, set(owner[1] for line, key, owner in new_rows))
+    return results
+
+def import_sensor_rows(rows):
+    """
+    Importa las filas de sensores en una transaccion. Retorna {numero de linea: resultado}.
+        @param rows lista de (numero de linea, fila)
+    """
+    parsed = []
+    results = {}
+    if not rows:
+        return results
+    for line, row in rows:
+        try:
+            parsed.append((line, parse_sensor_row(row)))
+        except ValueError as inst:
+            results[line] = {"line": line, "status": FAILED, "message": str(inst)}
+    # Los inmuebles se buscan por nombre, igual que en el configurador del plano
+    properties = {}
+    for name, property_id in Property.objects.filter(name__in=set(s[0] for line, s in parsed)).values_list('name', 'id'):
+        properties.setdefault(name, []).append(property_id)
+    property_ids = set(ids[0] for ids in properties.values() if len(ids) == 1)
+    existing = set(Sensor.objects.filter(property_id__in=property_ids).values_list('property_id', 'location_in_plan'))
+    new_rows = []
+    for line, sensor in parsed:
+        ids = properties.get(sensor[0], [])
+        if not ids:
+            results[line] = {"line": line, "status": FAILED, "message": "El inmueble no existe: " + sensor[0]}
+        elif len(ids) > 1:
+            results[line] = {"line": line, "status": FAILED, "message": "Hay varios inmuebles con el nombre: " + sensor[0]}
+        elif (ids[0], sensor[4]) in existing:
+            results[line] = {"line": line, "status": SKIPPED, "message": "Ya hay un sensor en esa ubicacion del plano"}
+        else:
+            existing.add((ids[0], sensor[4]))
+            new_rows.append((line, ids[0], sensor))
+    if new_rows:
+        with transaction.atomic():
+            inserted = insert_sensors([(property_id, sensor) for line, property_id, sensor in new_rows])
+        for line, property_id, sensor in new_rows:
+            sensor_id, code = inserted[(property_id, sensor[4])]
+            results[line] = {"line": line, "status": INSERTED, "message": "Sensor registrado", "sensor_id": sensor_id, "code": code}
+        # bulk_create no dispara post_save, se invalida el estado de sensores de los inmuebles en todos los procesos
+        invalidation.publish(sensor_state.SENSOR_STATE, set(property_id for line, property_id, sensor in new_rows))
+    return results
+
+def insert_sensors(rows):
+    """
+    Inserta los sensores con bulk_create y asigna los codigos (prefijo-id, igual que set_position_ajax) con un
+    solo UPDATE para todo el bloque. Retorna {(inmueble, ubicacion en el plano): (id, codigo)}.
+    Los sensores se insertan con un codigo temporal propio del bloque (prefijo~marca), asi los que insertan al mismo
+    tiempo set_position_ajax u otro import_worker no se confunden con los del bloque. last_id solo acota la busqueda.
+        @param rows lista de (id del inmueble, sensor de parse_sensor_row) sin ubicaciones repetidas
+    """
+    marker = uuid.uuid4().hex[:Sensor._meta.get_field('code').max_length - 2]
+    last_id = Sensor.objects.aggregate(last=Max('id'))['last'] or 0
+    Sensor.objects.bulk_create([Sensor(code=prefix + '~' + marker, description=description, type=sensor_type,
+                                       location_in_plan=location, is_discrete=is_discrete, property_id=property_id,
+                                       value=SENSOR_INITIAL_VALUE)
+                                for property_id, (name, prefix, description, sensor_type, location, is_discrete) in rows])
+    temporary_codes = sorted(set(sensor[1] + '~' + marker for property_id, sensor in rows))
+    inserted = list(Sensor.objects.filter(pk__gt=last_id, code__in=temporary_codes).values_list('id', 'property_id', 'location_in_plan', 'code'))
+    assign_codes(last_id, temporary_codes)
+    return dict(((property_id, location), (pk, code[0] + '-' + str(pk))) for pk, property_id, location, code in inserted)
+
+def assign_codes(last_id, temporary_codes):
+    """
+    Reemplaza los codigos temporales de los sensores insertados despues de last_id por prefijo-id. El id se agrega en
+    la base de datos, asi no hay una segunda escritura por sensor. Un codigo temporal solo existe dentro de la
+    transaccion de insert_sensors.
+        @param last_id
+        @param temporary_codes
+    """
+    sql = "UPDATE %s SET code = SUBSTR(code, 1, 1) || '-' || CAST(id AS VARCHAR(12)) WHERE id > %%s AND code IN (%s)" % (
+        connection.ops.quote_name(Sensor._meta.db_table), ', '.join(['%s'] * len(temporary_codes)))
+    connection.cursor().execute(sql, [last_id] + list(temporary_codes))
+
+def lock_inserts(model):
+    """
+    Bloquea hasta el fin de la transaccion las inserciones de otras transacciones en la tabla del modelo, espera a
+    las que estan en curso. En PostgreSQL; sqlite (desarrollo) ya permite una sola transaccion de escritura.
+        @param model
+    """
+    if connection.vendor == 'postgresql':
+        connection.cursor().execute('LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE' % connection.ops.quote_name(model._meta.db_table))
+
+def insert_properties(keys):
+    """
+    Inserta los inmuebles con bulk_create y retorna {llave: id}. bulk_create no retorna los ids, se leen
+    los inmuebles con id mayor al maximo antes de insertar; la tabla se bloquea para que ningun otro inmueble
+    quede en ese rango. Se llama dentro de la transaccion del bloque.
+        @param keys lista de (nombre, direccion, telefono, plano) sin repetir
+    """
+    lock_inserts(Property)
+    last_id = Property.objects.aggregate(last=Max('id'))['last'] or 0
+    Property.objects.bulk_create([Property(name=name, address=address, fixed_phone=fixed_phone, plan=plan)
+                                  for name, address, fixed_phone, plan in keys])
+    inserted = Property.objects.filter(pk__gt=last_id, name__in=set(key[0] for key in keys))
+    return dict(((name, address, fixed_phone, plan), pk) for pk, name, address, fixed_phone, plan in
+                inserted.values_list('id', 'name', 'address', 'fixed_phone', 'plan'))
+
+def import_properties(lines, chunk_size=None, fmt='csv'):
+    """
+    Importa todos los inmuebles y sensores del archivo, un bloque por transaccion
+        @param lines archivo o iterable de lineas
+        @param chunk_size
+        @param fmt csv o json
+    """
+    report = ImportReport()
+    for chunk in iter_chunks(lines, chunk_size, fmt=fmt):
+        report.add(import_chunk(chunk))
+    return report
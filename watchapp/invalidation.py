@@ -0,0 +1,122 @@
+"""
+Invalidacion entre procesos de los caches locales (el cache de Django, que por defecto es LocMemCache, y los caches en
+memoria de watchapp.sensor_state). Las senales solo invalidan el cache del proceso donde ocurre el cambio; un proceso
+que cambia datos que otros tienen en cache (import_worker) los registra con publish en CacheInvalidation y cada proceso
+web lee las invalidaciones nuevas a lo sumo cada CACHE_INVALIDATION_INTERVAL segundos (InvalidationMiddleware) y las
+aplica en su memoria con el handler registrado para cada tipo (register).
+Los registros no se hacen visibles en el orden de sus ids: publish se llama dentro de transacciones (los bloques de
+import_worker) que pueden confirmarse despues de otra con un id mayor. Por eso cada lectura vuelve a leer los
+registros de los ultimos CACHE_INVALIDATION_MARGIN segundos y descarta los ids ya aplicados.
+"""
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from watchapp.models import CacheInvalidation
+import collections
+import datetime
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# tipo -> funcion que recibe la lista de ids a invalidar
+handlers = {}
+
+def register(scope, handler):
+    handlers[scope] = handler
+
+def apply(scope, object_ids):
+    handler = handlers.get(scope)
+    if handler is not None:
+        handler(object_ids)
+
+def publish(scope, object_ids):
+    """
+    Invalida los ids en este proceso y los registra para los demas. Borra los registros mas antiguos que
+    CACHE_INVALIDATION_KEEP segundos, para entonces los caches de los demas procesos ya expiraron.
+        @param scope tipo registrado con register
+        @param object_ids
+    """
+    object_ids = sorted(set(object_ids))
+    if not object_ids:
+        return
+    apply(scope, object_ids)
+    now = timezone.now()
+    CacheInvalidation.objects.bulk_create([CacheInvalidation(scope=scope, object_id=object_id, created=now) for object_id in object_ids])
+    keep = getattr(settings, 'CACHE_INVALIDATION_KEEP', 3600)
+    CacheInvalidation.objects.filter(created__lt=now - datetime.timedelta(seconds=keep)).delete()
+
+class Poller(object):
+    """
+    Lee las invalidaciones registradas desde CACHE_INVALIDATION_MARGIN segundos antes de la lectura anterior y aplica
+    las que no se habian leido. La primera lectura solo marca las existentes como leidas: el proceso recien iniciado
+    no tiene nada en cache.
+    """
+    def __init__(self):
+        self.seen = None
+        self.since = None
+        self.last_poll = 0
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.seen = self.since = None
+
+    def fetch(self, sql):
+        # Con el cursor del driver: la consulta es del proceso y no de la vista, no se registra en connection.queries
+        # (watchapp.metrics ni assertNumQueries la cuentan)
+        connection.ensure_connection()
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute(sql)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def poll(self, force=False):
+        """
+        Aplica las invalidaciones nuevas, retorna cuantas se aplicaron
+            @param force lee aunque no hayan pasado CACHE_INVALIDATION_INTERVAL segundos
+        """
+        now = time.time()
+        if not force and now - self.last_poll < getattr(settings, 'CACHE_INVALIDATION_INTERVAL', 2):
+            return 0
+        if not self.lock.acquire(False):
+            # Otro hilo del proceso esta leyendo
+            return 0
+        try:
+            self.last_poll = now
+            # Cubre las transacciones que confirman tarde y la diferencia de reloj entre servidores
+            started = timezone.now()
+            margin = datetime.timedelta(seconds=getattr(settings, 'CACHE_INVALIDATION_MARGIN', 300))
+            since = (self.since or started) - margin
+            table = connection.ops.quote_name(CacheInvalidation._meta.db_table)
+            rows = self.fetch("SELECT id, scope, object_id FROM %s WHERE created >= '%s' ORDER BY id" %
+                              (table, connection.ops.value_to_db_datetime(since)))
+            first = self.seen is None
+            new_rows = [row for row in rows if first or row[0] not in self.seen]
+            # Los ids anteriores a since no se vuelven a leer, basta recordar los de esta lectura
+            self.seen = set(row[0] for row in rows)
+            self.since = started
+            if first:
+                return 0
+            by_scope = collections.defaultdict(set)
+            for row_id, scope, object_id in new_rows:
+                by_scope[scope].add(object_id)
+            for scope, object_ids in by_scope.items():
+                apply(scope, sorted(object_ids))
+            return len(new_rows)
+        except Exception:
+            log.exception("poll: no se pudieron leer las invalidaciones de cache")
+            return 0
+        finally:
+            self.lock.release()
+
+poller = Poller()
+
+class InvalidationMiddleware(object):
+    """
+    Aplica las invalidaciones de otros procesos antes de atender la peticion
+    """
+    def process_request(self, request):
+        poller.poll()
@@ -0,0 +1,258 @@
+"""
+Log asincrono: QueueHandler solo encola los registros (el hilo de la peticion no escribe en disco ni en consola) y un
+hilo del proceso (QueueListener) los pasa por lotes a los handlers configurados. Los handlers Batch* escriben cada
+lote con una sola escritura. Incluye un filtro de muestreo para los mensajes DEBUG muy frecuentes y un formato JSON
+(una linea por registro). Python 2.7 no trae logging.handlers.QueueHandler, esta es una version equivalente.
+Con los workers gevent de gunicorn (ver Procfile) el modulo threading esta parcheado y el QueueListener es un greenlet
+del mismo hilo del sistema: la peticion ya no espera la escritura de su registro, pero la escritura de cada lote en
+disco bloquea el worker mientras dura. Por eso se escribe por lotes y el lote es pequeno.
+"""
+from logging.handlers import RotatingFileHandler
+import Queue
+import atexit
+import datetime
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+class QueueListener(object):
+    """
+    Hilo que toma los registros de la cola y los entrega por lotes de hasta batch_size registros, esperando a lo sumo
+    flush_interval segundos para completar un lote
+    """
+    _stop = object()
+
+    def __init__(self, queue, handler_names, batch_size=100, flush_interval=0.5, owner=None):
+        self.queue = queue
+        self.handler_names = list(handler_names)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.owner = owner
+        self.thread = None
+        self.targets = {}
+        self.handlers()
+
+    def handlers(self):
+        # dictConfig registra los handlers por nombre en logging._handlers, que solo guarda referencias debiles: si
+        # ningun logger usa el handler se libera al terminar dictConfig. Se resuelven una vez y se guardan aqui; los
+        # que aun no estan configurados se buscan de nuevo en el siguiente lote.
+        for name in self.handler_names:
+            if name not in self.targets:
+                handler = logging._handlers.get(name)
+                if handler is not None:
+                    self.targets[name] = handler
+        return [self.targets[name] for name in self.handler_names if name in self.targets]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='log-queue-listener')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        """
+        Escribe los registros pendientes y detiene el hilo
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(self._stop)
+        self.thread.join(timeout)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            stop = record is self._stop
+            batch = [] if stop else [record]
+            deadline = time.time() + self.flush_interval
+            while not stop and len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+                if record is self._stop:
+                    stop = True
+                else:
+                    batch.append(record)
+            self.dispatch(batch)
+            for _ in range(len(batch) + stop):
+                self.queue.task_done()
+            if stop:
+                return
+
+    def dispatch(self, batch):
+        dropped = self.owner.take_dropped() if self.owner is not None else 0
+        if dropped:
+            batch = batch + [logging.LogRecord(__name__, logging.WARNING, __file__, 0,
+                                           'Cola de log llena: %d registros descartados', (dropped,), None)]
+        if not batch:
+            return
+        for handler in self.handlers():
+            records = [r for r in batch if r.levelno >= handler.level]
+            if not records:
+                continue
+            try:
+                if hasattr(handler, 'emit_batch'):
+                    handler.emit_batch(records)
+                else:
+                    for record in records:
+                        handler.handle(record)
+            except Exception:
+                handler.handleError(records[-1])
+
+class QueueHandler(logging.Handler):
+    """
+    Encola los registros para que los escriba el hilo QueueListener en los handlers con los nombres dados.
+    Si la cola esta llena el registro se descarta (no bloquea la peticion) y se cuenta.
+        @param handlers nombres de los handlers de LOGGING que escriben los registros
+        @param queue_size
+        @param batch_size
+        @param flush_interval
+    """
+    def __init__(self, handlers, queue_size=10000, batch_size=100, flush_interval=0.5):
+        logging.Handler.__init__(self)
+        self.queue = Queue.Queue(queue_size)
+        self.listener = QueueListener(self.queue, handlers, batch_size, flush_interval, owner=self)
+        self.dropped = 0
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def ensure_listener(self):
+        # El hilo se inicia con el primer registro de cada proceso (los workers de gunicorn se crean con fork)
+        if self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.pid != os.getpid():
+                if self.pid is not None:
+                    self.queue = self.listener.queue = Queue.Queue(self.queue.maxsize)
+                self.listener.start()
+                self.pid = os.getpid()
+
+    def prepare(self, record):
+        """
+        Interpola el mensaje y formatea la excepcion antes de encolar, los argumentos pueden cambiar despues
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.ensure_listener()
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def take_dropped(self):
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+    def flush(self):
+        """
+        Espera a que el hilo escriba los registros encolados
+        """
+        if self.pid == os.getpid() and self.listener.thread.is_alive():
+            self.queue.join()
+
+def _write_batch(handler, stream, records):
+    lines = []
+    for record in records:
+        if not handler.filter(record):
+            continue
+        line = handler.format(record)
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        lines.append(line + '\n')
+    text = ''.join(lines)
+    stream.write(text)
+    stream.flush()
+    return text
+
+class BatchStreamHandler(logging.StreamHandler):
+    """
+    StreamHandler que escribe un lote de registros con una sola escritura
+    """
+    def emit_batch(self, records):
+        self.acquire()
+        try:
+            _write_batch(self, self.stream, records)
+        finally:
+            self.release()
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler que escribe un lote de registros con una sola escritura y rota el archivo antes del lote
+    si este superaria maxBytes
+    """
+    def emit_batch(self, records):
+        self.acquire()
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0:
+                self.stream.seek(0, 2)
+                if self.stream.tell() >= self.maxBytes:
+                    self.doRollover()
+            _write_batch(self, self.stream, records)
+        finally:
+            self.release()
+
+class SamplingFilter(logging.Filter):
+    """
+    Deja pasar uno de cada every registros por linea de codigo para los niveles hasta level (DEBUG por defecto),
+    los de niveles mayores pasan siempre
+        @param every
+        @param level
+    """
+    def __init__(self, every=10, level=logging.DEBUG):
+        logging.Filter.__init__(self)
+        self.every = every
+        self.level = logging.getLevelName(level) if isinstance(level, basestring) else level
+        self.counters = {}
+
+    def filter(self, record):
+        if record.levelno > self.level or self.every <= 1:
+            return True
+        site = (record.pathname, record.lineno)
+        counter = self.counters.get(site)
+        if counter is None:
+            counter = self.counters.setdefault(site, itertools.count())
+        return next(counter) % self.every == 0
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formatea cada registro como un objeto JSON en una linea, con los campos extra (extra={...}) del registro
+    """
+    RESERVED = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | set(['message', 'asctime'])
+
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        for key, value in record.__dict__.items():
+            if key not in self.RESERVED:
+                data[key] = value
+        return json.dumps(data, default=repr)
@@ -0,0 +1,79 @@
+"""
+Plantillas y envio de los correos de las notificaciones.
+Las plantillas de los correos se compilan una vez por proceso (render) y los correos de un lote se envian por una sola
+conexion del backend de correo (EmailSender), en lugar de abrir una conexion SMTP con TLS por mensaje.
+"""
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template import Context
+from django.template.loader import get_template
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+FROM_EMAIL = 'watchapp.latam@gmail.com'
+
+templates = {}
+templates_lock = threading.Lock()
+
+def compiled_template(name):
+    """
+    Retorna la plantilla compilada, la carga y compila solo la primera vez
+        @param name
+    """
+    template = templates.get(name)
+    if template is None:
+        with templates_lock:
+            template = templates.get(name)
+            if template is None:
+                template = templates[name] = get_template(name)
+    return template
+
+def render(name, context):
+    """
+    Equivalente a render_to_string con la plantilla compilada en memoria
+        @param name
+        @param context diccionario
+    """
+    return compiled_template(name).render(Context(context))
+
+class EmailSender(object):
+    """
+    Conexion del backend de correo (get_connection) compartida por los correos de un lote. Se abre con el primer
+    correo y se cierra con close o al salir del bloque with. No es segura para hilos, cada hilo usa la suya.
+    """
+    def __init__(self):
+        self.connection = None
+        self.sent = 0
+
+    def send(self, subject, html_content, recipients):
+        """
+        Envia un correo HTML, lanza una excepcion si el envio falla
+        """
+        if self.connection is None:
+            self.connection = get_connection()
+            self.connection.open()
+        msg = EmailMultiAlternatives(subject, html_content, FROM_EMAIL, recipients, connection=self.connection)
+        msg.attach_alternative(html_content, 'text/html')
+        try:
+            sent = self.connection.send_messages([msg])
+        except Exception:
+            # La conexion puede quedar inservible (ej. SMTPServerDisconnected), el siguiente correo abre otra
+            self.close()
+            raise
+        self.sent += sent or 0
+        return sent
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception as inst:
+                log.warning("close: error al cerrar la conexion de correo: %s", inst)
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
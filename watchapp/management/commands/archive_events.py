@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from watchapp import archive
+
+class Command(BaseCommand):
+    """
+    Mueve los eventos antiguos de la tabla Event a EventArchive por bloques, un bloque por transaccion.
+    Los reportes siguen incluyendo los eventos archivados cuando el rango de fechas llega a ellos.
+    Uso: python manage.py archive_events --older-than=180
+    """
+    help = 'Mueve a EventArchive los eventos con mas de --older-than dias'
+    option_list = BaseCommand.option_list + (
+        make_option('--older-than', type='int', dest='older_than', default=None, help='Antiguedad en dias de los eventos a archivar (EVENT_ARCHIVE_AFTER_DAYS)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=None, help='Eventos movidos por transaccion (EVENT_ARCHIVE_BATCH_SIZE)'),
+    )
+
+    def handle(self, *args, **options):
+        days = options['older_than']
+        if days is None:
+            days = getattr(settings, 'EVENT_ARCHIVE_AFTER_DAYS', 180)
+        if days < 1:
+            raise CommandError('--older-than debe ser mayor que cero')
+        before = archive.cutoff(days)
+        total = archive.archive_events(before, options['batch_size'])
+        self.stdout.write('%d eventos archivados (anteriores a %s)' % (total, before.isoformat()))
@@ -0,0 +1,88 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from optparse import make_option
+from watchapp.models import ConstructorCompany, Property, Sensor, Event
+from watchapp.benchmarks import check_benchmark_database, seed_events, time_call
+import copy
+import datetime
+
+BENCH_NIT = 'BENCH-IDX'
+
+class Command(BaseCommand):
+    """
+    Compara la latencia de las consultas de los reportes de eventos sin y con los indices
+    de la migracion 0004_report_indexes. Siembra los eventos y elimina los indices en la base de datos configurada,
+    que debe ser de benchmark (benchmarks.check_benchmark_database).
+    Uso: DATABASE_URL=postgres://localhost/watchapp_bench python manage.py benchmark_event_indexes --events=1000000
+    """
+    help = 'Mide las consultas de reportes de eventos con y sin los indices compuestos'
+    option_list = BaseCommand.option_list + (
+        make_option('--events', type='int', default=1000000, help='Eventos a sembrar'),
+        make_option('--properties', type='int', default=200, help='Inmuebles a sembrar'),
+        make_option('--repeat', type='int', default=5, help='Repeticiones por consulta'),
+        make_option('--keep', action='store_true', default=False, help='No borra los datos sembrados'),
+    )
+
+    def handle(self, *args, **options):
+        check_benchmark_database()
+        properties, sensors = self.seed(options)
+        now = timezone.now()
+        constructora_properties = Property.objects.filter(constructor_company__nit=BENCH_NIT)
+        one_property = properties[len(properties) // 2]
+        queries = [
+            ('inmueble, 7 dias', lambda: list(Event.objects.filter(property_id=one_property.id, date__range=[now - datetime.timedelta(days=7), now]))),
+            ('inmueble, 90 dias', lambda: list(Event.objects.filter(property_id=one_property.id, date__range=[now - datetime.timedelta(days=90), now]))),
+            ('constructora, 1 dia', lambda: list(Event.objects.filter(property__in=constructora_properties, date__range=[now - datetime.timedelta(days=1), now]))),
+            ('constructora, 30 dias, tipo', lambda: list(Event.objects.filter(property__in=constructora_properties, date__range=[now - datetime.timedelta(days=30), now], type='0'))),
+            ('inmueble por nombre', lambda: Property.objects.get(name=one_property.name)),
+            ('sensor por ubicacion', lambda: list(Sensor.objects.filter(location_in_plan=sensors[0].location_in_plan))),
+        ]
+        try:
+            self.set_indexes(False)
+            before = [time_call(q, options['repeat']) for name, q in queries]
+            self.set_indexes(True)
+            after = [time_call(q, options['repeat']) for name, q in queries]
+        finally:
+            self.set_indexes(True)
+            if not options['keep']:
+                self.cleanup()
+        self.stdout.write('%-32s %12s %12s' % ('consulta', 'sin indice', 'con indice'))
+        for (name, q), b, a in zip(queries, before, after):
+            self.stdout.write('%-32s %10.2fms %10.2fms' % (name, b, a))
+
+    def seed(self, options):
+        self.stdout.write('Sembrando %d eventos...' % options['events'])
+        constructora = ConstructorCompany.objects.create(nit=BENCH_NIT, company_name='Benchmark', address='-', email='bench-idx@watchapp.co', contact_name='-')
+        properties = [Property.objects.create(name='bench-idx-%d' % i, constructor_company=constructora) for i in range(options['properties'])]
+        sensors = [Sensor.objects.create(code='S-%d' % p.id, description='Sensor', type='0', location_in_plan='%d-1' % p.id, property=p, value='1') for p in properties]
+        seed_events(sensors, options['events'], seed=1)
+        return properties, sensors
+
+    def set_indexes(self, enabled):
+        """
+        Crea o elimina los indices de Event(property, date, type), Property.name y Sensor.location_in_plan
+        """
+        if enabled == getattr(self, 'enabled', True):
+            return
+        index_together = Event._meta.index_together
+        with connection.schema_editor() as editor:
+            if enabled:
+                editor.alter_index_together(Event, [], index_together)
+            else:
+                editor.alter_index_together(Event, index_together, [])
+            for model, name in ((Property, 'name'), (Sensor, 'location_in_plan')):
+                field = model._meta.get_field(name)
+                plain = copy.copy(field)
+                plain.db_index = False
+                if enabled:
+                    editor.alter_field(model, plain, field)
+                else:
+                    editor.alter_field(model, field, plain)
+        self.enabled = enabled
+
+    def cleanup(self):
+        Event.objects.filter(property__constructor_company__nit=BENCH_NIT).delete()
+        Sensor.objects.filter(property__constructor_company__nit=BENCH_NIT).delete()
+        Property.objects.filter(constructor_company__nit=BENCH_NIT).delete()
+        ConstructorCompany.objects.filter(nit=BENCH_NIT).delete()
@@ -0,0 +1,174 @@
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from optparse import make_option
+from watchapp.models import ConstructorCompany, Property, UserProfile, Sensor, NotificationOutbox
+from watchapp.benchmarks import check_benchmark_database, percentile, stub_sms_gateway
+from watchapp import notifications
+import json
+import random
+import threading
+import time
+
+BENCH_NIT = 'BENCH-INGEST'
+
+def run_client(payloads, batch_size, samples):
+    """
+    Envia los eventos con un cliente de pruebas propio, de a batch_size por POST (un objeto si batch_size es 1).
+    Agrega a samples (latencia en ms, consultas, eventos, codigo de respuesta) por peticion.
+    """
+    client = Client()
+    try:
+        for start in range(0, len(payloads), batch_size):
+            chunk = payloads[start:start + batch_size]
+            body = json.dumps(chunk if batch_size > 1 else chunk[0])
+            with CaptureQueriesContext(connection) as queries:
+                began = time.time()
+                response = client.post('/api/events/', body, content_type='application/json')
+                elapsed = (time.time() - began) * 1000.0
+            samples.append((elapsed, len(queries), len(chunk), response.status_code))
+    finally:
+        if threading.current_thread().name != 'MainThread':
+            connection.close()
+
+class Command(BaseCommand):
+    """
+    Mide el registro de eventos por el API (EventViewSet) con el cliente de pruebas de Django contra la base de datos
+    configurada, con un numero creciente de clientes concurrentes (hilos). Las notificaciones encoladas por
+    EventNotifier se envian despues de cada nivel con el backend de correo en memoria y un gateway de SMS local.
+    Reporta eventos por segundo, latencia p50/p99 y consultas por evento; con --json escribe el resultado en JSON
+    para comparar ejecuciones. Los eventos criticos y fatales encolan notificaciones que el notification_worker de la
+    misma base de datos enviaria, por eso solo corre sobre una base de datos de benchmark (check_benchmark_database).
+    Uso: python manage.py benchmark_ingest --levels=1,2,4,8 --events=1000 --json=ingest.json
+    """
+    help = 'Mide el throughput del registro de eventos por el API'
+    option_list = BaseCommand.option_list + (
+        make_option('--levels', default='1,2,4,8', help='Clientes concurrentes por nivel, separados por coma'),
+        make_option('--events', type='int', default=1000, help='Eventos por nivel'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1, help='Eventos por POST (lote si es mayor que 1)'),
+        make_option('--properties', type='int', default=20, help='Inmuebles a sembrar'),
+        make_option('--critical-ratio', dest='critical_ratio', type='float', default=0.05, help='Fraccion de eventos criticos'),
+        make_option('--fatal-ratio', dest='fatal_ratio', type='float', default=0.01, help='Fraccion de eventos fatales'),
+        make_option('--json', dest='json_path', default=None, help='Archivo donde se escribe el resultado en JSON, - para la salida estandar'),
+        make_option('--keep', action='store_true', default=False, help='No borra los datos sembrados'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['levels'].split(',')]
+        except ValueError:
+            raise CommandError('--levels debe ser una lista de enteros separados por coma')
+        if min(levels) < 1 or options['events'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--levels, --events y --batch-size deben ser mayores que cero')
+        check_benchmark_database()
+        self.last_notification = NotificationOutbox.objects.aggregate(last=Max('id'))['last'] or 0
+        sensors = self.seed(options['properties'])
+        results = []
+        try:
+            settings_override = override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                                                  SMS_BACKEND='watchapp.sms.BlowerBackend', ALLOWED_HOSTS=['testserver'])
+            with settings_override, stub_sms_gateway() as gateway:
+                rnd = random.Random(1)
+                for level in levels:
+                    results.append(self.run_level(level, sensors, options, rnd, gateway))
+        finally:
+            if not options['keep']:
+                self.cleanup()
+        report = {
+            'benchmark': 'ingest',
+            'timestamp': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'options': dict((name, options[name]) for name in ('events', 'batch_size', 'properties', 'critical_ratio', 'fatal_ratio')),
+            'results': results,
+        }
+        if options['json_path'] == '-':
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+            return
+        self.stdout.write('%-8s %10s %10s %10s %10s %12s %8s %8s %8s' % (
+            'clientes', 'eventos/s', 'p50 (ms)', 'p99 (ms)', 'consultas', 'notificac/s', 'correos', 'sms', 'errores'))
+        for r in results:
+            self.stdout.write('%-8d %10.1f %10.2f %10.2f %10.2f %12.1f %8d %8d %8d' % (
+                r['concurrency'], r['events_per_second'], r['p50_ms'], r['p99_ms'], r['queries_per_event'],
+                r['notifications_per_second'], r['emails'], r['sms'], r['errors']))
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+
+    def run_level(self, level, sensors, options, rnd, gateway):
+        """
+        Registra options['events'] eventos repartidos entre level clientes y luego envia sus notificaciones
+        """
+        payloads = []
+        for i in range(options['events']):
+            sensor = rnd.choice(sensors)
+            payloads.append({'description': 'Evento benchmark', 'value': '1.00', 'type': '3', 'property': sensor.property_id,
+                             'sensor': sensor.id, 'is_critical': rnd.random() < options['critical_ratio'],
+                             'is_fatal': rnd.random() < options['fatal_ratio']})
+        samples = []
+        began = time.time()
+        if level == 1:
+            run_client(payloads, options['batch_size'], samples)
+        else:
+            threads = [threading.Thread(target=run_client, args=(payloads[i::level], options['batch_size'], samples)) for i in range(level)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        seconds = time.time() - began
+        latencies = [sample[0] for sample in samples]
+        created = sum(sample[2] for sample in samples if sample[3] == 201)
+        result = {
+            'concurrency': level,
+            'requests': len(samples),
+            'events': created,
+            'errors': len([sample for sample in samples if sample[3] != 201]),
+            'seconds': seconds,
+            'events_per_second': created / seconds if seconds else 0.0,
+            'p50_ms': percentile(latencies, 50),
+            'p99_ms': percentile(latencies, 99),
+            'queries_per_event': sum(sample[1] for sample in samples) / float(max(sum(sample[2] for sample in samples), 1)),
+        }
+        result.update(self.send_notifications(gateway))
+        return result
+
+    def send_notifications(self, gateway):
+        """
+        Envia las notificaciones encoladas por los eventos del benchmark (solo esas, no las de otros eventos)
+        """
+        emails, sms_sent = len(getattr(mail, 'outbox', [])), gateway.received
+        pending = list(NotificationOutbox.objects.filter(pk__gt=self.last_notification, status=NotificationOutbox.PENDING).order_by('pk'))
+        began = time.time()
+        notifications.process_batch(pending)
+        seconds = time.time() - began
+        return {
+            'notifications': len(pending),
+            'notifications_per_second': len(pending) / seconds if seconds else 0.0,
+            'emails': len(getattr(mail, 'outbox', [])) - emails,
+            'sms': gateway.received - sms_sent,
+        }
+
+    def seed(self, count):
+        """
+        Crea una constructora con count inmuebles, cada uno con propietario y sensor
+        """
+        constructora = ConstructorCompany.objects.create(nit=BENCH_NIT, company_name='Benchmark', address='-', email='bench-ingest@watchapp.co', contact_name='-')
+        sensors = []
+        for i in range(count):
+            prop = Property.objects.create(name='bench-ingest-%d' % i, address='-', constructor_company=constructora)
+            user = User.objects.create_user('bench-ingest-%d' % i, 'bench-ingest-%d@watchapp.co' % i, None, first_name='Bench', last_name=str(i))
+            profile = UserProfile.objects.create(user=user, mobile_number='3000000000')
+            profile.properties_as_owner.add(prop)
+            sensors.append(Sensor.objects.create(code='S-%d' % prop.id, description='Sensor', type='0', property=prop, value='1'))
+        return sensors
+
+    def cleanup(self):
+        NotificationOutbox.objects.filter(pk__gt=self.last_notification, subject__contains='bench-ingest').delete()
+        NotificationOutbox.objects.filter(pk__gt=self.last_notification, body__contains='bench-ingest').delete()
+        Property.objects.filter(constructor_company__nit=BENCH_NIT).delete()
+        User.objects.filter(username__startswith='bench-ingest-').delete()
+        ConstructorCompany.objects.filter(nit=BENCH_NIT).delete()
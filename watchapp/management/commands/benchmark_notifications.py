@@ -0,0 +1,89 @@
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test.utils import override_settings
+from django.utils import timezone
+from optparse import make_option
+from watchapp.models import NotificationOutbox
+from watchapp.benchmarks import CountingEmailBackend, check_benchmark_database
+from watchapp import mailer, notifications
+import json
+import time
+
+TEMPLATES = ('watchapp/email.html', 'watchapp/email_constructora.html')
+CONTEXT = {'constructora': {'company_name': 'Constructora'}, 'address_to_notify': 'Calle 1', 'name_to_notify': 'Apto 101',
+           'first_name': 'Ana', 'last_name': 'Perez', 'sensor': 'Puerta', 'mobile_to_notify': '3001234567', 'mail_to_notify': 'owner@mail.co'}
+BENCH_SUBJECT = 'bench-notifications'
+
+class Command(BaseCommand):
+    """
+    Mide el render de las plantillas de las notificaciones (render_to_string contra las plantillas compiladas de
+    watchapp.mailer) y el envio de correos de la cola con el backend de correo en memoria: un envio por notificacion,
+    cada uno con su conexion, contra notifications.process_batch con una conexion por lote. Reporta mensajes por segundo
+    y conexiones abiertas; con --json escribe el resultado en JSON para comparar ejecuciones. Los correos se encolan
+    como pendientes, solo corre sobre una base de datos de benchmark (check_benchmark_database).
+    Uso: python manage.py benchmark_notifications --messages=1000 --batch-size=50 --json=notifications.json
+    """
+    help = 'Mide el render y el envio de las notificaciones por correo'
+    option_list = BaseCommand.option_list + (
+        make_option('--messages', type='int', default=1000, help='Correos por medicion'),
+        make_option('--batch-size', dest='batch_size', type='int', default=50, help='Correos por conexion en el envio por lote'),
+        make_option('--json', dest='json_path', default=None, help='Archivo donde se escribe el resultado en JSON, - para la salida estandar'),
+    )
+
+    def handle(self, *args, **options):
+        if options['messages'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--messages y --batch-size deben ser mayores que cero')
+        check_benchmark_database()
+        results = [self.measure_render('render_to_string', render_to_string, options['messages']),
+                   self.measure_render('mailer.render', mailer.render, options['messages'])]
+        body = mailer.render(TEMPLATES[0], CONTEXT)
+        pending = [NotificationOutbox.queue_email(BENCH_SUBJECT, body, ['owner@mail.co']) for i in range(options['messages'])]
+        try:
+            with override_settings(EMAIL_BACKEND='watchapp.benchmarks.CountingEmailBackend'):
+                results.append(self.measure_send('per_message', pending, lambda batch: [notifications.process(n) for n in batch], 1))
+                NotificationOutbox.objects.filter(pk__in=[n.id for n in pending]).update(status=NotificationOutbox.PENDING)
+                results.append(self.measure_send('batched', pending, notifications.process_batch, options['batch_size']))
+        finally:
+            NotificationOutbox.objects.filter(pk__in=[n.id for n in pending]).delete()
+        report = {
+            'benchmark': 'notifications',
+            'timestamp': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'options': dict((name, options[name]) for name in ('messages', 'batch_size')),
+            'results': results,
+        }
+        if options['json_path'] == '-':
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+            return
+        self.stdout.write('%-20s %10s %12s %12s' % ('medicion', 'mensajes', 'mensajes/s', 'conexiones'))
+        for r in results:
+            self.stdout.write('%-20s %10d %12.1f %12s' % (r['name'], r['messages'], r['messages_per_second'], r.get('connections', '-')))
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+
+    def measure_render(self, name, render, count):
+        """
+        Renderiza count veces cada plantilla de las notificaciones
+        """
+        began = time.time()
+        for i in range(count):
+            for template in TEMPLATES:
+                render(template, CONTEXT)
+        seconds = time.time() - began
+        return {'name': name, 'messages': count * len(TEMPLATES), 'seconds': seconds,
+                'messages_per_second': count * len(TEMPLATES) / seconds if seconds else 0.0}
+
+    def measure_send(self, name, pending, send, batch_size):
+        """
+        Envia las notificaciones pendientes en lotes de batch_size con send
+        """
+        outbox, CountingEmailBackend.connections = len(getattr(mail, 'outbox', [])), 0
+        began = time.time()
+        for start in range(0, len(pending), batch_size):
+            send(pending[start:start + batch_size])
+        seconds = time.time() - began
+        return {'name': name, 'messages': len(getattr(mail, 'outbox', [])) - outbox, 'seconds': seconds,
+                'messages_per_second': len(pending) / seconds if seconds else 0.0, 'connections': CountingEmailBackend.connections}
@@ -0,0 +1,106 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import render_to_string
+from optparse import make_option
+from watchapp import pdf
+from watchapp.benchmarks import peak_rss
+import datetime
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+TEMPLATE = 'watchapp/template_rpt_admin_all_property.html'
+
+def synthetic_rows(count, seed=1):
+    """
+    Filas sinteticas con el formato de reports.event_row, no usa la base de datos
+    """
+    rnd = random.Random(seed)
+    start = datetime.date.today()
+    for i in range(count):
+        yield {'date': str(start - datetime.timedelta(days=rnd.randint(0, 365))), 'description': 'Evento sintetico %d' % i,
+               'type': 'Alerta en sensor', 'is_critical': 'Si' if rnd.random() < 0.05 else 'No', 'is_fatal': 'No',
+               'property': 'Inmueble %d' % rnd.randint(1, 200), 'sensor': 'Sensor %d' % rnd.randint(1, 10), 'propietario': 'Propietario'}
+
+def html_parts(count, chunk_size):
+    """
+    HTML del reporte por bloques de chunk_size filas, como reports.report_html_parts
+    """
+    context = {'pagesize': 'A4', 'event_type': 'Todos', 'dateInit': '2015-01-01', 'dateFinal': '2015-12-31'}
+    rows = synthetic_rows(count)
+    number = 0
+    while True:
+        chunk = [row for n, row in zip(range(chunk_size), rows)]
+        if not chunk:
+            break
+        context.update({'sdf': chunk, 'continuation': number > 0})
+        number += 1
+        yield render_to_string(TEMPLATE, context)
+
+def run_case(count, chunk_size, processes, chunked, queue):
+    """
+    Genera un reporte en un proceso hijo nuevo, para que la memoria maxima medida sea solo la de este caso
+    """
+    out_dir = tempfile.mkdtemp()
+    path = os.path.join(out_dir, 'report.pdf')
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        start = time.time()
+        if chunked:
+            error = pdf.write_pdf_parts(html_parts(count, chunk_size), path, pool)
+        else:
+            error = pdf.write_pdf(next(html_parts(count, count)), path)
+        elapsed = time.time() - start
+        if pool is not None:
+            pool.close()
+            pool.join()
+        own, children = peak_rss()
+        queue.put({'error': error, 'seconds': elapsed, 'rss': own, 'workers_rss': children,
+                   'size': os.path.getsize(path) if not error else 0})
+    except Exception as inst:
+        queue.put({'error': str(inst)})
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+class Command(BaseCommand):
+    """
+    Mide el tiempo y la memoria maxima de generar el PDF de reportes con filas sinteticas, convirtiendo
+    todo el HTML de una vez (monolitico) y por bloques unidos con PyPDF2 (como report_worker).
+    Uso: python manage.py benchmark_pdf --sizes=1000,10000,100000 --processes=4
+    """
+    help = 'Compara la generacion de PDF monolitica y por bloques'
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', default='1000,10000,100000', help='Numero de eventos por caso, separados por coma'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500, help='Eventos por bloque'),
+        make_option('--processes', type='int', default=multiprocessing.cpu_count(), help='Procesos para convertir los bloques'),
+        make_option('--monolithic-limit', dest='monolithic_limit', type='int', default=10000,
+                    help='No ejecuta el caso monolitico por encima de este numero de eventos'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes debe ser una lista de enteros separados por coma')
+        self.stdout.write('%-10s %-12s %10s %12s %12s %10s' % ('eventos', 'modo', 'segundos', 'rss (MB)', 'worker (MB)', 'KB'))
+        for count in sizes:
+            cases = [('bloques', True, options['processes'])]
+            if count <= options['monolithic_limit']:
+                cases.insert(0, ('monolitico', False, 1))
+            for mode, chunked, processes in cases:
+                result = self.run(count, options['chunk_size'], processes, chunked)
+                if result['error']:
+                    self.stdout.write('%-10d %-12s %s' % (count, mode, result['error']))
+                    continue
+                self.stdout.write('%-10d %-12s %10.2f %12.1f %12.1f %10d' % (
+                    count, mode, result['seconds'], result['rss'], result['workers_rss'], result['size'] // 1024))
+
+    def run(self, count, chunk_size, processes, chunked):
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=run_case, args=(count, chunk_size, processes, chunked, queue))
+        child.start()
+        result = queue.get()
+        child.join()
+        return result
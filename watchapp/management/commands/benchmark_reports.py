@@ -0,0 +1,149 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import resolve
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from optparse import make_option
+from watchapp.models import ConstructorCompany, UserProfile
+from watchapp.benchmarks import check_benchmark_database, peak_rss
+from watchapp import report_jobs
+import datetime
+import json
+import multiprocessing
+import shutil
+import tempfile
+import time
+
+# (vista, url, usuario que la consulta, parametros propios)
+REPORT_VIEWS = (
+    ('get_event_owner_property', '/watchapp/get_event_owner_property/', 'owner', {'property': '0'}),
+    ('get_event_admin_all_property', '/watchapp/get_event_admin_all_property/', 'constructora', {'event_type': '-1'}),
+    ('get_event_admin_all_property_by_owner', '/watchapp/get_event_admin_all_property_by_owner/', 'constructora', {'owners_select': '0'}),
+    ('get_report_owner_property', '/watchapp/get_report_owner_property/', 'owner', {'property': '0'}),
+    ('get_report_admin_all_property', '/watchapp/get_report_admin_all_property/', 'constructora', {'event_type': '-1'}),
+    ('get_report_admin_all_property_by_owner', '/watchapp/get_report_admin_all_property_by_owner/', 'constructora', {'owners_select': '0'}),
+)
+
+def run_case(url, username, password, params, queue=None):
+    """
+    Consulta una vista de reporte con un cliente autenticado y mide el tiempo, las consultas y la memoria maxima.
+    Los PDF se generan en un directorio temporal, asi no se toman del cache de reportes.
+    """
+    report_root = tempfile.mkdtemp()
+    try:
+        with override_settings(ALLOWED_HOSTS=['testserver'], REPORT_ROOT=report_root):
+            client = Client()
+            if not client.login(username=username, password=password):
+                raise CommandError('No se pudo autenticar al usuario %s' % username)
+            rss_before = peak_rss()[0]
+            with CaptureQueriesContext(connection) as queries:
+                began = time.time()
+                response = client.post(url, json.dumps(params), content_type='application/json')
+                if response.status_code == 202:
+                    # Las vistas PDF crean un trabajo de report_worker, se procesa en este proceso y se descarga el PDF.
+                    # Solo se toma el trabajo creado por la vista, nunca uno de otro usuario.
+                    job_id = json.loads(response.content)['job_id']
+                    if not report_jobs.run_batch(1, ids=[job_id]):
+                        raise CommandError('El trabajo de reporte %s no esta pendiente' % job_id)
+                    response = client.post(url, json.dumps(params), content_type='application/json')
+                seconds = time.time() - began
+        result = {'seconds': seconds, 'queries': len(queries), 'status': response.status_code, 'bytes': len(response.content),
+                  'rss_mb': peak_rss()[0], 'rss_before_mb': rss_before, 'error': None}
+    except Exception as inst:
+        result = {'error': str(inst)}
+    finally:
+        shutil.rmtree(report_root, ignore_errors=True)
+    if queue is None:
+        return result
+    queue.put(result)
+
+class Command(BaseCommand):
+    """
+    Mide las vistas de reportes de eventos (JSON y PDF) con el cliente de pruebas de Django sobre los datos de la base
+    configurada, normalmente generados con seed_synthetic, para varios anchos del rango de fechas. Registra tiempo,
+    numero de consultas y memoria maxima; cada caso corre en un proceso hijo para que la memoria sea solo la suya.
+    Uso: python manage.py benchmark_reports --password=<clave> --widths=1,7,30,365 --json=reports.json
+    """
+    help = 'Mide el tiempo, las consultas y la memoria de las vistas de reportes'
+    option_list = BaseCommand.option_list + (
+        make_option('--widths', default='1,7,30,90,365', help='Ancho en dias de los rangos de fechas, separados por coma'),
+        make_option('--views', default=','.join(view[0] for view in REPORT_VIEWS), help='Vistas a medir, separadas por coma'),
+        make_option('--constructora', default='synthetic-c0', help='Usuario de la constructora'),
+        make_option('--owner', default=None, help='Usuario del propietario, por defecto el primero de la constructora'),
+        make_option('--password', default=None, help='Clave de los usuarios (la de seed_synthetic), obligatoria'),
+        make_option('--in-process', dest='in_process', action='store_true', default=False,
+                    help='Ejecuta los casos en este proceso (la memoria maxima es la de todo el proceso)'),
+        make_option('--json', dest='json_path', default=None, help='Archivo donde se escribe el resultado en JSON, - para la salida estandar'),
+    )
+
+    def handle(self, *args, **options):
+        check_benchmark_database()
+        if not options['password']:
+            raise CommandError('--password es obligatorio')
+        try:
+            widths = [int(width) for width in options['widths'].split(',')]
+        except ValueError:
+            raise CommandError('--widths debe ser una lista de enteros separados por coma')
+        names = options['views'].split(',')
+        views = [view for view in REPORT_VIEWS if view[0] in names]
+        if len(views) != len(names):
+            raise CommandError('Vistas validas: ' + ', '.join(view[0] for view in REPORT_VIEWS))
+        users = {'constructora': options['constructora'], 'owner': options['owner'] or self.first_owner(options['constructora'])}
+        # Carga las vistas (y la libreria de PDF) antes de los casos, asi no se mide la importacion de los modulos
+        for name, url, role, view_params in views:
+            resolve(url)
+        end = timezone.localtime(timezone.now())
+        results = []
+        for name, url, role, view_params in views:
+            for width in widths:
+                params = dict(view_params)
+                params['dateInit'] = (end - datetime.timedelta(days=width)).strftime('%Y-%m-%d %H:%M:%S%z')
+                params['dateFinal'] = end.strftime('%Y-%m-%d %H:%M:%S%z')
+                result = self.run(url, users[role], options['password'], params, options['in_process'])
+                result.update({'view': name, 'width_days': width, 'user': users[role]})
+                results.append(result)
+        report = {
+            'benchmark': 'reports',
+            'timestamp': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'users': users,
+            'results': results,
+        }
+        if options['json_path'] == '-':
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+            return
+        self.stdout.write('%-40s %6s %10s %10s %10s %10s' % ('vista', 'dias', 'segundos', 'consultas', 'rss (MB)', 'KB'))
+        for r in results:
+            if r['error']:
+                self.stdout.write('%-40s %6d %s' % (r['view'], r['width_days'], r['error']))
+                continue
+            self.stdout.write('%-40s %6d %10.3f %10d %10.1f %10d' % (r['view'], r['width_days'], r['seconds'], r['queries'], r['rss_mb'], r['bytes'] // 1024))
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+
+    def first_owner(self, username):
+        """
+        Usuario del primer propietario de los inmuebles de la constructora
+        """
+        try:
+            constructora = ConstructorCompany.objects.get(user_id=UserProfile.objects.get(user__username=username).id)
+        except (ConstructorCompany.DoesNotExist, UserProfile.DoesNotExist):
+            raise CommandError('%s no es el usuario de una constructora, genere los datos con seed_synthetic' % username)
+        owner = UserProfile.objects.filter(properties_as_owner__constructor_company=constructora).order_by('id').select_related('user').first()
+        if owner is None:
+            raise CommandError('La constructora de %s no tiene inmuebles con propietario' % username)
+        return owner.user.username
+
+    def run(self, url, username, password, params, in_process):
+        if in_process:
+            return run_case(url, username, password, params)
+        # El proceso hijo abre su propia conexion
+        connection.close()
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=run_case, args=(url, username, password, params, queue))
+        child.start()
+        result = queue.get()
+        child.join()
+        return result
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from watchapp import import_jobs
+import time
+
+class Command(BaseCommand):
+    """
+    Proceso que importa los archivos de inmuebles recibidos en /watchapp/process_file/.
+    Uso: python manage.py import_worker
+    """
+    help = 'Importa los archivos de inmuebles pendientes por bloques'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1, help='Trabajos por lote'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=None, help='Filas por bloque (por defecto IMPORT_CHUNK_SIZE)'),
+        make_option('--interval', type='float', default=2.0, help='Segundos de espera cuando no hay trabajos'),
+        make_option('--once', action='store_true', default=False, help='Procesa un lote y termina'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = import_jobs.run_batch(options['batch_size'], options['chunk_size'])
+            if options['once']:
+                break
+            if processed == 0:
+                time.sleep(options['interval'])
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+from watchapp import notifications, alerts
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    """
+    Proceso que envia las notificaciones (email y SMS) encoladas por EventNotifier. Antes de cada lote encola los
+    resumenes de las ventanas de alertas vencidas.
+    Uso: python manage.py notification_worker --threads=4
+    """
+    help = 'Envia las notificaciones pendientes de la cola NotificationOutbox'
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=4, help='Hilos de envio'),
+        make_option('--batch-size', type='int', dest='batch_size', default=50, help='Notificaciones por lote'),
+        make_option('--interval', type='float', default=2.0, help='Segundos de espera cuando la cola esta vacia'),
+        make_option('--once', action='store_true', default=False, help='Procesa un lote y termina'),
+    )
+
+    def handle(self, *args, **options):
+        pool = ThreadPool(options['threads'])
+        try:
+            while True:
+                try:
+                    alerts.flush_digests()
+                except Exception:
+                    # Los resumenes se reintentan en el siguiente lote, el envio de la cola no se detiene
+                    log.exception("notification_worker: error al encolar los resumenes de alertas")
+                processed = notifications.drain(options['batch_size'], pool, options['threads'])
+                if options['once']:
+                    break
+                if processed == 0:
+                    time.sleep(options['interval'])
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from optparse import make_option
+from watchapp import rollups
+
+class Command(BaseCommand):
+    """
+    Reconstruye los acumulados de eventos por hora y por dia desde la tabla Event, para cargar
+    los eventos historicos o corregir los acumulados. Debe ejecutarse sin ingesta de eventos en curso.
+    Uso: python manage.py rebuild_rollups --since=2015-01-01
+    """
+    help = 'Reconstruye los acumulados de eventos por hora y por dia'
+    option_list = BaseCommand.option_list + (
+        make_option('--since', default=None, help='Reconstruye solo desde esta fecha (AAAA-MM-DD)'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=10000, help='Eventos leidos por consulta'),
+    )
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_date(options['since'])
+            if since is None:
+                raise CommandError('--since debe tener el formato AAAA-MM-DD')
+        total = rollups.rebuild(since, options['chunk_size'])
+        self.stdout.write('%d eventos acumulados' % total)
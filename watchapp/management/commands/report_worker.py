@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from multiprocessing import Pool
+from watchapp import report_jobs, reports
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    """
+    Proceso que genera los reportes PDF solicitados en /watchapp/report_jobs/. Cada --prune-interval segundos borra
+    los PDF antiguos del cache (reports.prune_reports).
+    Uso: python manage.py report_worker --processes=2
+    """
+    help = 'Genera los reportes PDF pendientes en un pool de procesos'
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=2, help='Procesos de conversion a PDF'),
+        make_option('--batch-size', type='int', dest='batch_size', default=4, help='Trabajos por lote'),
+        make_option('--interval', type='float', default=2.0, help='Segundos de espera cuando no hay trabajos'),
+        make_option('--prune-interval', type='float', dest='prune_interval', default=600.0,
+                    help='Segundos entre limpiezas del cache de reportes'),
+        make_option('--once', action='store_true', default=False, help='Procesa un lote y termina'),
+    )
+
+    def handle(self, *args, **options):
+        # El pool se crea antes de abrir conexiones a la base de datos, los procesos hijos no la usan
+        pool = Pool(options['processes'])
+        last_prune = 0
+        try:
+            while True:
+                if time.time() - last_prune >= options['prune_interval']:
+                    last_prune = time.time()
+                    try:
+                        log.info("report_worker: %d reportes borrados del cache", reports.prune_reports())
+                    except Exception:
+                        log.exception("report_worker: error al limpiar el cache de reportes")
+                processed = report_jobs.run_batch(options['batch_size'], pool)
+                if options['once']:
+                    break
+                if processed == 0:
+                    time.sleep(options['interval'])
+        finally:
+            pool.close()
+            pool.join()
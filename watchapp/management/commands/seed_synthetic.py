@@ -0,0 +1,147 @@
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User, Group
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from optparse import make_option
+from watchapp.models import ConstructorCompany, Property, UserProfile, Sensor, Event, EventArchive, EventRollupHour, EventRollupDay
+from watchapp.access import CONSTRUCTORAS, USUARIOS
+from watchapp.benchmarks import check_benchmark_database, seed_events
+from watchapp import importer, rollups
+import random
+
+SENSOR_KINDS = (('p', '0'), ('m', '0'), ('h', '0'), ('t', '1'), ('l', '1'))
+
+def parse_weights(value):
+    """
+    Convierte '0:1,3:5' en {'0': 1.0, '3': 5.0}
+    """
+    weights = {}
+    for item in value.split(','):
+        key, weight = item.split(':')
+        weights[key.strip()] = float(weight)
+    return weights
+
+class Command(BaseCommand):
+    """
+    Genera datos sinteticos para medir los reportes: constructoras con su usuario, inmuebles con propietario y
+    residentes, sensores y eventos. Los usuarios, constructoras e inmuebles se nombran con --prefix y todos los
+    usuarios tienen la clave --password (sin --password se genera una aleatoria y se muestra). Las filas se insertan
+    con bulk_create. Solo corre sobre una base de datos de pruebas o de benchmark (check_benchmark_database).
+    Uso: python manage.py seed_synthetic --constructoras=5 --properties=200 --events=5000000 --skew=1.1
+    """
+    help = 'Genera constructoras, inmuebles, usuarios, sensores y eventos sinteticos'
+    option_list = BaseCommand.option_list + (
+        make_option('--constructoras', type='int', default=5, help='Constructoras'),
+        make_option('--properties', type='int', default=100, help='Inmuebles por constructora'),
+        make_option('--residents', type='int', default=1, help='Residentes por inmueble'),
+        make_option('--sensors', type='int', default=8, help='Sensores por inmueble'),
+        make_option('--events', type='int', default=1000000, help='Eventos'),
+        make_option('--days', type='int', default=365, help='Los eventos se reparten en los ultimos dias'),
+        make_option('--critical-ratio', dest='critical_ratio', type='float', default=0.05, help='Fraccion de eventos criticos'),
+        make_option('--fatal-ratio', dest='fatal_ratio', type='float', default=0.01, help='Fraccion de eventos fatales'),
+        make_option('--type-weights', dest='type_weights', default='0:1,1:1,2:1,3:5,4:2', help='Peso de cada tipo de evento (tipo:peso)'),
+        make_option('--skew', type='float', default=0.0, help='Concentracion de eventos por inmueble: el inmueble n tiene peso 1/n^skew (0 uniforme)'),
+        make_option('--batch-size', dest='batch_size', type='int', default=5000, help='Eventos por bulk_create'),
+        make_option('--seed', type='int', default=1, help='Semilla de los numeros aleatorios'),
+        make_option('--prefix', default='synthetic', help='Prefijo de los nombres de usuarios, constructoras e inmuebles'),
+        make_option('--password', default=None, help='Clave de todos los usuarios generados, por defecto una aleatoria'),
+        make_option('--clear', action='store_true', default=False, help='Borra antes los datos generados con el mismo prefijo'),
+        make_option('--rollups', action='store_true', default=False, help='Reconstruye los acumulados de eventos al terminar'),
+    )
+
+    def handle(self, *args, **options):
+        check_benchmark_database()
+        prefix = options['prefix'] + '-'
+        try:
+            type_weights = parse_weights(options['type_weights'])
+        except ValueError:
+            raise CommandError('--type-weights debe tener el formato tipo:peso,tipo:peso')
+        if options['clear']:
+            self.clear(prefix)
+        elif User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError('Ya hay datos con el prefijo %s, use --clear para reemplazarlos' % options['prefix'])
+        if not options['password']:
+            options['password'] = User.objects.make_random_password(16)
+            self.stdout.write('Clave de los usuarios: %s' % options['password'])
+        rnd = random.Random(options['seed'])
+        with transaction.atomic():
+            properties = self.seed_accounts(prefix, options)
+            sensors = self.seed_sensors(prefix, properties, options['sensors'], rnd)
+        self.stdout.write('%d constructoras, %d inmuebles, %d sensores' % (options['constructoras'], len(properties), len(sensors)))
+        # El inmueble en la posicion n (en orden aleatorio) tiene peso 1/n^skew, repartido entre sus sensores
+        ranks = list(range(1, len(properties) + 1))
+        rnd.shuffle(ranks)
+        property_weight = dict((prop.id, 1.0 / rank ** options['skew']) for prop, rank in zip(properties, ranks))
+        weights = [property_weight[sensor.property_id] for sensor in sensors]
+        created = seed_events(sensors, options['events'], options['days'], options['batch_size'], options['critical_ratio'],
+                              options['fatal_ratio'], type_weights, options['seed'], weights)
+        self.stdout.write('%d eventos' % created)
+        if options['rollups']:
+            rollups.rebuild()
+            self.stdout.write('Acumulados reconstruidos')
+
+    def seed_accounts(self, prefix, options):
+        """
+        Crea los usuarios (constructoras, propietarios y residentes) con sus grupos y perfiles, las constructoras
+        y los inmuebles. Retorna los inmuebles.
+        """
+        password = make_password(options['password'])
+        per_property = 1 + options['residents']
+        usernames = []
+        for c in range(options['constructoras']):
+            usernames.append(prefix + 'c%d' % c)
+            for p in range(options['properties']):
+                usernames.extend(prefix + 'c%d-p%d-u%d' % (c, p, u) for u in range(per_property))
+        User.objects.bulk_create([User(username=name, password=password, email=name + '@synthetic.co', first_name=name[:30],
+                                       last_name='Sintetico') for name in usernames])
+        users = dict(User.objects.filter(username__startswith=prefix).values_list('username', 'id'))
+        constructoras_group = Group.objects.get_or_create(name=CONSTRUCTORAS)[0]
+        usuarios_group = Group.objects.get_or_create(name=USUARIOS)[0]
+        constructora_names = set(prefix + 'c%d' % c for c in range(options['constructoras']))
+        Membership = User.groups.through
+        Membership.objects.bulk_create([Membership(user_id=user_id, group_id=constructoras_group.id if name in constructora_names else usuarios_group.id)
+                                        for name, user_id in users.items()])
+        UserProfile.objects.bulk_create([UserProfile(user_id=user_id, mobile_number='3000000000') for user_id in sorted(users.values())])
+        profiles = dict(UserProfile.objects.filter(user__username__startswith=prefix).values_list('user__username', 'id'))
+        # Las vistas de constructora buscan la constructora con el id del UserProfile
+        ConstructorCompany.objects.bulk_create([
+            ConstructorCompany(user_id=profiles[name], nit=name[:15], company_name=name, address='-', email=name + '@constructora.synthetic.co', contact_name=name)
+            for name in constructora_names])
+        companies = dict(ConstructorCompany.objects.filter(company_name__in=constructora_names).values_list('company_name', 'id'))
+        Property.objects.bulk_create([Property(name=prefix + 'c%d-p%d' % (c, p), address='Calle %d' % p, constructor_company_id=companies[prefix + 'c%d' % c])
+                                      for c in range(options['constructoras']) for p in range(options['properties'])])
+        properties = list(Property.objects.filter(name__startswith=prefix).order_by('id'))
+        Owner = UserProfile.properties_as_owner.through
+        Resident = UserProfile.properties_as_resident.through
+        owners = []
+        residents = []
+        for prop in properties:
+            owners.append(Owner(userprofile_id=profiles[prop.name + '-u0'], property_id=prop.id))
+            residents.extend(Resident(userprofile_id=profiles[prop.name + '-u%d' % u], property_id=prop.id) for u in range(1, per_property))
+        Owner.objects.bulk_create(owners)
+        Resident.objects.bulk_create(residents)
+        return properties
+
+    def seed_sensors(self, prefix, properties, per_property, rnd):
+        """
+        Crea per_property sensores en cada inmueble con los codigos prefijo-id, como la importacion de sensores
+        """
+        rows = []
+        for prop in properties:
+            for n in range(per_property):
+                code, sensor_type = rnd.choice(SENSOR_KINDS)
+                rows.append((prop.id, (prop.name, code, importer.SENSOR_PREFIXES[code], sensor_type, '%d-%d' % (n, rnd.randint(0, 99)), False)))
+        importer.insert_sensors(rows)
+        return list(Sensor.objects.filter(property__name__startswith=prefix).only('id', 'property').order_by('id'))
+
+    def clear(self, prefix):
+        """
+        Borra los datos generados con el prefijo. Los eventos se borran primero, con un DELETE por tabla.
+        """
+        properties = Property.objects.filter(name__startswith=prefix)
+        for model in (Event, EventArchive, EventRollupHour, EventRollupDay):
+            model.objects.filter(property__in=properties).delete()
+        properties.delete()
+        ConstructorCompany.objects.filter(company_name__startswith=prefix).delete()
+        UserProfile.objects.filter(user__username__startswith=prefix).delete()
+        User.objects.filter(username__startswith=prefix).delete()
@@ -0,0 +1,218 @@
+"""
+Instrumentacion de las peticiones: RequestMetricsMiddleware mide por vista el numero de peticiones, el tiempo total,
+el numero de consultas y el tiempo en la base de datos, y los guarda en histogramas en memoria del proceso (store).
+La vista request_metrics (/watchapp/metrics/) los publica en el formato de texto de Prometheus. Las peticiones que superan
+METRICS_SLOW_REQUEST_SECONDS se registran en el logger watchapp.metrics con sus METRICS_SLOW_QUERIES consultas mas
+lentas (sin los valores de los parametros), sin activar el log de todas las consultas (django.db.backends).
+Las respuestas por streaming (exportaciones) se miden cuando termina de enviarse el cuerpo; los streams de Server-Sent
+Events no se miden.
+Cada proceso (worker de gunicorn) tiene su propio store, los valores son los del worker que atiende la consulta.
+"""
+from django.conf import settings
+from django.db import connection
+import ast
+import logging
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class Histogram(object):
+    """
+    Histograma acumulado con limites fijos, como el de Prometheus (cada bucket cuenta las observaciones <= limite)
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+class MetricsStore(object):
+    """
+    Histogramas por vista de la duracion de la peticion, el numero de consultas y el tiempo en la base de datos,
+    y conteo de respuestas por vista y codigo. Seguro para hilos.
+    """
+    METRICS = (
+        ('watchapp_request_duration_seconds', 'Duracion de las peticiones por vista', 'duration'),
+        ('watchapp_request_queries', 'Consultas a la base de datos por peticion', 'queries'),
+        ('watchapp_request_db_duration_seconds', 'Tiempo en la base de datos por peticion', 'db_duration'),
+    )
+
+    def __init__(self, duration_buckets=None, query_buckets=None):
+        self.duration_buckets = duration_buckets or getattr(settings, 'METRICS_DURATION_BUCKETS', DURATION_BUCKETS)
+        self.query_buckets = query_buckets or getattr(settings, 'METRICS_QUERY_BUCKETS', QUERY_BUCKETS)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+            self.responses = {}
+
+    def observe(self, view, status, seconds, queries, db_seconds):
+        """
+        Registra una peticion
+            @param view nombre de la vista
+            @param status codigo de la respuesta
+            @param seconds duracion de la peticion
+            @param queries numero de consultas
+            @param db_seconds tiempo de las consultas
+        """
+        with self.lock:
+            histograms = self.views.get(view)
+            if histograms is None:
+                histograms = self.views[view] = {'duration': Histogram(self.duration_buckets), 'queries': Histogram(self.query_buckets),
+                                                 'db_duration': Histogram(self.duration_buckets)}
+            histograms['duration'].observe(seconds)
+            histograms['queries'].observe(queries)
+            histograms['db_duration'].observe(db_seconds)
+            self.responses[(view, status)] = self.responses.get((view, status), 0) + 1
+
+    def render(self):
+        """
+        Retorna las metricas en el formato de texto de Prometheus
+        """
+        lines = []
+        with self.lock:
+            for name, help_text, key in self.METRICS:
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s histogram' % name)
+                for view in sorted(self.views):
+                    histogram = self.views[view][key]
+                    label = 'view="%s"' % escape_label(view)
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (name, label, format_bound(bound), count))
+                    lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, label, histogram.count))
+                    lines.append('%s_sum{%s} %s' % (name, label, repr(histogram.sum)))
+                    lines.append('%s_count{%s} %d' % (name, label, histogram.count))
+            lines.append('# HELP watchapp_responses_total Respuestas por vista y codigo')
+            lines.append('# TYPE watchapp_responses_total counter')
+            for (view, status), count in sorted(self.responses.items()):
+                lines.append('watchapp_responses_total{view="%s",code="%s"} %d' % (escape_label(view), status, count))
+        return '\n'.join(lines) + '\n'
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_bound(bound):
+    return repr(float(bound))
+
+store = MetricsStore()
+
+def view_name(view_func):
+    """
+    Nombre de la vista para las metricas: el nombre de la funcion o de la clase (viewsets de rest_framework)
+        @param view_func
+    """
+    return getattr(view_func, '__name__', None) or view_func.__class__.__name__
+
+class RequestMetricsMiddleware(object):
+    """
+    Mide cada peticion y la registra en store. Debe ser el primer middleware para medir toda la peticion.
+    Las consultas se toman de connection.queries, que Django vacia al inicio de cada peticion; el cursor de depuracion
+    se activa solo durante la peticion y django.db.backends debe estar por encima de DEBUG para no registrar cada consulta.
+    """
+    def process_request(self, request):
+        request._metrics_start = time.time()
+        request._metrics_debug_cursor = connection.use_debug_cursor
+        request._metrics_first_query = len(connection.queries)
+        connection.use_debug_cursor = True
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = view_name(view_func)
+
+    def process_response(self, request, response):
+        if getattr(request, '_metrics_start', None) is None:
+            return response
+        if response.streaming:
+            if response.get('Content-Type', '').startswith('text/event-stream'):
+                # Un stream SSE dura minutos esperando mensajes, su duracion no es la de una peticion
+                self.stop_capture(request)
+                return response
+            # El cuerpo (y sus consultas) se genera despues de process_response, se mide al terminar de enviarlo
+            response.streaming_content = MeasuredStream(response.streaming_content, lambda: self.record(request, response))
+            return response
+        self.record(request, response)
+        return response
+
+    def stop_capture(self, request):
+        """
+        Restaura el cursor de depuracion y retorna las consultas de la peticion
+        """
+        queries = connection.queries[request._metrics_first_query:]
+        connection.use_debug_cursor = request._metrics_debug_cursor
+        if not (connection.use_debug_cursor or settings.DEBUG):
+            # Las consultas se registraron solo para las metricas, no se dejan en connection.queries
+            del connection.queries[request._metrics_first_query:]
+        return queries
+
+    def record(self, request, response):
+        seconds = time.time() - request._metrics_start
+        queries = self.stop_capture(request)
+        view = getattr(request, '_metrics_view', '<sin vista>')
+        db_seconds = sum(float(q['time']) for q in queries)
+        store.observe(view, response.status_code, seconds, len(queries), db_seconds)
+        if seconds >= getattr(settings, 'METRICS_SLOW_REQUEST_SECONDS', 1.0):
+            log_slow_request(request, view, seconds, queries, db_seconds)
+
+class MeasuredStream(object):
+    """
+    Cuerpo de una respuesta por streaming que llama a finish una sola vez, al terminar de recorrerse o al cerrarse
+    la respuesta (el cliente cerro la conexion)
+    """
+    def __init__(self, content, finish):
+        self.content = content
+        self.finish = finish
+        self.finished = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.content:
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            self.finish()
+
+# Formato de connection.queries de sqlite en Django 1.7: QUERY = u'...' - PARAMS = (...)
+SQLITE_QUERY_RE = re.compile(r"^QUERY = (u?'.*') - PARAMS = ", re.S)
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+def sql_template(sql):
+    """
+    Consulta sin los valores de los parametros (claves de sesion, datos de usuarios) para escribirla en el log:
+    sqlite registra la consulta y los parametros por separado, los demas motores la registran con los valores, que
+    se reemplazan por ?
+        @param sql
+    """
+    match = SQLITE_QUERY_RE.match(sql)
+    if match:
+        try:
+            sql = ast.literal_eval(match.group(1))
+        except (ValueError, SyntaxError):
+            pass
+    return LITERAL_RE.sub('?', sql)
+
+def log_slow_request(request, view, seconds, queries, db_seconds):
+    """
+    Registra una peticion lenta con sus consultas mas lentas
+    """
+    top = sorted(queries, key=lambda q: float(q['time']), reverse=True)[:getattr(settings, 'METRICS_SLOW_QUERIES', 5)]
+    lines = ['Peticion lenta: %s %s vista=%s %.3fs consultas=%d db=%.3fs' % (request.method, request.path, view, seconds, len(queries), db_seconds)]
+    for q in top:
+        lines.append('  %ss %s' % (q['time'], sql_template(q['sql'])[:1000]))
+    log.warning('\n'.join(lines))
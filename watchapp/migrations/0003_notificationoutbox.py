@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watchapp', '0002_userprofile_photo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationOutbox',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('channel', models.CharField(max_length=1, choices=[(b'0', b'Email'), (b'1', b'SMS')])),
+                ('recipients', models.CharField(max_length=300)),
+                ('subject', models.CharField(max_length=200, blank=True)),
+                ('body', models.TextField()),
+                ('status', models.CharField(default=b'0', max_length=1, choices=[(b'0', b'Pendiente'), (b'1', b'Enviando'), (b'2', b'Enviada'), (b'3', b'Fallida')])),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent', models.DateTimeField(null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='notificationoutbox',
+            index_together=set([('status', 'next_attempt')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watchapp', '0003_notificationoutbox'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='property',
+            name='name',
+            field=models.CharField(max_length=60, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='sensor',
+            name='location_in_plan',
+            field=models.CharField(max_length=20, null=True, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='event',
+            index_together=set([('property', 'date', 'type')]),
+        ),
+    ]
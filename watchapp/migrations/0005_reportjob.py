@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('watchapp', '0004_report_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=1, choices=[(b'0', b'Eventos de los inmuebles del propietario'), (b'1', b'Eventos de los inmuebles de la constructora'), (b'2', b'Eventos de la constructora por propietario')])),
+                ('params', models.TextField()),
+                ('cache_key', models.CharField(max_length=40, db_index=True)),
+                ('status', models.CharField(default=b'0', max_length=1, choices=[(b'0', b'Pendiente'), (b'1', b'Generando'), (b'2', b'Terminado'), (b'3', b'Fallido'), (b'4', b'Sin eventos')])),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watchapp', '0005_reportjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventRollupDay',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('type', models.CharField(max_length=30, choices=[(b'0', b'Disparo de alarma'), (b'1', b'Activar alarma'), (b'3', b'Alerta en sensor'), (b'2', b'Desactivar alarma'), (b'4', b'Cambio actuador')])),
+                ('is_critical', models.BooleanField(default=False)),
+                ('is_fatal', models.BooleanField(default=False)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('bucket', models.DateField()),
+                ('property', models.ForeignKey(to='watchapp.Property')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='EventRollupHour',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('type', models.CharField(max_length=30, choices=[(b'0', b'Disparo de alarma'), (b'1', b'Activar alarma'), (b'3', b'Alerta en sensor'), (b'2', b'Desactivar alarma'), (b'4', b'Cambio actuador')])),
+                ('is_critical', models.BooleanField(default=False)),
+                ('is_fatal', models.BooleanField(default=False)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('bucket', models.DateTimeField()),
+                ('property', models.ForeignKey(to='watchapp.Property')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='eventrolluphour',
+            unique_together=set([('property', 'bucket', 'type', 'is_critical', 'is_fatal')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='eventrollupday',
+            unique_together=set([('property', 'bucket', 'type', 'is_critical', 'is_fatal')]),
+        ),
+    ]
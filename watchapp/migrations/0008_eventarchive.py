@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watchapp', '0007_importjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventArchive',
+            fields=[
+                ('id', models.IntegerField(serialize=False, primary_key=True)),
+                ('date', models.DateTimeField(verbose_name=b'date', db_index=True)),
+                ('description', models.CharField(max_length=200)),
+                ('value', models.DecimalField(max_digits=10, decimal_places=2)),
+                ('type', models.CharField(max_length=30, choices=[(b'0', b'Disparo de alarma'), (b'1', b'Activar alarma'), (b'3', b'Alerta en sensor'), (b'2', b'Desactivar alarma'), (b'4', b'Cambio actuador')])),
+                ('is_critical', models.BooleanField(default=False)),
+                ('is_fatal', models.BooleanField(default=False)),
+                ('property', models.ForeignKey(to='watchapp.Property')),
+                ('sensor', models.ForeignKey(to='watchapp.Sensor')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='eventarchive',
+            index_together=set([('property', 'date', 'type')]),
+        ),
+    ]
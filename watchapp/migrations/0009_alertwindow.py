@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watchapp', '0008_eventarchive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlertWindow',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('severity', models.CharField(max_length=1, choices=[(b'0', b'Critica'), (b'1', b'Fatal')])),
+                ('opened', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('suppressed', models.PositiveIntegerField(default=0)),
+                ('last_description', models.CharField(max_length=200, blank=True)),
+                ('property', models.ForeignKey(to='watchapp.Property')),
+                ('sensor', models.ForeignKey(to='watchapp.Sensor')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='alertwindow',
+            unique_together=set([('property', 'sensor', 'severity')]),
+        ),
+    ]
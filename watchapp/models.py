@@ -1,15 +1,15 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
 from decimal import Decimal
 from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.contrib.auth.models import User, Group
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
-import os
-import requests
+from watchapp import mailer
+import logging
+
+log = logging.getLogger(__name__)
 
 '''Clase para las constructoras'''
 class ConstructorCompany(models.Model):
@@ -25,7 +25,7 @@ class ConstructorCompany(models.Model):
 
 '''Clase para los inmuebles'''
 class Property(models.Model):
-    name = models.CharField(max_length=60)
+    name = models.CharField(max_length=60, db_index=True)
     address = models.CharField(max_length=100, null=True)
     fixed_phone = models.CharField(max_length=15, null=True)
     plan = models.CharField(max_length=300, null=True)
@@ -59,7 +59,7 @@ class Sensor(models.Model):
     code = models.CharField(max_length=15)
     description = models.CharField(max_length=60)
     type = models.CharField(max_length=30, choices=SENSOR_TYPES_CHOICES)
-    location_in_plan = models.CharField(max_length=20,null=True)
+    location_in_plan = models.CharField(max_length=20,null=True, db_index=True)
     is_discrete = models.BooleanField(default=False)
     property = models.ForeignKey(Property,null=True)
     value = models.CharField(max_length=30, choices=SENSOR_STATUS_CHOICES)
@@ -85,53 +85,233 @@ class Event(models.Model):
     property = models.ForeignKey(Property)
     sensor = models.ForeignKey(Sensor)
 
-'''Clase receiver que se ejecuta cuando se recibe un POST de evento para envio de notificaciones (email y SMS)'''
+    class Meta:
+        # Los reportes filtran por inmueble y rango de fechas, y a veces por tipo de evento
+        index_together = (('property', 'date', 'type'),)
+
+'''Clase para los eventos antiguos que el comando archive_events mueve desde Event, conservan el id del evento'''
+class EventArchive(models.Model):
+    id = models.IntegerField(primary_key=True)
+    date = models.DateTimeField('date', db_index=True)
+    description = models.CharField(max_length=200)
+    value = models.DecimalField(max_digits=10, decimal_places=2)
+    type = models.CharField(max_length=30, choices=Event.EVENT_CHOICES)
+    is_critical = models.BooleanField(default=False)
+    is_fatal = models.BooleanField(default=False)
+    property = models.ForeignKey(Property)
+    sensor = models.ForeignKey(Sensor)
+
+    class Meta:
+        index_together = (('property', 'date', 'type'),)
+
+'''Clase para la cola de notificaciones (email y SMS). Las filas se guardan en la misma transaccion del evento y las envia el proceso notification_worker'''
+class NotificationOutbox(models.Model):
+    CHANNEL_CHOICES = (
+        ('0', 'Email'),
+        ('1', 'SMS'),
+    )
+    STATUS_CHOICES = (
+        ('0', 'Pendiente'),
+        ('1', 'Enviando'),
+        ('2', 'Enviada'),
+        ('3', 'Fallida'),
+    )
+    EMAIL = '0'
+    SMS = '1'
+    PENDING = '0'
+    SENDING = '1'
+    SENT = '2'
+    FAILED = '3'
+    channel = models.CharField(max_length=1, choices=CHANNEL_CHOICES)
+    recipients = models.CharField(max_length=300)
+    subject = models.CharField(max_length=200, blank=True)
+    body = models.TextField()
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = (('status', 'next_attempt'),)
+
+    @classmethod
+    def queue_email(cls, subject, html_content, recipients):
+        '''Encola un correo, los destinatarios vacios (ej. inmueble sin constructora) se omiten. Retorna None si no queda ninguno'''
+        recipients = [r for r in recipients if r]
+        if not recipients:
+            return None
+        return cls.objects.create(channel=cls.EMAIL, subject=subject, body=html_content, recipients=','.join(recipients))
+
+    @classmethod
+    def queue_sms(cls, mobile_number, message):
+        '''Encola un SMS, retorna None si el contacto no tiene celular'''
+        if not mobile_number:
+            return None
+        return cls.objects.create(channel=cls.SMS, body=message, recipients=mobile_number)
+
+    def recipient_list(self):
+        return [r for r in self.recipients.split(',') if r]
+
+'''Clase para las ventanas de agrupacion de alertas por inmueble, sensor y severidad (watchapp.alerts)'''
+class AlertWindow(models.Model):
+    SEVERITY_CHOICES = (
+        ('0', 'Critica'),
+        ('1', 'Fatal'),
+    )
+    CRITICAL = '0'
+    FATAL = '1'
+    property = models.ForeignKey(Property)
+    sensor = models.ForeignKey(Sensor)
+    severity = models.CharField(max_length=1, choices=SEVERITY_CHOICES)
+    opened = models.DateTimeField(default=timezone.now)
+    expires = models.DateTimeField(db_index=True)
+    suppressed = models.PositiveIntegerField(default=0)
+    last_description = models.CharField(max_length=200, blank=True)
+
+    class Meta:
+        unique_together = (('property', 'sensor', 'severity'),)
+
+'''Clase para las invalidaciones de los caches locales de los procesos web hechas por otros procesos (watchapp.invalidation)'''
+class CacheInvalidation(models.Model):
+    scope = models.CharField(max_length=30)
+    object_id = models.IntegerField()
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+'''Clase para los trabajos de generacion de reportes PDF que procesa el comando report_worker'''
+class ReportJob(models.Model):
+    KIND_CHOICES = (
+        ('0', 'Eventos de los inmuebles del propietario'),
+        ('1', 'Eventos de los inmuebles de la constructora'),
+        ('2', 'Eventos de la constructora por propietario'),
+    )
+    STATUS_CHOICES = (
+        ('0', 'Pendiente'),
+        ('1', 'Generando'),
+        ('2', 'Terminado'),
+        ('3', 'Fallido'),
+        ('4', 'Sin eventos'),
+    )
+    PENDING = '0'
+    RUNNING = '1'
+    DONE = '2'
+    FAILED = '3'
+    EMPTY = '4'
+    user = models.ForeignKey(User)
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    params = models.TextField()
+    cache_key = models.CharField(max_length=40, db_index=True)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+'''Clase para los trabajos de importacion masiva de inmuebles que procesa el comando import_worker'''
+class ImportJob(models.Model):
+    STATUS_CHOICES = (
+        ('0', 'Pendiente'),
+        ('1', 'Procesando'),
+        ('2', 'Terminado'),
+        ('3', 'Fallido'),
+    )
+    PENDING = '0'
+    RUNNING = '1'
+    DONE = '2'
+    FAILED = '3'
+    user = models.ForeignKey(User)
+    path = models.CharField(max_length=300)
+    filename = models.CharField(max_length=200)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING)
+    total_rows = models.PositiveIntegerField(default=0)
+    # Ultima linea del archivo del ultimo bloque confirmado, desde aqui continua un worker despues de una caida
+    last_line = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    inserted = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    # Filas omitidas o con error en json [{line, status, message}], hasta IMPORT_MAX_ISSUES
+    issues = models.TextField(default='[]')
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    heartbeat = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+'''Clase base de los acumulados de eventos: numero de eventos por inmueble, tipo, critico/fatal y periodo'''
+class EventRollup(models.Model):
+    property = models.ForeignKey(Property)
+    type = models.CharField(max_length=30, choices=Event.EVENT_CHOICES)
+    is_critical = models.BooleanField(default=False)
+    is_fatal = models.BooleanField(default=False)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+'''Clase para los acumulados de eventos por hora, bucket es el inicio de la hora'''
+class EventRollupHour(EventRollup):
+    bucket = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('property', 'bucket', 'type', 'is_critical', 'is_fatal'),)
+
+'''Clase para los acumulados de eventos por dia'''
+class EventRollupDay(EventRollup):
+    bucket = models.DateField()
+
+    class Meta:
+        unique_together = (('property', 'bucket', 'type', 'is_critical', 'is_fatal'),)
+
+'''Clase receiver que se ejecuta cuando se recibe un POST de evento para encolar las notificaciones (email y SMS)'''
 @receiver(post_save, sender=Event)
 def EventNotifier(sender, instance, **kwargs):
-    print "entra al event notifier! :D"
-    print instance.property.name
-    '''Se busca la propiedad en la que ocurrio el evento'''
-    property_in_event = Property.objects.get(name=instance.property.name)
-    address_to_notify = instance.property.address
-    name_to_notify = instance.property.name
-    sensor = instance.sensor.description
-    mail_constructora =  Property.objects.get(name=instance.property.name).constructor_company.email
-    constructora =  Property.objects.get(name=instance.property.name).constructor_company
-    '''Se busca los datos de uno de los residentes del inmueble'''
+    notify_event(instance)
+
+def notify_event(instance):
+    '''Encola las notificaciones (email y SMS) de un evento critico o fatal, el envio lo hace el proceso notification_worker. Tambien se usa para los eventos creados con bulk_create, que no disparan post_save.
+    Las notificaciones se encolan en su propio savepoint: si fallan se registra el error y el evento se guarda igual'''
+    if not (instance.is_critical or instance.is_fatal):
+        return
     try:
-        mobile_to_notify = property_in_event.properties_as_owner.all()[0].mobile_number
-        mail_to_notify = property_in_event.properties_as_owner.all()[0].user.email
-        first_name = property_in_event.properties_as_owner.all()[0].user.first_name
-        last_name = property_in_event.properties_as_owner.all()[0].user.last_name
-        
-    except UserProfile.DoesNotExist:
-        '''Si el inmueble no tiene residentes registrados, se busca el primer duenho'''
-        mobile_to_notify = property_in_event.properties_as_resident.all()[0].mobile_number
-        mail_to_notify = property_in_event.properties_as_resident.all()[0].user.email
-        first_name = property_in_event.properties_as_resident.all()[0].user.first_name
-        last_name = property_in_event.properties_as_resident.all()[0].user.last_name
-        
-    if instance.is_critical == True and property_in_event.is_secure_mode == True:
-        print "entra al evento critico"
-        text_content = ''
-        html_content = render_to_string('watchapp/email.html', {'address_to_notify':address_to_notify, 'name_to_notify':name_to_notify, 'first_name':first_name, 'last_name':last_name, 'sensor': sensor})
-        html_content_constructora = render_to_string('watchapp/email_constructora.html', {'constructora': constructora, 'address_to_notify':address_to_notify, 'name_to_notify':name_to_notify, 'first_name':first_name, 'last_name':last_name, 'sensor': sensor, 'mobile_to_notify':mobile_to_notify, 'mail_to_notify':mail_to_notify})
-        msg = EmailMultiAlternatives('Alerta en el inmueble ' + address_to_notify + ' ' + name_to_notify, html_content,'watchapp.latam@gmail.com', [mail_constructora])
-        msg.attach_alternative(html_content, 'text/html')
-        msg.send()
-        msg_constructora = EmailMultiAlternatives('Alerta en el inmueble ' + address_to_notify + ' ' + name_to_notify, html_content_constructora,'watchapp.latam@gmail.com', [mail_constructora])
-        msg_constructora.attach_alternative(html_content_constructora, 'text/html')
-        msg_constructora.send()
-        
-    if instance.is_fatal == True and property_in_event.is_secure_mode == True:
-        print "entra al evento fatal"
-        text_content = ''
-        html_content = render_to_string('watchapp/email.html', {'address_to_notify':address_to_notify, 'name_to_notify':name_to_notify, 'first_name':first_name, 'last_name':last_name, 'sensor': sensor})
-        html_content_constructora = render_to_string('watchapp/email_constructora.html', {'constructora': constructora, 'address_to_notify':address_to_notify, 'name_to_notify':name_to_notify, 'first_name':first_name, 'last_name':last_name, 'sensor': sensor, 'mobile_to_notify':mobile_to_notify, 'mail_to_notify':mail_to_notify})
-        msg = EmailMultiAlternatives('Alerta en el inmueble ' + address_to_notify + ' ' + name_to_notify, html_content,'watchapp.latam@gmail.com', [mail_to_notify])
-        msg.attach_alternative(html_content, 'text/html')
-        msg.send()
-        msg_constructora = EmailMultiAlternatives('Alerta en el inmueble ' + address_to_notify + ' ' + name_to_notify, html_content_constructora,'watchapp.latam@gmail.com', [mail_constructora])
-        msg_constructora.attach_alternative(html_content_constructora, 'text/html')
-        msg_constructora.send()
-        requests.post(os.environ['BLOWERIO_URL'] + '/messages', data={'to': mobile_to_notify, 'message': 'ATENCION: Alerta fatal: ' + instance.description + ' del inmueble: ' + instance.property.name + '. Mensaje de: Watchapp'})
+        with transaction.atomic():
+            queue_event_notifications(instance)
+    except Exception:
+        log.exception("notify_event: no se pudieron encolar las notificaciones del evento %s del inmueble %s", instance.id, instance.property_id)
+
+def queue_event_notifications(instance):
+    '''Encola las notificaciones del evento. Las alertas repetidas del mismo sensor y severidad se agrupan en un resumen (watchapp.alerts)'''
+    # Import local para evitar el import circular, recipients registra sus senales al cargarse
+    from watchapp.recipients import get_property_contacts
+    from watchapp import alerts
+    contacts = get_property_contacts(instance.property_id)
+    if not contacts.is_secure_mode:
+        return
+    is_critical = instance.is_critical == True and alerts.admit(instance, AlertWindow.CRITICAL, contacts)
+    is_fatal = instance.is_fatal == True and alerts.admit(instance, AlertWindow.FATAL, contacts)
+    if not (is_critical or is_fatal):
+        log.debug("notify_event: evento %s agrupado en la ventana de alertas", instance.id)
+        return
+    if not (contacts.mail_constructora or contacts.mail_to_notify):
+        log.warning("notify_event: el inmueble %s no tiene constructora ni contacto para notificar el evento %s", instance.property_id, instance.id)
+        return
+    log.debug("notify_event: evento %s del inmueble %s", instance.id, instance.property_id)
+    sensor = instance.sensor.description
+    context = {'constructora': contacts.constructora, 'address_to_notify': contacts.address, 'name_to_notify': contacts.name,
+               'first_name': contacts.first_name, 'last_name': contacts.last_name, 'sensor': sensor,
+               'mobile_to_notify': contacts.mobile_to_notify, 'mail_to_notify': contacts.mail_to_notify}
+    html_content = mailer.render('watchapp/email.html', context)
+    html_content_constructora = mailer.render('watchapp/email_constructora.html', context)
+    subject = 'Alerta en el inmueble ' + contacts.label
+
+    if is_critical:
+        log.debug("notify_event: evento critico %s", instance.id)
+        NotificationOutbox.queue_email(subject, html_content, [contacts.mail_constructora])
+        NotificationOutbox.queue_email(subject, html_content_constructora, [contacts.mail_constructora])
+
+    if is_fatal:
+        log.debug("notify_event: evento fatal %s", instance.id)
+        NotificationOutbox.queue_email(subject, html_content, [contacts.mail_to_notify])
+        NotificationOutbox.queue_email(subject, html_content_constructora, [contacts.mail_constructora])
+        NotificationOutbox.queue_sms(contacts.mobile_to_notify, 'ATENCION: Alerta fatal: ' + instance.description + ' del inmueble: ' + contacts.name + '. Mensaje de: Watchapp')
@@ -0,0 +1,101 @@
+"""
+Envio de las notificaciones encoladas en NotificationOutbox.
+Lo usa el comando notification_worker; el registro de los eventos solo guarda las filas de la cola.
+Los correos de un lote se envian por una misma conexion del backend de correo (mailer.EmailSender).
+"""
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.utils import timezone
+from watchapp.models import NotificationOutbox
+from watchapp import sms, mailer
+import datetime
+import logging
+
+log = logging.getLogger(__name__)
+
+FROM_EMAIL = mailer.FROM_EMAIL
+
+def claim_batch(limit):
+    """
+    Toma hasta limit notificaciones pendientes y las marca como Enviando.
+    Las que queden en Enviando porque el worker murio se vuelven a tomar cuando vence NOTIFICATION_LEASE.
+        @param limit
+    """
+    now = timezone.now()
+    lease = datetime.timedelta(seconds=getattr(settings, 'NOTIFICATION_LEASE', 300))
+    with transaction.atomic():
+        batch = list(NotificationOutbox.objects.select_for_update().filter(
+            status__in=[NotificationOutbox.PENDING, NotificationOutbox.SENDING],
+            next_attempt__lte=now).order_by('next_attempt')[:limit])
+        NotificationOutbox.objects.filter(pk__in=[n.id for n in batch]).update(status=NotificationOutbox.SENDING, next_attempt=now + lease)
+    return batch
+
+def deliver(notification, sender=None):
+    """
+    Envia una notificacion por su canal, lanza una excepcion si el envio falla
+        @param notification
+        @param sender mailer.EmailSender con la conexion de correo del lote, None para abrir una conexion propia
+    """
+    if notification.channel == NotificationOutbox.EMAIL:
+        if sender is None:
+            with mailer.EmailSender() as own_sender:
+                own_sender.send(notification.subject, notification.body, notification.recipient_list())
+        else:
+            sender.send(notification.subject, notification.body, notification.recipient_list())
+    else:
+        sms_backend = sms.get_backend()
+        for to in notification.recipient_list():
+            sms_backend.send(to, notification.body)
+
+def process(notification, sender=None):
+    """
+    Envia una notificacion y registra el resultado. Si falla se reintenta con espera exponencial
+    (NOTIFICATION_RETRY_DELAY * 2^intentos) hasta NOTIFICATION_MAX_ATTEMPTS intentos.
+        @param notification
+        @param sender mailer.EmailSender compartido por el lote
+    """
+    close_old_connections()
+    try:
+        deliver(notification, sender)
+    except Exception as inst:
+        notification.attempts += 1
+        notification.last_error = str(inst)
+        if notification.attempts >= getattr(settings, 'NOTIFICATION_MAX_ATTEMPTS', 5):
+            notification.status = NotificationOutbox.FAILED
+            log.error("process: notificacion %s fallida: %s", notification.id, inst)
+        else:
+            delay = getattr(settings, 'NOTIFICATION_RETRY_DELAY', 30) * 2 ** (notification.attempts - 1)
+            notification.status = NotificationOutbox.PENDING
+            notification.next_attempt = timezone.now() + datetime.timedelta(seconds=delay)
+            log.warning("process: notificacion %s reintento en %ss: %s", notification.id, delay, inst)
+        notification.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt'])
+        return False
+    notification.status = NotificationOutbox.SENT
+    notification.sent = timezone.now()
+    notification.save(update_fields=['status', 'sent'])
+    return True
+
+def process_batch(batch):
+    """
+    Envia las notificaciones en orden, los correos por una sola conexion de correo.
+    Retorna el numero de notificaciones enviadas.
+        @param batch
+    """
+    with mailer.EmailSender() as sender:
+        return len([n for n in batch if process(n, sender)])
+
+def drain(limit, pool=None, connections=1):
+    """
+    Envia un lote de notificaciones pendientes. Con un pool de hilos el lote se reparte en connections grupos que se
+    envian en paralelo, cada uno con su conexion de correo.
+    Retorna el numero de notificaciones procesadas.
+        @param limit
+        @param pool
+        @param connections
+    """
+    batch = claim_batch(limit)
+    if pool is None or connections <= 1:
+        process_batch(batch)
+    else:
+        pool.map(process_batch, [group for group in (batch[i::connections] for i in range(connections)) if group])
+    return len(batch)
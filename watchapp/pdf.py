@@ -0,0 +1,90 @@
+"""
+Conversion de HTML a PDF con pisa (xhtml2pdf).
+Las funciones de este modulo no usan la base de datos, por lo que se pueden ejecutar en un pool de procesos.
+"""
+from PyPDF2 import PdfFileMerger
+import ho.pisa as pisa
+import cStringIO as StringIO
+import collections
+import os
+import shutil
+import tempfile
+
+def write_pdf(html, path):
+    """
+    Convierte html a PDF y lo guarda en path. El archivo se escribe primero en un temporal del mismo
+    directorio y se renombra, asi un lector nunca ve un PDF a medias.
+    Retorna None o el mensaje de error.
+        @param html
+        @param path
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix='.pdf', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as dest:
+            pdf = pisa.pisaDocument(StringIO.StringIO(html.encode("UTF-8")), dest)
+        if pdf.err:
+            os.remove(tmp_path)
+            return 'Error al generar el PDF'
+        os.rename(tmp_path, path)
+        return None
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_pdf_parts(html_parts, path, pool=None, max_pending=4):
+    """
+    Convierte cada bloque de html_parts en un PDF parcial y los une en path con PyPDF2.
+    Los bloques se consumen a medida que se convierten: con un pool de procesos hay a lo sumo max_pending
+    conversiones en curso, asi la memoria no depende del numero total de eventos.
+    Retorna None o el mensaje de error.
+        @param html_parts iterable de documentos html
+        @param path
+        @param pool multiprocessing.Pool o None para convertir en este proceso
+        @param max_pending
+    """
+    parts_dir = tempfile.mkdtemp(dir=os.path.dirname(path))
+    part_paths = []
+    pending = collections.deque()
+    try:
+        for html in html_parts:
+            part_path = os.path.join(parts_dir, '%06d.pdf' % len(part_paths))
+            part_paths.append(part_path)
+            if pool is None:
+                error = write_pdf(html, part_path)
+                if error:
+                    return error
+                continue
+            pending.append(pool.apply_async(write_pdf, (html, part_path)))
+            if len(pending) >= max_pending:
+                error = pending.popleft().get()
+                if error:
+                    return error
+        while pending:
+            error = pending.popleft().get()
+            if error:
+                return error
+        merge_pdfs(part_paths, path)
+        return None
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+def merge_pdfs(part_paths, path):
+    """
+    Une los PDF parciales en path, escribiendo primero en un temporal del mismo directorio
+        @param part_paths
+        @param path
+    """
+    merger = PdfFileMerger()
+    fd, tmp_path = tempfile.mkstemp(suffix='.pdf', dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        for part_path in part_paths:
+            merger.append(part_path)
+        with open(tmp_path, 'wb') as dest:
+            merger.write(dest)
+        os.rename(tmp_path, path)
+    finally:
+        merger.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
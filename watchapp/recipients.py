@@ -0,0 +1,141 @@
+"""
+Resolucion de los destinatarios de las notificaciones de un inmueble.
+Los datos de contacto (constructora, propietario o residente) se cargan con un numero fijo de consultas
+y se guardan en un cache LRU del proceso que se invalida con las senales de los modelos relacionados.
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Prefetch
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from watchapp.models import ConstructorCompany, Property, UserProfile
+from collections import OrderedDict
+import threading
+import time
+
+class LRUCache(object):
+    """
+    Cache LRU en memoria, seguro para hilos, con tiempo de vida maximo por entrada.
+    El tiempo de vida acota cuanto puede estar desactualizado un proceso cuando el cambio ocurre en otro.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                return None
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard_where(self, predicate):
+        """
+        Elimina las entradas cuyo valor cumple el predicado
+        """
+        with self._lock:
+            for key in [k for k, (value, expires) in self._data.items() if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class PropertyContacts(object):
+    """
+    Datos de contacto de un inmueble usados por EventNotifier. La constructora y el contacto (con su correo y celular)
+    son None si el inmueble no los tiene; los canales sin destinatario no se notifican
+    """
+    def __init__(self, prop):
+        self.property_id = prop.id
+        self.name = prop.name
+        self.address = prop.address or ''
+        # Direccion y nombre para los asuntos y mensajes, los inmuebles importados no tienen direccion
+        self.label = ' '.join(part for part in (prop.address, prop.name) if part)
+        self.is_secure_mode = prop.is_secure_mode
+        self.constructora = prop.constructor_company
+        self.constructor_company_id = prop.constructor_company_id
+        self.mail_constructora = prop.constructor_company.email if prop.constructor_company else None
+        owners = list(prop.properties_as_owner.all())
+        residents = list(prop.properties_as_resident.all())
+        self.profile_ids = set(p.id for p in owners + residents)
+        self.user_ids = set(p.user_id for p in owners + residents)
+        # Se notifica al primer propietario, si el inmueble no tiene propietarios al primer residente
+        contact = (owners or residents or [None])[0]
+        self.mobile_to_notify = contact.mobile_number if contact else None
+        self.mail_to_notify = contact.user.email if contact else None
+        self.first_name = contact.user.first_name if contact else ''
+        self.last_name = contact.user.last_name if contact else ''
+
+contacts_cache = LRUCache(getattr(settings, 'RECIPIENTS_CACHE_SIZE', 1024), getattr(settings, 'RECIPIENTS_CACHE_TTL', 300))
+
+def get_property_contacts(property_id):
+    """
+    Retorna los datos de contacto de un inmueble, desde el cache o con tres consultas
+    (inmueble y constructora, propietarios y residentes con su usuario)
+        @param property_id
+    """
+    contacts = contacts_cache.get(property_id)
+    if contacts is None:
+        profiles = UserProfile.objects.select_related('user').order_by('id')
+        prop = Property.objects.select_related('constructor_company').prefetch_related(
+            Prefetch('properties_as_owner', queryset=profiles),
+            Prefetch('properties_as_resident', queryset=profiles)).get(pk=property_id)
+        contacts = PropertyContacts(prop)
+        contacts_cache.set(property_id, contacts)
+    return contacts
+
+####################### Invalidacion del cache #######################
+
+@receiver(post_save, sender=Property)
+@receiver(post_delete, sender=Property)
+def invalidate_property_contacts(sender, instance, **kwargs):
+    contacts_cache.pop(instance.id)
+
+@receiver(post_save, sender=ConstructorCompany)
+@receiver(post_delete, sender=ConstructorCompany)
+def invalidate_constructor_contacts(sender, instance, **kwargs):
+    contacts_cache.discard_where(lambda c: c.constructor_company_id == instance.id)
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_profile_contacts(sender, instance, **kwargs):
+    contacts_cache.discard_where(lambda c: instance.id in c.profile_ids)
+
+@receiver(post_save, sender=User)
+def invalidate_user_contacts(sender, instance, **kwargs):
+    contacts_cache.discard_where(lambda c: instance.id in c.user_ids)
+
+@receiver(m2m_changed, sender=UserProfile.properties_as_owner.through)
+@receiver(m2m_changed, sender=UserProfile.properties_as_resident.through)
+def invalidate_membership_contacts(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        contacts_cache.pop(instance.id)
+    elif pk_set is None:
+        contacts_cache.discard_where(lambda c: instance.id in c.profile_ids)
+    else:
+        for property_id in pk_set:
+            contacts_cache.pop(property_id)
@@ -0,0 +1,98 @@
+"""
+Trabajos de generacion de reportes PDF fuera de los workers web.
+La vista submit_report_job crea el trabajo y el comando report_worker lo procesa: arma el HTML por bloques
+(consultas a la base de datos) en el proceso principal y convierte cada bloque a PDF en un pool de procesos.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from watchapp.models import ReportJob
+from watchapp import reports, pdf
+import datetime
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+def submit(kind, user, data):
+    """
+    Crea un trabajo de reporte. Si el PDF ya esta en el cache o no hay eventos el trabajo queda terminado,
+    y si ya hay un trabajo pendiente con los mismos parametros se reutiliza.
+        @param kind
+        @param user
+        @param data parametros del reporte
+    """
+    cache_key, count = reports.report_fingerprint(kind, user, data)
+    if count == 0:
+        status = ReportJob.EMPTY
+    elif os.path.exists(reports.report_path(cache_key)):
+        # Se usa de nuevo, prune_reports borra primero los que no se han usado
+        touch(reports.report_path(cache_key))
+        status = ReportJob.DONE
+    else:
+        running = ReportJob.objects.filter(user=user, cache_key=cache_key, status__in=[ReportJob.PENDING, ReportJob.RUNNING]).first()
+        if running is not None:
+            return running
+        status = ReportJob.PENDING
+    finished = timezone.now() if status != ReportJob.PENDING else None
+    return ReportJob.objects.create(user=user, kind=kind, params=json.dumps(data), cache_key=cache_key, status=status, finished=finished)
+
+def touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+def claim_batch(limit, ids=None):
+    """
+    Toma hasta limit trabajos pendientes. Los que quedaron Generando por la caida de un worker
+    se vuelven a tomar despues de REPORT_JOB_LEASE segundos.
+        @param limit
+        @param ids None para tomar cualquier trabajo o los ids de los unicos trabajos que se pueden tomar
+    """
+    now = timezone.now()
+    expired = now - datetime.timedelta(seconds=getattr(settings, 'REPORT_JOB_LEASE', 600))
+    with transaction.atomic():
+        pending = ReportJob.objects.select_for_update().filter(status=ReportJob.PENDING)
+        stale = ReportJob.objects.select_for_update().filter(status=ReportJob.RUNNING, started__lt=expired)
+        if ids is not None:
+            pending = pending.filter(pk__in=ids)
+            stale = stale.filter(pk__in=ids)
+        batch = list(pending.order_by('created')[:limit]) + list(stale.order_by('created')[:limit])
+        batch = batch[:limit]
+        ReportJob.objects.filter(pk__in=[j.id for j in batch]).update(status=ReportJob.RUNNING, started=now)
+    return batch
+
+def finish(job, status, error=''):
+    job.status = status
+    job.error = error
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'error', 'finished', 'cache_key'])
+
+def run_batch(limit, pool=None, ids=None):
+    """
+    Procesa un lote de trabajos. La llave del cache se recalcula al generar, por si llegaron eventos
+    despues de crear el trabajo. Con pool los bloques del PDF se convierten en paralelo en otros procesos.
+    Retorna el numero de trabajos procesados.
+        @param limit
+        @param pool multiprocessing.Pool o None para convertir en este proceso
+        @param ids None para procesar cualquier trabajo pendiente o los ids de los trabajos a procesar
+    """
+    batch = claim_batch(limit, ids)
+    for job in batch:
+        try:
+            data = json.loads(job.params)
+            job.cache_key, count = reports.report_fingerprint(job.kind, job.user, data)
+            path = reports.report_path(job.cache_key)
+            if count == 0:
+                finish(job, ReportJob.EMPTY)
+            elif os.path.exists(path):
+                finish(job, ReportJob.DONE)
+            else:
+                error = pdf.write_pdf_parts(reports.report_html_parts(job.kind, job.user, data), path, pool)
+                finish(job, ReportJob.FAILED if error else ReportJob.DONE, error or '')
+        except Exception as inst:
+            log.exception("run_batch: trabajo %s", job.id)
+            finish(job, ReportJob.FAILED, str(inst))
+    return len(batch)
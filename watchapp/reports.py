@@ -0,0 +1,358 @@
+"""
+Consultas y filas de los reportes de eventos, compartidas por las vistas get_event_* y get_report_*.
+Las filas se construyen con un numero fijo de consultas: los eventos con su inmueble y sensor
+(select_related) y el primer propietario de cada inmueble en una sola consulta.
+Los eventos se consultan con archive.events, que incluye EventArchive solo si el rango llega a los eventos archivados.
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Count, Max
+from django.template.loader import render_to_string
+from watchapp.models import ConstructorCompany, Property, UserProfile, Event
+from watchapp import archive, pdf
+import csv
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+EVENT_TYPE_LABELS = dict(Event.EVENT_CHOICES)
+
+def owner_property_events(user, data):
+    """
+    Eventos de los inmuebles de un propietario, data['property'] == '0' para todos sus inmuebles.
+    Retorna el queryset y la etiqueta del filtro para el encabezado del reporte.
+        @param user
+        @param data parametros json del reporte (property, dateInit, dateFinal)
+    """
+    if data['property'] == '0':
+        properties = user.userprofile.properties_as_owner.all()
+        return archive.events(data['dateInit'], data['dateFinal'], property__in=properties), "Todas"
+    selected_property = Property.objects.get(name=data['property'])
+    return archive.events(data['dateInit'], data['dateFinal'], property_id=selected_property.id), data['property']
+
+def constructor_properties(user):
+    """
+    Inmuebles de la constructora del usuario autenticado
+        @param user
+    """
+    constructora = ConstructorCompany.objects.get(user_id=user.userprofile.id)
+    return Property.objects.filter(constructor_company_id=constructora.id)
+
+def constructor_events(user, data):
+    """
+    Eventos de todos los inmuebles de la constructora, data['event_type'] == '-1' para todos los tipos.
+        @param user
+        @param data parametros json del reporte (event_type, dateInit, dateFinal)
+    """
+    events = archive.events(data['dateInit'], data['dateFinal'], property__in=constructor_properties(user))
+    if data['event_type'] == '-1':
+        return events, "Todos"
+    return events.filter(type=data['event_type']), EVENT_TYPE_LABELS.get(data['event_type'], data['event_type'])
+
+def constructor_owner_events(user, data):
+    """
+    Eventos de los inmuebles de la constructora de un propietario, data['owners_select'] == '0' para todos.
+        @param user
+        @param data parametros json del reporte (owners_select, dateInit, dateFinal)
+    """
+    properties = constructor_properties(user)
+    if data['owners_select'] == '0':
+        return archive.events(data['dateInit'], data['dateFinal'], property__in=properties), "Todos"
+    owner_name = data['owners_select'].split()
+    owner_id = User.objects.get(first_name=owner_name[0])
+    properties = properties.filter(properties_as_owner=owner_id)
+    return archive.events(data['dateInit'], data['dateFinal'], property__in=properties), data['owners_select']
+
+def owner_names(property_ids):
+    """
+    Retorna {property_id: nombre del primer propietario} con una sola consulta a la tabla intermedia
+        @param property_ids
+    """
+    names = {}
+    owners = UserProfile.properties_as_owner.through.objects.filter(property_id__in=property_ids).order_by('id')
+    for property_id, first_name, last_name in owners.values_list('property_id', 'userprofile__user__first_name', 'userprofile__user__last_name'):
+        if property_id not in names:
+            names[property_id] = str(first_name.encode('utf8')) + ' ' + str(last_name.encode('utf8'))
+    return names
+
+def event_row(e, owner=None):
+    """
+    Fila del reporte de un evento, owner es el nombre del propietario o None si el reporte no lo incluye
+        @param e
+        @param owner
+    """
+    row = {}
+    row["date"] = str(e.date.date())
+    row["description"] = str(e.description.encode('utf8'))
+    row["type"] = str(e.get_type_display())
+    row["is_critical"] = "Si" if e.is_critical else "No"
+    row["is_fatal"] = "Si" if e.is_fatal else "No"
+    row["property"] = e.property.name.encode('utf8')
+    row["sensor"] = str(e.sensor.description.encode('utf8'))
+    if owner is not None:
+        row["propietario"] = owner
+    return row
+
+def event_rows(events, with_owner=False, owner=None):
+    """
+    Construye las filas del reporte en una pasada. Con with_owner cada fila lleva el propietario del inmueble,
+    o el nombre fijo owner cuando el reporte es de un solo propietario.
+        @param events queryset de eventos o archive.EventSet
+        @param with_owner
+        @param owner
+    """
+    events = list(events.select_related('property', 'sensor'))
+    owners = {}
+    if with_owner and owner is None:
+        owners = owner_names(set(e.property_id for e in events))
+    rows = []
+    for e in events:
+        if not with_owner:
+            rows.append(event_row(e))
+        else:
+            rows.append(event_row(e, owner if owner is not None else owners.get(e.property_id, '')))
+    return rows
+
+####################### Exportacion por streaming #######################
+
+REPORT_COLUMNS = (
+    ('date', 'Fecha'),
+    ('description', 'Descripcion'),
+    ('type', 'Tipo'),
+    ('is_critical', 'Critico'),
+    ('is_fatal', 'Fatal'),
+    ('property', 'Propiedad'),
+    ('sensor', 'Sensor'),
+)
+OWNER_COLUMN = ('propietario', 'Propietario')
+
+def iter_event_chunks(events, chunk_size=1000):
+    """
+    Recorre los eventos por bloques de chunk_size (paginando por llave primaria) con su inmueble y sensor,
+    para procesar reportes grandes con memoria constante. Los eventos archivados se recorren primero.
+        @param events queryset de eventos o archive.EventSet
+        @param chunk_size
+    """
+    for part in archive.parts(events):
+        part = part.select_related('property', 'sensor').order_by('pk')
+        last_pk = 0
+        while True:
+            chunk = list(part.filter(pk__gt=last_pk)[:chunk_size].iterator())
+            if not chunk:
+                break
+            yield chunk
+            last_pk = chunk[-1].pk
+
+def iter_row_chunks(events, with_owner=False, owner=None, chunk_size=1000):
+    """
+    Filas del reporte (como event_rows) por bloques de chunk_size eventos, cada bloque hace dos consultas
+        @param events queryset de eventos
+        @param with_owner
+        @param owner
+        @param chunk_size
+    """
+    for chunk in iter_event_chunks(events, chunk_size):
+        owners = {}
+        if with_owner and owner is None:
+            owners = owner_names(set(e.property_id for e in chunk))
+        if not with_owner:
+            yield [event_row(e) for e in chunk]
+        else:
+            yield [event_row(e, owner if owner is not None else owners.get(e.property_id, '')) for e in chunk]
+
+def iter_event_rows(events, with_owner=False, owner=None, chunk_size=1000):
+    """
+    Igual que event_rows pero genera las filas una a una leyendo los eventos por bloques
+        @param events queryset de eventos
+        @param with_owner
+        @param owner
+        @param chunk_size
+    """
+    for chunk in iter_row_chunks(events, with_owner, owner, chunk_size):
+        for row in chunk:
+            yield row
+
+def report_columns(with_owner):
+    return REPORT_COLUMNS + (OWNER_COLUMN,) if with_owner else REPORT_COLUMNS
+
+def stream_json(rows):
+    """
+    Genera un arreglo JSON fila por fila
+        @param rows iterable de filas
+    """
+    yield '['
+    separator = ''
+    for row in rows:
+        yield separator + json.dumps(row)
+        separator = ','
+    yield ']'
+
+class _Echo(object):
+    """
+    Objeto tipo archivo que retorna lo escrito, para generar el CSV linea por linea
+    """
+    def write(self, value):
+        return value
+
+def stream_csv(rows, columns):
+    """
+    Genera un CSV con encabezado fila por fila
+        @param rows iterable de filas
+        @param columns tupla de (llave, titulo)
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow([title for key, title in columns])
+    for row in rows:
+        yield writer.writerow([row[key] for key, title in columns])
+
+####################### Reportes PDF #######################
+
+# Parametros que definen cada tipo de reporte (ReportJob.KIND_CHOICES)
+REPORT_PARAMS = {
+    '0': ('property', 'dateInit', 'dateFinal'),
+    '1': ('event_type', 'dateInit', 'dateFinal'),
+    '2': ('owners_select', 'dateInit', 'dateFinal'),
+}
+
+class ReportError(Exception):
+    pass
+
+def report_events(kind, user, data):
+    """
+    Eventos y etiqueta del filtro de un tipo de reporte
+        @param kind ReportJob.KIND_CHOICES
+        @param user
+        @param data
+    """
+    if kind == '0':
+        return owner_property_events(user, data)
+    if kind == '1':
+        return constructor_events(user, data)
+    return constructor_owner_events(user, data)
+
+def report_fingerprint(kind, user, data):
+    """
+    Llave del PDF en el cache: hash del tipo de reporte, el usuario, los parametros y el numero y ultimo id
+    de los eventos del rango, asi la llave cambia cuando llegan eventos nuevos. Retorna (llave, numero de eventos).
+        @param kind
+        @param user
+        @param data
+    """
+    events, label = report_events(kind, user, data)
+    count, last = 0, None
+    for part in archive.parts(events):
+        stats = part.aggregate(count=Count('id'), last=Max('id'))
+        count += stats['count']
+        last = max(last, stats['last'])
+    params = dict((name, data.get(name)) for name in REPORT_PARAMS[kind])
+    raw = json.dumps([kind, user.id, params, count, last], sort_keys=True)
+    return hashlib.sha1(raw).hexdigest(), count
+
+def report_path(cache_key):
+    """
+    Ruta del PDF en el cache local (settings.REPORT_ROOT). El directorio debe ser compartido por los procesos web y
+    report_worker, ver settings.REPORT_ROOT
+        @param cache_key
+    """
+    if not os.path.isdir(settings.REPORT_ROOT):
+        os.makedirs(settings.REPORT_ROOT)
+    return os.path.join(settings.REPORT_ROOT, cache_key + '.pdf')
+
+REPORT_FILE_RE = re.compile(r'^[0-9a-f]{40}\.pdf$')
+
+def prune_reports(max_age=None, max_bytes=None, now=None):
+    """
+    Borra del cache local los PDF generados hace mas de max_age segundos (REPORT_MAX_AGE) y, si los restantes
+    ocupan mas de max_bytes (REPORT_ROOT_MAX_MB), los mas antiguos hasta quedar por debajo. Tambien borra los
+    temporales de conversiones interrumpidas. Retorna el numero de PDF borrados.
+        @param max_age
+        @param max_bytes
+        @param now
+    """
+    max_age = max_age if max_age is not None else getattr(settings, 'REPORT_MAX_AGE', 7 * 24 * 3600)
+    max_bytes = max_bytes if max_bytes is not None else getattr(settings, 'REPORT_ROOT_MAX_MB', 1024) * 1024 * 1024
+    now = now or time.time()
+    if not os.path.isdir(settings.REPORT_ROOT):
+        return 0
+    kept = []
+    removed = 0
+    for name in os.listdir(settings.REPORT_ROOT):
+        path = os.path.join(settings.REPORT_ROOT, name)
+        try:
+            stat = os.stat(path)
+            if not REPORT_FILE_RE.match(name):
+                # Temporales de write_pdf_parts y merge_pdfs, solo los de conversiones que ya no estan en curso
+                if now - stat.st_mtime > max_age:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+            elif now - stat.st_mtime > max_age:
+                os.remove(path)
+                removed += 1
+            else:
+                kept.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            # Otro proceso lo borro o lo renombro mientras tanto
+            continue
+    total = sum(size for mtime, size, path in kept)
+    for mtime, size, path in sorted(kept):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+        total -= size
+    return removed
+
+def report_html_parts(kind, user, data, chunk_size=None):
+    """
+    Genera el HTML del reporte PDF por bloques de chunk_size eventos (settings.REPORT_PDF_CHUNK_SIZE).
+    Solo el primer bloque lleva el encabezado del reporte; cada bloque se convierte a PDF por separado.
+        @param kind
+        @param user
+        @param data
+        @param chunk_size
+    """
+    chunk_size = chunk_size or getattr(settings, 'REPORT_PDF_CHUNK_SIZE', 500)
+    events, pData = report_events(kind, user, data)
+    context = {'pagesize': 'A4', 'user': user, 'dateInit': str(data['dateInit']).split(' ')[0], 'dateFinal': str(data['dateFinal']).split(' ')[0]}
+    if kind == '0':
+        # El template recorre el inmueble y el sensor de cada evento
+        chunks = iter_event_chunks(events, chunk_size)
+        template, rows_name = 'watchapp/template_rpt_owner_property.html', 'Events'
+        context['property'] = str(pData)
+    elif kind == '1':
+        chunks = iter_row_chunks(events, with_owner=True, chunk_size=chunk_size)
+        template, rows_name = 'watchapp/template_rpt_admin_all_property.html', 'sdf'
+        context['event_type'] = str(pData)
+    else:
+        owner = None if data['owners_select'] == '0' else data['owners_select']
+        chunks = iter_row_chunks(events, with_owner=True, owner=owner, chunk_size=chunk_size)
+        template, rows_name = 'watchapp/template_rpt_admin_all_property_by_owner.html', 'events'
+        context['event_type'] = str(pData)
+    for number, chunk in enumerate(chunks):
+        context.update({rows_name: chunk, 'continuation': number > 0})
+        yield render_to_string(template, context)
+
+def build_report(kind, user, data):
+    """
+    Retorna la ruta del PDF del reporte desde el cache, generandolo si no existe, o None si no hay eventos
+        @param kind
+        @param user
+        @param data
+    """
+    cache_key, count = report_fingerprint(kind, user, data)
+    if count == 0:
+        return None
+    path = report_path(cache_key)
+    if not os.path.exists(path):
+        error = pdf.write_pdf_parts(report_html_parts(kind, user, data), path)
+        if error:
+            raise ReportError(error)
+    return path
@@ -0,0 +1,164 @@
+"""
+Acumulados de eventos por hora y por dia (EventRollupHour, EventRollupDay) para los tableros de las constructoras
+y los propietarios. EventViewSet los actualiza en la misma transaccion en la que inserta los eventos y el comando
+rebuild_rollups los reconstruye desde la tabla Event. Los resumenes leen los acumulados, asi el costo depende del
+numero de periodos y no del numero de eventos.
+"""
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from watchapp.models import Event, EventArchive, EventRollupHour, EventRollupDay
+import collections
+import datetime
+
+EVENT_TYPE_LABELS = dict(Event.EVENT_CHOICES)
+
+GRANULARITIES = {
+    'hour': EventRollupHour,
+    'day': EventRollupDay,
+}
+
+def parse_date_param(value):
+    """
+    Convierte un parametro de fecha ('2015-03-01', '2015-03-01 00:00:00-05') en datetime con zona horaria.
+    Retorna None si el valor no es una fecha.
+        @param value
+    """
+    value = (value or '').strip()
+    date = parse_datetime(value)
+    if date is None:
+        day = parse_date(value)
+        if day is None:
+            return None
+        date = datetime.datetime.combine(day, datetime.time())
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date, timezone.get_current_timezone())
+    return date
+
+def hour_bucket(date):
+    """
+    Inicio de la hora (en la zona horaria actual) de una fecha
+        @param date
+    """
+    return timezone.localtime(date).replace(minute=0, second=0, microsecond=0)
+
+def day_bucket(date):
+    """
+    Dia (en la zona horaria actual) de una fecha
+        @param date
+    """
+    return timezone.localtime(date).date()
+
+def count_events(rows):
+    """
+    Cuenta los eventos por acumulado. Retorna dos Counter {(property_id, bucket, type, is_critical, is_fatal): n},
+    uno por hora y otro por dia.
+        @param rows iterable de tuplas (property_id, date, type, is_critical, is_fatal)
+    """
+    hours = collections.Counter()
+    days = collections.Counter()
+    for property_id, date, event_type, is_critical, is_fatal in rows:
+        hours[(property_id, hour_bucket(date), event_type, is_critical, is_fatal)] += 1
+        days[(property_id, day_bucket(date), event_type, is_critical, is_fatal)] += 1
+    return hours, days
+
+def increment(model, counts):
+    """
+    Suma los conteos a los acumulados con un UPDATE por llave, creando la fila si no existe.
+    Si otra transaccion crea la misma fila al tiempo se reintenta el UPDATE.
+        @param model EventRollupHour o EventRollupDay
+        @param counts Counter de count_events
+    """
+    for (property_id, bucket, event_type, is_critical, is_fatal), n in counts.items():
+        key = {'property_id': property_id, 'bucket': bucket, 'type': event_type, 'is_critical': is_critical, 'is_fatal': is_fatal}
+        if model.objects.filter(**key).update(count=F('count') + n):
+            continue
+        try:
+            with transaction.atomic():
+                model.objects.create(count=n, **key)
+        except IntegrityError:
+            model.objects.filter(**key).update(count=F('count') + n)
+
+def record_events(events):
+    """
+    Actualiza los acumulados con eventos recien creados, se llama dentro de la transaccion que los inserta
+        @param events lista de Event
+    """
+    hours, days = count_events((e.property_id, e.date, e.type, e.is_critical, e.is_fatal) for e in events)
+    increment(EventRollupHour, hours)
+    increment(EventRollupDay, days)
+
+def rebuild(since=None, chunk_size=10000, batch_size=1000):
+    """
+    Reconstruye los acumulados desde las tablas EventArchive y Event leyendo los eventos por bloques. Con since solo se
+    reconstruyen los dias desde esa fecha. Retorna el numero de eventos procesados.
+    Los eventos que lleguen mientras corre pueden quedar sin contar, debe ejecutarse sin ingesta o repetirse despues.
+        @param since date o None para reconstruir todo
+        @param chunk_size eventos leidos por consulta
+        @param batch_size filas por bulk_create
+    """
+    sources = [EventArchive.objects.order_by('pk'), Event.objects.order_by('pk')]
+    hours_rollup = EventRollupHour.objects.all()
+    days_rollup = EventRollupDay.objects.all()
+    if since is not None:
+        start = timezone.make_aware(datetime.datetime.combine(since, datetime.time()), timezone.get_current_timezone())
+        sources = [events.filter(date__gte=start) for events in sources]
+        hours_rollup = hours_rollup.filter(bucket__gte=start)
+        days_rollup = days_rollup.filter(bucket__gte=since)
+    hours = collections.Counter()
+    days = collections.Counter()
+    total = 0
+    for events in sources:
+        last_pk = 0
+        while True:
+            chunk = list(events.filter(pk__gt=last_pk).values_list('pk', 'property_id', 'date', 'type', 'is_critical', 'is_fatal')[:chunk_size])
+            if not chunk:
+                break
+            chunk_hours, chunk_days = count_events(row[1:] for row in chunk)
+            hours.update(chunk_hours)
+            days.update(chunk_days)
+            total += len(chunk)
+            last_pk = chunk[-1][0]
+    with transaction.atomic():
+        hours_rollup.delete()
+        days_rollup.delete()
+        for model, counts in ((EventRollupHour, hours), (EventRollupDay, days)):
+            rows = [model(property_id=key[0], bucket=key[1], type=key[2], is_critical=key[3], is_fatal=key[4], count=n)
+                    for key, n in counts.items()]
+            # batch_size no puede superar el limite de parametros del motor (SQLite)
+            limit = connection.ops.bulk_batch_size(model._meta.concrete_fields, rows) or batch_size
+            model.objects.bulk_create(rows, batch_size=min(batch_size, limit))
+    return total
+
+def summary(properties, granularity, date_init, date_final, event_type=None):
+    """
+    Numero de eventos por periodo, inmueble, tipo y critico/fatal leidos de los acumulados.
+        @param properties queryset o lista de ids de inmuebles
+        @param granularity 'hour' o 'day'
+        @param date_init datetime con zona horaria
+        @param date_final datetime con zona horaria
+        @param event_type tipo de evento o None para todos
+    """
+    model = GRANULARITIES[granularity]
+    if granularity == 'day':
+        date_init, date_final = day_bucket(date_init), day_bucket(date_final)
+    else:
+        date_init = hour_bucket(date_init)
+    rollups = model.objects.filter(property__in=properties, bucket__range=[date_init, date_final])
+    if event_type is not None:
+        rollups = rollups.filter(type=event_type)
+    rows = rollups.values('bucket', 'property_id', 'property__name', 'type', 'is_critical', 'is_fatal', 'count')
+    result = []
+    for row in rows.order_by('bucket', 'property_id', 'type'):
+        result.append({
+            'bucket': row['bucket'].isoformat(),
+            'property_id': row['property_id'],
+            'property': row['property__name'],
+            'type': row['type'],
+            'type_display': EVENT_TYPE_LABELS.get(row['type'], row['type']),
+            'is_critical': row['is_critical'],
+            'is_fatal': row['is_fatal'],
+            'count': row['count'],
+        })
+    return result
@@ -0,0 +1,98 @@
+"""
+Comandos por lote a los actuadores de un inmueble (escenas). Los cambios se aplican en una transaccion con un
+UPDATE por valor distinto y se registran como eventos 'Cambio actuador' (tipo '4') con bulk_create.
+"""
+from django.db import transaction
+from decimal import Decimal
+from watchapp.models import Sensor, Event
+from watchapp import rollups, sensor_state, stream
+import collections
+
+ACTUATOR = '1'
+ACTUATOR_CHANGE = '4'
+STATUS_LABELS = dict(Sensor.SENSOR_STATUS_CHOICES)
+
+# Escenas predefinidas: nombre -> valor para todos los actuadores del inmueble
+SCENES = {
+    'all_off': '1',
+    'all_on': '5',
+    'dim': '2',
+}
+
+def scene_commands(actuators, name):
+    """
+    Comandos [(sensor_id, value)] de una escena predefinida, o None si la escena no existe
+        @param actuators sensores actuadores del inmueble
+        @param name
+    """
+    if name not in SCENES:
+        return None
+    return [(sensor.id, SCENES[name]) for sensor in actuators]
+
+def validate_commands(actuators, commands):
+    """
+    Valida los comandos contra los actuadores del inmueble y Sensor.SENSOR_STATUS_CHOICES.
+    Retorna (cambios {sensor_id: value}, errores [{index, sensor_id, error}]). Si un sensor se repite gana el ultimo.
+        @param actuators diccionario {id: Sensor} de los sensores del inmueble
+        @param commands lista de pares (sensor_id, value)
+    """
+    changes = collections.OrderedDict()
+    errors = []
+    for index, (sensor_id, value) in enumerate(commands):
+        try:
+            sensor_id = int(sensor_id)
+        except (TypeError, ValueError):
+            errors.append({"index": index, "sensor_id": sensor_id, "error": "Sensor no valido"})
+            continue
+        value = str(value)
+        if sensor_id not in actuators:
+            errors.append({"index": index, "sensor_id": sensor_id, "error": "El sensor no es un actuador del inmueble"})
+        elif value not in STATUS_LABELS:
+            errors.append({"index": index, "sensor_id": sensor_id, "error": "Valor no valido: " + value})
+        else:
+            changes[sensor_id] = value
+    return changes, errors
+
+def apply_commands(property_id, actuators, changes):
+    """
+    Aplica los cambios en una transaccion: un UPDATE por valor y los eventos 'Cambio actuador' en un bulk_create.
+    Los sensores sin cambio de valor no generan evento. Retorna la lista de sensores modificados.
+        @param property_id
+        @param actuators diccionario {id: Sensor}
+        @param changes diccionario {sensor_id: value}
+    """
+    changed = [(sensor_id, value) for sensor_id, value in changes.items() if actuators[sensor_id].value != value]
+    by_value = collections.defaultdict(list)
+    for sensor_id, value in changed:
+        by_value[value].append(sensor_id)
+    events = []
+    for sensor_id, value in changed:
+        sensor = actuators[sensor_id]
+        events.append(Event(description='Cambio actuador: ' + sensor.description + ' a ' + STATUS_LABELS[value],
+                            value=Decimal(value), type=ACTUATOR_CHANGE, property_id=property_id, sensor_id=sensor_id))
+    with transaction.atomic():
+        for value, sensor_ids in by_value.items():
+            Sensor.objects.filter(pk__in=sensor_ids).update(value=value)
+        Event.objects.bulk_create(events)
+        rollups.record_events(events)
+    # Solo despues de guardar: los valores pendientes de la escritura diferida quedan reemplazados por los de la escena
+    sensor_state.state.apply_values(property_id, dict(changed))
+    sensors = []
+    for sensor_id, value in changed:
+        sensor = actuators[sensor_id]
+        sensor.value = value
+        stream.publish_sensor(sensor)
+        sensors.append(sensor)
+    stream.publish_events(events)
+    return sensors
+
+def property_actuators(property_id):
+    """
+    Actuadores del inmueble {id: Sensor} leidos de la base de datos, con los valores que aun no se han escrito
+    del cache de estado de sensores
+        @param property_id
+    """
+    actuators = dict((sensor.id, sensor) for sensor in Sensor.objects.filter(property_id=property_id, type=ACTUATOR))
+    for sensor in actuators.values():
+        sensor.value = sensor_state.state.pending_value(sensor.id, sensor.value)
+    return actuators
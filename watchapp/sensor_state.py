@@ -0,0 +1,206 @@
+"""
+Cache del estado de los sensores por inmueble con escritura diferida (write-behind).
+property_sensors y render_sensor_status leen los sensores del cache. update_sensor cambia el valor en el cache y
+lo deja pendiente: las rafagas de cambios de un mismo sensor se unen y un hilo escribe los pendientes cada
+SENSOR_FLUSH_INTERVAL segundos, solo la columna value y con un UPDATE por valor distinto. Los sensores de alarma
+(SENSOR_SYNC_CODE_PREFIXES) y SENSOR_FLUSH_INTERVAL = 0 escriben de inmediato con save(update_fields=['value']).
+
+El cache es local al proceso; las entradas expiran despues de SENSOR_STATE_TTL segundos para ver los cambios
+hechos por otros procesos, y al recargar se conservan los valores que aun no se han escrito. Los sensores que
+inserta import_worker se invalidan antes en todos los procesos (watchapp.invalidation).
+"""
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from watchapp.models import Sensor
+from watchapp import invalidation
+import atexit
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+def is_sync_sensor(sensor):
+    """
+    True si los cambios del sensor se deben escribir de inmediato (sensores de alarma)
+        @param sensor
+    """
+    return bool(sensor.code) and sensor.code[0] in getattr(settings, 'SENSOR_SYNC_CODE_PREFIXES', ())
+
+class SensorStateCache(object):
+    """
+    Sensores por inmueble en memoria y valores pendientes de escribir {sensor_id: value}
+    """
+    def __init__(self, flush_interval=None, ttl=None, start_thread=True):
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.start_thread = start_thread
+        self.lock = threading.RLock()
+        self.properties = {}
+        self.sensor_property = {}
+        self.pending = {}
+        self.thread = None
+
+    def get_flush_interval(self):
+        if self.flush_interval is not None:
+            return self.flush_interval
+        return getattr(settings, 'SENSOR_FLUSH_INTERVAL', 2)
+
+    def sensors(self, property_id):
+        """
+        Sensores del inmueble ordenados por id, consulta la base de datos si no estan en cache o expiraron
+            @param property_id
+        """
+        ttl = self.ttl if self.ttl is not None else getattr(settings, 'SENSOR_STATE_TTL', 60)
+        with self.lock:
+            entry = self.properties.get(property_id)
+            if entry is not None and time.time() - entry[0] < ttl:
+                return list(entry[1].values())
+        sensors = list(Sensor.objects.filter(property_id=property_id).order_by('id'))
+        with self.lock:
+            by_id = collections.OrderedDict()
+            for sensor in sensors:
+                # Los valores que aun no se han escrito tienen prioridad sobre los de la base de datos
+                sensor.value = self.pending.get(sensor.id, sensor.value)
+                by_id[sensor.id] = sensor
+                self.sensor_property[sensor.id] = property_id
+            self.properties[property_id] = (time.time(), by_id)
+        return sensors
+
+    def get(self, sensor_id):
+        """
+        Sensor desde el cache, carga los sensores de su inmueble si hace falta
+            @param sensor_id
+        """
+        sensor_id = int(sensor_id)
+        with self.lock:
+            property_id = self.sensor_property.get(sensor_id)
+            entry = self.properties.get(property_id)
+            if entry is not None and sensor_id in entry[1]:
+                return entry[1][sensor_id]
+        if property_id is None:
+            property_id = Sensor.objects.values_list('property_id', flat=True).get(pk=sensor_id)
+        for sensor in self.sensors(property_id):
+            if sensor.id == sensor_id:
+                return sensor
+        raise Sensor.DoesNotExist()
+
+    def update(self, sensor_id, value, sync=None):
+        """
+        Cambia el valor de un sensor. Con sync (por defecto para los sensores de alarma) se escribe de inmediato,
+        si no queda pendiente para el siguiente flush. Retorna el sensor.
+            @param sensor_id
+            @param value
+            @param sync
+        """
+        sensor = self.get(sensor_id)
+        if sync is None:
+            sync = self.get_flush_interval() <= 0 or is_sync_sensor(sensor)
+        with self.lock:
+            sensor.value = value
+            if not sync:
+                self.pending[sensor.id] = value
+            else:
+                self.pending.pop(sensor.id, None)
+        if sync:
+            sensor.save(update_fields=['value'])
+        else:
+            self.ensure_flusher()
+        return sensor
+
+    def flush(self):
+        """
+        Escribe los valores pendientes con un UPDATE por valor distinto. Retorna el numero de sensores escritos.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        by_value = collections.defaultdict(list)
+        for sensor_id, value in pending.items():
+            by_value[value].append(sensor_id)
+        try:
+            for value, sensor_ids in by_value.items():
+                Sensor.objects.filter(pk__in=sensor_ids).update(value=value)
+        except Exception:
+            # Se reintentan en el siguiente flush, salvo los sensores que cambiaron mientras tanto
+            with self.lock:
+                for sensor_id, value in pending.items():
+                    self.pending.setdefault(sensor_id, value)
+            raise
+        return len(pending)
+
+    def ensure_flusher(self):
+        if not self.start_thread or (self.thread is not None and self.thread.is_alive()):
+            return
+        with self.lock:
+            if self.thread is None:
+                atexit.register(self.flush)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run_flusher, name='sensor-state-flusher')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run_flusher(self):
+        while True:
+            time.sleep(max(self.get_flush_interval(), 0.1))
+            try:
+                self.flush()
+            except Exception:
+                log.exception("run_flusher: error escribiendo los sensores pendientes")
+            finally:
+                # El hilo no atiende peticiones, la conexion se cierra para no dejarla abierta entre flushes
+                connection.close()
+
+    def invalidate(self, property_id):
+        with self.lock:
+            entry = self.properties.pop(property_id, None)
+            if entry is not None:
+                for sensor_id in entry[1]:
+                    self.sensor_property.pop(sensor_id, None)
+
+    def pending_value(self, sensor_id, default=None):
+        with self.lock:
+            return self.pending.get(sensor_id, default)
+
+    def apply_values(self, property_id, values):
+        """
+        Registra valores escritos directamente en la base de datos (escenas): descarta los pendientes de esos
+        sensores y actualiza el cache
+            @param property_id
+            @param values diccionario {sensor_id: value}
+        """
+        with self.lock:
+            entry = self.properties.get(property_id)
+            for sensor_id, value in values.items():
+                self.pending.pop(sensor_id, None)
+                if entry is not None and sensor_id in entry[1]:
+                    entry[1][sensor_id].value = value
+
+    def apply(self, sensor):
+        """
+        Actualiza el valor en cache de un sensor guardado fuera del cache (save con update_fields=['value'])
+            @param sensor
+        """
+        with self.lock:
+            entry = self.properties.get(sensor.property_id)
+            if entry is not None and sensor.id in entry[1] and sensor.id not in self.pending:
+                entry[1][sensor.id].value = sensor.value
+
+state = SensorStateCache()
+
+SENSOR_STATE = 'sensor_state'
+invalidation.register(SENSOR_STATE, lambda property_ids: [state.invalidate(property_id) for property_id in property_ids])
+
+@receiver(post_save, sender=Sensor)
+def invalidate_on_save(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) == set(['value']):
+        state.apply(instance)
+        return
+    state.invalidate(state.sensor_property.get(instance.id))
+    state.invalidate(instance.property_id)
+
+@receiver(post_delete, sender=Sensor)
+def invalidate_on_delete(sender, instance, **kwargs):
+    state.invalidate(instance.property_id)
@@ -1,10 +1,27 @@
 from rest_framework import serializers
 from watchapp.models import Event, Property, Sensor
 
+class PrefetchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    '''
+    Campo de llave primaria que resuelve el objeto relacionado desde un diccionario {pk: objeto}
+    precargado en el contexto del serializer (context['prefetched'][<nombre del campo>]).
+    Si el contexto no trae el diccionario se comporta como PrimaryKeyRelatedField.
+    '''
+    def to_internal_value(self, data):
+        prefetched = self.context.get('prefetched', {}).get(self.field_name)
+        if prefetched is None:
+            return super(PrefetchedPrimaryKeyRelatedField, self).to_internal_value(data)
+        try:
+            return prefetched[int(data)]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
 class EventSerializer(serializers.HyperlinkedModelSerializer):
     '''Esta clase carga la lista de sensores y propiedades y demas atributos para GET / POST de un evento'''
-    sensor = serializers.PrimaryKeyRelatedField(queryset=Sensor.objects.all())
-    property = serializers.PrimaryKeyRelatedField(queryset=Property.objects.all())
+    sensor = PrefetchedPrimaryKeyRelatedField(queryset=Sensor.objects.all())
+    property = PrefetchedPrimaryKeyRelatedField(queryset=Property.objects.all())
 
     class Meta:
         model = Event
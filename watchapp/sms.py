@@ -0,0 +1,31 @@
+"""
+Backends para el envio de mensajes de texto (SMS).
+El backend se configura con settings.SMS_BACKEND, igual que EMAIL_BACKEND para los correos.
+"""
+from django.conf import settings
+from django.utils.module_loading import import_string
+from watchapp import sms_gateway
+
+# Mensajes enviados con el LocmemBackend, equivalente a django.core.mail.outbox
+outbox = []
+
+def get_backend():
+    """
+    Retorna una instancia del backend configurado en settings.SMS_BACKEND
+    """
+    return import_string(getattr(settings, 'SMS_BACKEND', 'watchapp.sms.BlowerBackend'))()
+
+class BlowerBackend(object):
+    """
+    Envia los mensajes por medio del servicio Blower.io (variable de entorno BLOWERIO_URL) con el cliente del proceso
+    (sms_gateway.get_client)
+    """
+    def send(self, to, message):
+        sms_gateway.get_client().send(to, message)
+
+class LocmemBackend(object):
+    """
+    Guarda los mensajes en watchapp.sms.outbox, se usa en las pruebas y en desarrollo
+    """
+    def send(self, to, message):
+        outbox.append({'to': to, 'message': message})
@@ -0,0 +1,169 @@
+"""
+Cliente HTTP del gateway de SMS (Blower.io, variable de entorno BLOWERIO_URL) que usa sms.BlowerBackend.
+Todos los envios del proceso comparten una requests.Session, asi las conexiones TCP/TLS se reutilizan, con tiempos
+maximos de conexion y de lectura. Los errores de conexion y las respuestas 429/502/503/504 se reintentan hasta
+SMS_RETRIES veces con espera exponencial aleatoria (jitter); un timeout de lectura no se reintenta porque el mensaje
+pudo haberse enviado. Despues de SMS_CIRCUIT_THRESHOLD fallos seguidos el circuito se abre y los envios fallan de
+inmediato durante SMS_CIRCUIT_RESET segundos, la cola de notificaciones los reintenta despues.
+"""
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+import logging
+import os
+import random
+import requests
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+class CircuitOpenError(Exception):
+    """
+    El circuito del gateway esta abierto, el mensaje no se envio
+    """
+    pass
+
+class RetryableStatus(Exception):
+    def __init__(self, response):
+        Exception.__init__(self, 'El gateway respondio %s' % response.status_code)
+        self.response = response
+
+class CircuitBreaker(object):
+    """
+    Circuito con tres estados: cerrado (deja pasar), abierto (rechaza hasta que pasan reset_timeout segundos) y
+    semiabierto (deja pasar una prueba: si funciona se cierra, si falla se vuelve a abrir). Seguro para hilos.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    log.warning("record_failure: circuito del gateway de SMS abierto despues de %d fallos", self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+class GatewayClient(object):
+    """
+    Cliente del gateway de SMS
+        @param base_url URL del gateway, None para leer BLOWERIO_URL en cada envio
+        @param pool_size conexiones que se mantienen abiertas por host (hilos del notification_worker)
+        @param connect_timeout
+        @param read_timeout
+        @param retries reintentos despues del primer intento
+        @param backoff espera base en segundos, el reintento n espera un valor aleatorio entre 0 y backoff * 2^n
+        @param max_backoff
+        @param breaker CircuitBreaker
+    """
+    def __init__(self, base_url=None, pool_size=10, connect_timeout=3.05, read_timeout=10, retries=2, backoff=0.5,
+                 max_backoff=5, breaker=None):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def send(self, to, message):
+        """
+        Envia un mensaje, retorna la respuesta del gateway o lanza una excepcion si el envio falla
+            @param to numero de celular
+            @param message
+        """
+        # La URL se resuelve antes de tomar el permiso del circuito, un error de configuracion no lo deja semiabierto
+        url = (self.base_url or os.environ['BLOWERIO_URL']) + '/messages'
+        if not self.breaker.allow():
+            raise CircuitOpenError('Circuito del gateway de SMS abierto')
+        try:
+            response = self.post(url, {'to': to, 'message': message})
+        except requests.HTTPError as inst:
+            # El gateway responde: un error del mensaje (4xx) no es una falla del gateway
+            status = inst.response.status_code if inst.response is not None else 500
+            if status >= 500 or status in RETRY_STATUSES:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        except BaseException:
+            # Cualquier otro error (timeout, conexion, URL no valida, redirecciones...) cuenta como falla, asi el
+            # circuito nunca queda semiabierto sin resultado
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return response
+
+    def post(self, url, data):
+        """
+        POST al gateway con los reintentos de los errores de conexion y de las respuestas RETRY_STATUSES
+            @param url
+            @param data
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(url, data=data, timeout=self.timeout)
+                if response.status_code in RETRY_STATUSES:
+                    raise RetryableStatus(response)
+                response.raise_for_status()
+                return response
+            except (requests.ConnectionError, RetryableStatus) as inst:
+                if attempt >= self.retries:
+                    if isinstance(inst, RetryableStatus):
+                        inst.response.raise_for_status()
+                    raise
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                log.info("post: reintento %d del SMS en %.2fs: %s", attempt + 1, delay, inst)
+                time.sleep(delay)
+                attempt += 1
+
+client = None
+client_lock = threading.Lock()
+
+def get_client():
+    """
+    Retorna el cliente del proceso, configurado con las variables SMS_* de settings
+    """
+    global client
+    if client is None:
+        with client_lock:
+            if client is None:
+                client = GatewayClient(
+                    base_url=getattr(settings, 'SMS_GATEWAY_URL', None),
+                    pool_size=getattr(settings, 'SMS_POOL_SIZE', 10),
+                    connect_timeout=getattr(settings, 'SMS_CONNECT_TIMEOUT', 3.05),
+                    read_timeout=getattr(settings, 'SMS_TIMEOUT', 10),
+                    retries=getattr(settings, 'SMS_RETRIES', 2),
+                    backoff=getattr(settings, 'SMS_RETRY_BACKOFF', 0.5),
+                    breaker=CircuitBreaker(getattr(settings, 'SMS_CIRCUIT_THRESHOLD', 5), getattr(settings, 'SMS_CIRCUIT_RESET', 30)))
+    return client
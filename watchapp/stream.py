@@ -0,0 +1,129 @@
+"""
+Publicacion en tiempo real de los cambios de los inmuebles (valores de sensores y eventos nuevos) a los navegadores
+suscritos por Server-Sent Events. El broker es local al proceso: update_sensor y EventViewSet publican en el
+proceso que atiende la peticion y cada conexion abierta en ese proceso recibe el mensaje de su inmueble.
+
+Las conexiones SSE pasan casi todo el tiempo esperando en una cola, por eso el servidor web debe correr con
+workers asincronos (gevent con psycogreen, ver smarthome/gunicorn_conf.py): cada conexion es un greenlet y no ocupa
+un worker sincrono.
+Con varios procesos web cada uno tiene su propio broker, un navegador solo recibe lo publicado en su proceso.
+"""
+from django.conf import settings
+import json
+import Queue
+import threading
+import time
+
+class Subscription(object):
+    """
+    Cola de mensajes de un navegador suscrito a un inmueble
+    """
+    def __init__(self, property_id, maxsize):
+        self.property_id = property_id
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+
+class Broker(object):
+    """
+    Distribuye los mensajes de cada inmueble a sus suscriptores. Si la cola de un suscriptor esta llena
+    (navegador lento) el mensaje se descarta para ese suscriptor y no bloquea al que publica.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def subscribe(self, property_id, maxsize=None):
+        subscription = Subscription(property_id, maxsize or getattr(settings, 'SSE_QUEUE_SIZE', 100))
+        with self.lock:
+            self.subscriptions.setdefault(property_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.property_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.property_id]
+
+    def publish(self, property_id, event, data):
+        """
+        Envia el mensaje a los suscriptores del inmueble. Retorna el numero de suscriptores que lo recibieron.
+            @param property_id
+            @param event nombre del evento SSE ('sensor' o 'event')
+            @param data diccionario serializable a json
+        """
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(property_id, ()))
+        message = sse_message(event, data)
+        delivered = 0
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(message)
+                delivered += 1
+            except Queue.Full:
+                subscription.dropped += 1
+        return delivered
+
+    def count(self, property_id=None):
+        with self.lock:
+            if property_id is not None:
+                return len(self.subscriptions.get(property_id, ()))
+            return sum(len(s) for s in self.subscriptions.values())
+
+broker = Broker()
+
+def sse_message(event, data):
+    """
+    Mensaje en el formato de Server-Sent Events
+        @param event
+        @param data
+    """
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+def stream(subscription, heartbeat=None, max_duration=None):
+    """
+    Generador del cuerpo de la respuesta SSE. Envia un comentario cada heartbeat segundos para que los proxies
+    no cierren la conexion, y termina despues de max_duration segundos (el navegador se reconecta solo).
+    Al cerrarse la respuesta se cancela la suscripcion.
+        @param subscription
+        @param heartbeat
+        @param max_duration
+    """
+    heartbeat = heartbeat or getattr(settings, 'SSE_HEARTBEAT', 15)
+    max_duration = max_duration or getattr(settings, 'SSE_MAX_DURATION', 300)
+    deadline = time.time() + max_duration
+    try:
+        yield 'retry: 3000\n\n'
+        while time.time() < deadline:
+            try:
+                yield subscription.queue.get(timeout=min(heartbeat, max(deadline - time.time(), 0.01)))
+            except Queue.Empty:
+                yield ': keepalive\n\n'
+    finally:
+        broker.unsubscribe(subscription)
+
+def sensor_data(sensor):
+    return {"sensor_id": sensor.id, "code": sensor.code, "location_in_plan": sensor.location_in_plan,
+            "value": sensor.value, "valueDisplay": sensor.get_value_display()}
+
+def event_data(event):
+    return {"id": event.id, "date": event.date.isoformat() if event.date else None, "description": event.description,
+            "type": event.type, "type_display": event.get_type_display(), "is_critical": event.is_critical,
+            "is_fatal": event.is_fatal, "sensor_id": event.sensor_id}
+
+def publish_sensor(sensor):
+    """
+    Publica el valor de un sensor, se llama despues de guardar el cambio
+        @param sensor
+    """
+    if sensor.property_id is not None:
+        broker.publish(sensor.property_id, 'sensor', sensor_data(sensor))
+
+def publish_events(events):
+    """
+    Publica eventos nuevos, se llama despues de confirmar la transaccion que los inserta
+        @param events lista de Event
+    """
+    for event in events:
+        broker.publish(event.property_id, 'event', event_data(event))
@@ -1,6 +1,20 @@
 from django.test import TestCase
-from watchapp.models import Property
-import csv, os
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.test.utils import override_settings
+from django.core import mail
+from django.contrib.auth.models import User, Group
+from watchapp.models import ConstructorCompany, Property, UserProfile, Sensor, Event, NotificationOutbox, ReportJob, EventRollupHour, EventRollupDay, ImportJob, EventArchive, AlertWindow, CacheInvalidation
+from watchapp import notifications, sms, recipients, reports, report_jobs, rollups, access, stream, sensor_state, importer, import_jobs, archive, metrics, logpipe, alerts, mailer, sms_gateway, invalidation, scenes
+from watchapp.benchmarks import CountingEmailBackend, check_benchmark_database, stub_sms_gateway
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+from StringIO import StringIO
+from PyPDF2 import PdfFileReader
+import Queue, csv, datetime, gc, logging, os, json, requests, shutil, tempfile, threading, time, uuid
 """
 class CSVLoadingTests(TestCase):
 
@@ -110,3 +124,1199 @@ class PropertyFileTestCase(TestCase):
 
 
 
+class EventBatchTestCase(TestCase):
+    '''
+    Pruebas del POST de lotes de eventos en /api/events/
+    '''
+    def setUp(self):
+        self.property = Property.objects.create(name='Apto 101', address='Calle 1')
+        self.sensor = Sensor.objects.create(code='S-1', description='Puerta', type='0', property=self.property, value='1')
+
+    def event_data(self, **kwargs):
+        data = {'description': 'Lectura', 'value': '1.00', 'type': '3', 'is_critical': False, 'is_fatal': False, 'property': self.property.id, 'sensor': self.sensor.id}
+        data.update(kwargs)
+        return data
+
+    def test_batch_partial_failure(self):
+        batch = [self.event_data(), self.event_data(sensor=9999), self.event_data(value='1.50')]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/events/', json.dumps(batch), content_type='application/json')
+        # Una consulta para sensores, una para propiedades, un INSERT y un UPDATE + INSERT por cada
+        # acumulado nuevo (hora y dia) (sin contar savepoints)
+        self.assertEqual(len([q for q in queries if 'SAVEPOINT' not in q['sql']]), 7)
+        self.assertEqual(response.status_code, 207)
+        body = json.loads(response.content)
+        self.assertEqual(body['created'], 2)
+        self.assertEqual([r['status'] for r in body['results']], ['created', 'invalid', 'created'])
+        self.assertIn('sensor', body['results'][1]['errors'])
+        self.assertEqual(Event.objects.count(), 2)
+
+    def test_single_event_still_supported(self):
+        response = self.client.post('/api/events/', json.dumps(self.event_data()), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Event.objects.count(), 1)
+
+    def test_notification_errors_do_not_lose_events(self):
+        # Inmueble sin constructora ni direccion, como los que crea el importador
+        Property.objects.filter(pk=self.property.pk).update(address=None)
+        batch = [self.event_data(), self.event_data(is_critical=True), self.event_data(is_fatal=True)]
+        response = self.client.post('/api/events/', json.dumps(batch), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Event.objects.count(), 3)
+        response = self.client.post('/api/events/', json.dumps(self.event_data(is_fatal=True)), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Event.objects.count(), 4)
+
+def create_property_with_owner(name='Apto 101'):
+    '''
+    Crea un inmueble con constructora, propietario y un sensor para las pruebas
+    '''
+    constructora = ConstructorCompany.objects.create(nit='900', company_name='Constructora', address='Calle 2', email=name.replace(' ', '') + '@constructora.co', contact_name='Contacto')
+    prop = Property.objects.create(name=name, address='Calle 1', constructor_company=constructora)
+    user = User.objects.create_user(name.replace(' ', '').lower(), 'owner@mail.co', 'secret', first_name='Ana', last_name='Perez')
+    profile = UserProfile.objects.create(user=user, mobile_number='3001234567')
+    profile.properties_as_owner.add(prop)
+    sensor = Sensor.objects.create(code='S-1', description='Puerta', type='0', property=prop, value='1')
+    return prop, sensor
+
+class FailingSMSBackend(object):
+    def send(self, to, message):
+        raise IOError('gateway caido')
+
+@override_settings(SMS_BACKEND='watchapp.sms.LocmemBackend')
+class NotificationOutboxTestCase(TestCase):
+    '''
+    Pruebas de la cola de notificaciones y del envio con notifications.drain
+    '''
+    def setUp(self):
+        self.property, self.sensor = create_property_with_owner()
+        sms.outbox[:] = []
+
+    def create_event(self, **kwargs):
+        kwargs.setdefault('sensor', self.sensor)
+        return Event.objects.create(description='Humo', value='1', type='0', property=self.property, **kwargs)
+
+    def test_event_only_queues_notifications(self):
+        self.create_event(is_fatal=True)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(NotificationOutbox.objects.filter(status=NotificationOutbox.PENDING).count(), 3)
+        self.assertEqual(notifications.drain(10), 3)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(sms.outbox[0]['to'], '3001234567')
+        self.assertEqual(NotificationOutbox.objects.filter(status=NotificationOutbox.SENT).count(), 3)
+
+    @override_settings(EMAIL_BACKEND='watchapp.benchmarks.CountingEmailBackend')
+    def test_batch_emails_share_one_connection(self):
+        CountingEmailBackend.connections = 0
+        self.create_event(is_fatal=True)
+        self.create_event(is_critical=True)
+        self.assertEqual(notifications.drain(10), 5)
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(CountingEmailBackend.connections, 1)
+        self.assertIs(mailer.compiled_template('watchapp/email.html'), mailer.compiled_template('watchapp/email.html'))
+
+    def test_property_without_constructora_or_address(self):
+        Property.objects.filter(pk=self.property.pk).update(constructor_company=None, address=None)
+        self.create_event(is_fatal=True)
+        self.create_event(is_critical=True, sensor=Sensor.objects.create(code='S-2', description='Gas', type='0', property=self.property, value='1'))
+        queued = NotificationOutbox.objects.order_by('id')
+        self.assertEqual([(n.channel, n.recipients) for n in queued], [(NotificationOutbox.EMAIL, 'owner@mail.co'), (NotificationOutbox.SMS, '3001234567')])
+        self.assertEqual(queued[0].subject, 'Alerta en el inmueble Apto 101')
+        self.assertNotIn('None', queued[0].body)
+
+    def test_non_critical_event_queues_nothing(self):
+        self.create_event()
+        self.assertEqual(NotificationOutbox.objects.count(), 0)
+
+    @override_settings(SMS_BACKEND='watchapp.tests.FailingSMSBackend', NOTIFICATION_MAX_ATTEMPTS=2)
+    def test_failed_delivery_is_retried_then_failed(self):
+        notification = NotificationOutbox.queue_sms('3001234567', 'Alerta')
+        notifications.process(notification)
+        notification = NotificationOutbox.objects.get(pk=notification.pk)
+        self.assertEqual(notification.status, NotificationOutbox.PENDING)
+        self.assertTrue(notification.next_attempt > notification.created)
+        self.assertEqual(notifications.drain(10), 0)
+        notifications.process(notification)
+        self.assertEqual(NotificationOutbox.objects.get(pk=notification.pk).status, NotificationOutbox.FAILED)
+
+@override_settings(NOTIFICATION_ALERT_WINDOW=300)
+class AlertCoalescingTestCase(TestCase):
+    '''
+    Pruebas de la agrupacion de alertas por inmueble, sensor y severidad de watchapp.alerts
+    '''
+    def setUp(self):
+        alerts.windows.clear()
+        self.property, self.sensor = create_property_with_owner()
+
+    def create_event(self, sensor=None, **kwargs):
+        return Event.objects.create(description='Humo', value='1', type='0', property=self.property, sensor=sensor or self.sensor, **kwargs)
+
+    def test_flapping_sensor_sends_one_alert_and_digest(self):
+        for i in range(50):
+            self.create_event(is_critical=True)
+        self.assertEqual(NotificationOutbox.objects.count(), 2)
+        self.assertEqual(AlertWindow.objects.get().suppressed, 49)
+        # Otro sensor tiene su propia ventana
+        other = Sensor.objects.create(code='S-2', description='Ventana', type='0', property=self.property, value='1')
+        self.create_event(sensor=other, is_critical=True)
+        self.assertEqual(NotificationOutbox.objects.count(), 4)
+        self.assertEqual(alerts.flush_digests(), 0)
+        self.assertEqual(alerts.flush_digests(timezone.now() + datetime.timedelta(seconds=301)), 1)
+        digest = NotificationOutbox.objects.latest('id')
+        self.assertEqual(digest.recipient_list(), ['Apto101@constructora.co'])
+        self.assertIn('49 alertas adicionales', digest.body)
+        self.assertFalse(AlertWindow.objects.exists())
+
+    def test_failed_digest_does_not_block_the_others(self):
+        other = Sensor.objects.create(code='S-2', description='Ventana', type='0', property=self.property, value='1')
+        for sensor in (self.sensor, other):
+            for i in range(2):
+                self.create_event(sensor=sensor, is_critical=True)
+        queue_digest = alerts.queue_digest
+        def fail_first_sensor(window, contacts):
+            if window.sensor_id == self.sensor.id:
+                raise TypeError('plantilla no valida')
+            return queue_digest(window, contacts)
+        alerts.queue_digest = fail_first_sensor
+        try:
+            self.assertEqual(alerts.flush_digests(timezone.now() + datetime.timedelta(seconds=301)), 1)
+        finally:
+            alerts.queue_digest = queue_digest
+        self.assertFalse(AlertWindow.objects.exists())
+        self.assertEqual(NotificationOutbox.objects.filter(subject__startswith='Resumen').count(), 1)
+
+    def test_window_is_shared_between_processes(self):
+        self.create_event(is_fatal=True)
+        self.assertEqual(NotificationOutbox.objects.count(), 3)
+        # Otro worker no tiene la ventana en memoria y la encuentra en la base de datos
+        # (mas el savepoint de las notificaciones)
+        alerts.windows.clear()
+        with self.assertNumQueries(7):
+            self.create_event(is_fatal=True)
+        self.assertEqual(NotificationOutbox.objects.count(), 3)
+        with self.assertNumQueries(4):
+            self.create_event(is_fatal=True)
+        self.assertEqual(AlertWindow.objects.get().suppressed, 2)
+        # Al vencer la ventana el siguiente evento encola el resumen y vuelve a notificar
+        AlertWindow.objects.update(expires=timezone.now() - datetime.timedelta(seconds=1))
+        self.create_event(is_fatal=True)
+        self.assertEqual(NotificationOutbox.objects.count(), 7)
+        digest = NotificationOutbox.objects.get(subject__startswith='Resumen')
+        self.assertEqual(digest.recipient_list(), ['owner@mail.co', 'Apto101@constructora.co'])
+        self.assertEqual(AlertWindow.objects.get().suppressed, 0)
+
+class SMSGatewayTestCase(TestCase):
+    '''
+    Pruebas del cliente del gateway de SMS con el gateway local de watchapp.benchmarks
+    '''
+    def gateway_client(self, gateway, **kwargs):
+        options = {'retries': 2, 'backoff': 0.001, 'read_timeout': 0.2}
+        options.update(kwargs)
+        return sms_gateway.GatewayClient('http://127.0.0.1:%d' % gateway.server_address[1], **options)
+
+    def test_retries_reuse_the_connection(self):
+        with stub_sms_gateway(statuses=[503, 502]) as gateway:
+            client = self.gateway_client(gateway)
+            for i in range(4):
+                client.send('3001234567', 'Alerta %d' % i)
+            self.assertEqual(gateway.received, 6)
+            self.assertEqual(len(gateway.ports), 1)
+        # Los errores del mensaje no se reintentan
+        with stub_sms_gateway(statuses=[400]) as gateway:
+            self.assertRaises(requests.HTTPError, self.gateway_client(gateway).send, '3001234567', 'Alerta')
+            self.assertEqual(gateway.received, 1)
+
+    def test_read_timeout_is_not_retried(self):
+        with stub_sms_gateway(delay=0.5) as gateway:
+            began = time.time()
+            self.assertRaises(requests.Timeout, self.gateway_client(gateway, read_timeout=0.1).send, '3001234567', 'Alerta')
+            self.assertTrue(time.time() - began < 0.4)
+            self.assertEqual(gateway.received, 1)
+
+    def test_circuit_breaker(self):
+        breaker = sms_gateway.CircuitBreaker(threshold=2, reset_timeout=0.1)
+        with stub_sms_gateway(statuses=[503, 503, 503]) as gateway:
+            client = self.gateway_client(gateway, retries=0, breaker=breaker)
+            for i in range(2):
+                self.assertRaises(requests.HTTPError, client.send, '3001234567', 'Alerta')
+            self.assertRaises(sms_gateway.CircuitOpenError, client.send, '3001234567', 'Alerta')
+            self.assertEqual(gateway.received, 2)
+            # Pasado reset_timeout se permite una prueba, si falla el circuito se vuelve a abrir
+            time.sleep(0.15)
+            self.assertRaises(requests.HTTPError, client.send, '3001234567', 'Alerta')
+            self.assertRaises(sms_gateway.CircuitOpenError, client.send, '3001234567', 'Alerta')
+            time.sleep(0.15)
+            client.send('3001234567', 'Alerta')
+            self.assertEqual((breaker.state, gateway.received), (breaker.CLOSED, 4))
+
+    def test_unexpected_errors_do_not_leave_the_circuit_half_open(self):
+        breaker = sms_gateway.CircuitBreaker(threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        client = sms_gateway.GatewayClient(retries=0, breaker=breaker)
+        url = os.environ.pop('BLOWERIO_URL', None)
+        try:
+            self.assertRaises(KeyError, client.send, '3001234567', 'Alerta')
+        finally:
+            if url is not None:
+                os.environ['BLOWERIO_URL'] = url
+        self.assertEqual(breaker.state, breaker.OPEN)
+        client = sms_gateway.GatewayClient('http://', retries=0, breaker=breaker)
+        self.assertRaises(requests.RequestException, client.send, '3001234567', 'Alerta')
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertTrue(breaker.allow())
+
+class RecipientResolverTestCase(TestCase):
+    '''
+    Pruebas del cache de destinatarios usado por EventNotifier
+    '''
+    def setUp(self):
+        recipients.contacts_cache.clear()
+        self.property, self.sensor = create_property_with_owner()
+
+    def create_fatal_event(self):
+        return Event.objects.create(description='Humo', value='1', type='0', is_fatal=True, property=self.property, sensor=self.sensor)
+
+    @override_settings(NOTIFICATION_ALERT_WINDOW=0)
+    def test_notifier_runs_constant_queries(self):
+        # INSERT del evento, savepoint, tres consultas del resolver y tres INSERT en la cola
+        with self.assertNumQueries(9):
+            self.create_fatal_event()
+        # Con el cache caliente solo quedan los INSERT y el savepoint
+        for i in range(3):
+            with self.assertNumQueries(6):
+                self.create_fatal_event()
+
+    def test_cache_is_invalidated_on_changes(self):
+        self.create_fatal_event()
+        owner = User.objects.get(username='apto101')
+        owner.email = 'nuevo@mail.co'
+        owner.save()
+        self.assertEqual(recipients.get_property_contacts(self.property.id).mail_to_notify, 'nuevo@mail.co')
+        self.property.is_secure_mode = False
+        self.property.save()
+        self.assertFalse(recipients.get_property_contacts(self.property.id).is_secure_mode)
+        constructora = self.property.constructor_company
+        constructora.email = 'otra@constructora.co'
+        constructora.save()
+        self.assertEqual(recipients.get_property_contacts(self.property.id).mail_constructora, 'otra@constructora.co')
+
+def create_constructora_user(username='constructora'):
+    '''
+    Crea un usuario del grupo constructoras con su constructora, el cliente de pruebas debe hacer login con clave secret
+    '''
+    user = User.objects.create_user(username, username + '@mail.co', 'secret')
+    user.groups.add(Group.objects.get_or_create(name='constructoras')[0])
+    profile = UserProfile.objects.create(user=user, mobile_number='3000000000')
+    # Las vistas de constructora buscan la constructora con el id del UserProfile
+    constructora = ConstructorCompany.objects.create(user_id=profile.id, nit='800', company_name='Constructora', address='Calle 3', email=username + '@constructora.co', contact_name='Contacto')
+    return user, constructora
+
+class BenchmarkDatabaseTestCase(TestCase):
+    '''
+    Los comandos de benchmark que escriben en la base de datos no corren sobre la de produccion
+    '''
+    def test_production_database_is_refused(self):
+        name = connection.settings_dict['NAME']
+        try:
+            connection.settings_dict['NAME'] = 'watchapp'
+            self.assertRaises(CommandError, call_command, 'benchmark_event_indexes', events=10, stdout=StringIO())
+            self.assertRaises(CommandError, call_command, 'benchmark_ingest', levels='1', events=2, stdout=StringIO())
+            self.assertRaises(CommandError, call_command, 'benchmark_notifications', messages=2, stdout=StringIO())
+            self.assertRaises(CommandError, call_command, 'seed_synthetic', constructoras=1, properties=1, events=1, stdout=StringIO())
+            self.assertRaises(CommandError, call_command, 'benchmark_reports', password='clave', stdout=StringIO())
+            connection.settings_dict['NAME'] = 'watchapp_bench'
+            check_benchmark_database()
+        finally:
+            connection.settings_dict['NAME'] = name
+        self.assertFalse(ConstructorCompany.objects.exists())
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+class IngestBenchmarkTestCase(TestCase):
+    '''
+    Prueba de humo del comando benchmark_ingest con pocos eventos
+    '''
+    @override_settings(NOTIFICATION_ALERT_WINDOW=0)
+    def test_json_output(self):
+        out = StringIO()
+        call_command('benchmark_ingest', levels='1', events=4, batch_size=2, properties=2, critical_ratio=1, fatal_ratio=1, json_path='-', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['benchmark'], 'ingest')
+        result = report['results'][0]
+        self.assertEqual((result['concurrency'], result['requests'], result['events'], result['errors']), (1, 2, 4, 0))
+        self.assertTrue(result['p99_ms'] >= result['p50_ms'] > 0)
+        self.assertTrue(result['queries_per_event'] > 0)
+        # Cada evento critico y fatal encola 4 correos y un SMS, el SMS llega al gateway local
+        self.assertEqual((result['notifications'], result['emails'], result['sms']), (20, 16, 4))
+        # Los datos sembrados se borran
+        self.assertFalse(Property.objects.filter(name__startswith='bench-ingest').exists())
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+class NotificationBenchmarkTestCase(TestCase):
+    '''
+    Prueba de humo del comando benchmark_notifications
+    '''
+    def test_json_output(self):
+        out = StringIO()
+        call_command('benchmark_notifications', messages=20, batch_size=10, json_path='-', stdout=out)
+        results = dict((r['name'], r) for r in json.loads(out.getvalue())['results'])
+        self.assertEqual(results['mailer.render']['messages'], 40)
+        self.assertEqual((results['per_message']['messages'], results['per_message']['connections']), (20, 20))
+        self.assertEqual((results['batched']['messages'], results['batched']['connections']), (20, 2))
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+class ReportBenchmarkTestCase(TestCase):
+    '''
+    Prueba de humo de los comandos seed_synthetic y benchmark_reports con pocos datos
+    '''
+    def test_seed_and_benchmark(self):
+        call_command('seed_synthetic', constructoras=2, properties=3, residents=1, sensors=2, events=60, days=30, skew=1.0, password='clave', stdout=StringIO())
+        self.assertEqual(Property.objects.filter(name__startswith='synthetic-').count(), 6)
+        self.assertEqual(Sensor.objects.filter(property__name__startswith='synthetic-', code__contains='-').count(), 12)
+        self.assertEqual(Event.objects.count(), 60)
+        owner = UserProfile.objects.get(user__username='synthetic-c0-p0-u0')
+        self.assertEqual(owner.properties_as_owner.get().name, 'synthetic-c0-p0')
+        self.assertTrue(access.has_group(User.objects.get(username='synthetic-c1'), access.CONSTRUCTORAS))
+        out = StringIO()
+        call_command('benchmark_reports', widths='1,30', views='get_event_admin_all_property,get_event_owner_property',
+                     in_process=True, json_path='-', password='clave', stdout=out)
+        results = json.loads(out.getvalue())['results']
+        self.assertEqual([(r['view'], r['width_days'], r['status']) for r in results], [
+            ('get_event_owner_property', 1, 200), ('get_event_owner_property', 30, 200),
+            ('get_event_admin_all_property', 1, 200), ('get_event_admin_all_property', 30, 200)])
+        self.assertEqual(results[0]['user'], 'synthetic-c0-p0-u0')
+        self.assertTrue(all(r['queries'] > 0 and r['rss_mb'] > 0 for r in results))
+        # Con --clear se reemplazan los datos generados, sin --password la clave es aleatoria
+        out = StringIO()
+        call_command('seed_synthetic', constructoras=1, properties=1, sensors=1, events=5, clear=True, stdout=out)
+        self.assertEqual(Event.objects.count(), 5)
+        password = out.getvalue().split('Clave de los usuarios: ')[1].split()[0]
+        self.assertTrue(User.objects.get(username='synthetic-c0').check_password(password))
+        self.assertFalse(User.objects.get(username='synthetic-c0').check_password('synthetic'))
+
+class ReportDataMixin(object):
+    '''
+    Constructora con tres inmuebles, cada uno con propietario y sensor, y el cliente autenticado como la constructora
+    '''
+    def setUp(self):
+        self.user, self.constructora = create_constructora_user()
+        self.sensors = []
+        for i in range(3):
+            prop, sensor = create_property_with_owner('Apto %d' % i)
+            prop.constructor_company = self.constructora
+            prop.save()
+            self.sensors.append(sensor)
+        self.client.login(username='constructora', password='secret')
+        # Grupos del usuario en cache, las vistas no los vuelven a consultar
+        cache.clear()
+        access.user_groups(self.user)
+
+    def create_events(self, count):
+        for i in range(count):
+            sensor = self.sensors[i % len(self.sensors)]
+            Event.objects.create(description='Lectura', value='1', type='3', property_id=sensor.property_id, sensor=sensor)
+
+    def report_queries(self):
+        body = json.dumps({'event_type': '-1', 'dateInit': '2000-01-01 00:00', 'dateFinal': '2100-01-01 00:00'})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/watchapp/get_event_admin_all_property/', body, content_type='application/json')
+        return response, len(queries)
+
+class EventReportTestCase(ReportDataMixin, TestCase):
+    '''
+    Pruebas de las filas de los reportes de eventos
+    '''
+    def test_rows_include_owner(self):
+        self.create_events(3)
+        response, count = self.report_queries()
+        rows = json.loads(response.content)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(set(r['propietario'] for r in rows), set(['Ana Perez']))
+        self.assertEqual(rows[0]['is_critical'], 'No')
+
+    def test_report_queries_do_not_grow_with_rows(self):
+        self.create_events(3)
+        response, few = self.report_queries()
+        self.create_events(30)
+        response, many = self.report_queries()
+        self.assertEqual(len(json.loads(response.content)), 33)
+        self.assertEqual(few, many)
+
+    def test_streaming_export(self):
+        self.create_events(5)
+        params = {'event_type': '-1', 'dateInit': '2000-01-01 00:00', 'dateFinal': '2100-01-01 00:00'}
+        response = self.client.get('/watchapp/export_event_admin_all_property/', params)
+        exported = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(sorted(exported), sorted(json.loads(self.report_queries()[0].content)))
+        params['format'] = 'csv'
+        response = self.client.get('/watchapp/export_event_admin_all_property/', params)
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(lines[0], 'Fecha,Descripcion,Tipo,Critico,Fatal,Propiedad,Sensor,Propietario')
+        self.assertEqual(len(lines), 6)
+
+    def test_row_chunks(self):
+        self.create_events(7)
+        events, label = reports.constructor_events(self.user, {'event_type': '-1', 'dateInit': '2000-01-01 00:00', 'dateFinal': '2100-01-01 00:00'})
+        self.assertEqual(list(reports.iter_event_rows(events, with_owner=True, chunk_size=2)), reports.event_rows(events.order_by('pk'), with_owner=True))
+
+class ReportJobTestCase(ReportDataMixin, TestCase):
+    '''
+    Pruebas de los trabajos de reportes PDF y del cache por contenido
+    '''
+    def setUp(self):
+        super(ReportJobTestCase, self).setUp()
+        self.report_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(REPORT_ROOT=self.report_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.report_root)
+
+    def submit(self):
+        body = json.dumps({'kind': '1', 'event_type': '-1', 'dateInit': '2000-01-01 00:00', 'dateFinal': '2100-01-01 00:00'})
+        return json.loads(self.client.post('/watchapp/report_jobs/', body, content_type='application/json').content)
+
+    def test_job_lifecycle_and_cache(self):
+        self.create_events(3)
+        job = self.submit()
+        self.assertFalse(job['done'])
+        self.assertEqual(self.submit()['job_id'], job['job_id'])
+        self.assertEqual(report_jobs.run_batch(5), 1)
+        job = json.loads(self.client.get('/watchapp/report_jobs/%d/' % job['job_id']).content)
+        self.assertTrue(job['done'])
+        response = self.client.get(job['download_url'])
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(response.content.startswith(b'%PDF'))
+        # Mismos parametros y sin eventos nuevos: se sirve del cache
+        self.assertTrue(self.submit()['done'])
+        self.create_events(1)
+        self.assertFalse(self.submit()['done'])
+
+    def test_report_view_uses_jobs_and_cache(self):
+        self.create_events(2)
+        body = json.dumps({'event_type': '-1', 'dateInit': '2000-01-01 00:00', 'dateFinal': '2100-01-01 00:00'})
+        # El worker web no genera el PDF, crea el trabajo para report_worker
+        response = self.client.post('/watchapp/get_report_admin_all_property/', body, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        job = json.loads(response.content)
+        self.assertFalse(job['done'])
+        self.assertEqual(os.listdir(self.report_root), [])
+        # Con ids solo se toman esos trabajos (benchmark_reports no procesa los de otros usuarios)
+        other = ReportJob.objects.create(user=self.user, kind='1', params='{}', cache_key='otro', status=ReportJob.PENDING)
+        self.assertEqual(report_jobs.run_batch(5, ids=[job['job_id']]), 1)
+        self.assertEqual(ReportJob.objects.get(pk=other.pk).status, ReportJob.PENDING)
+        response = self.client.post('/watchapp/get_report_admin_all_property/', body, content_type='application/json')
+        self.assertTrue(response.content.startswith(b'%PDF'))
+        self.assertEqual(len(os.listdir(self.report_root)), 1)
+        self.assertTrue(self.submit()['done'])
+
+    def test_empty_report(self):
+        self.assertTrue(self.submit()['empty'])
+        self.assertEqual(ReportJob.objects.get().status, ReportJob.EMPTY)
+
+    def test_prune_reports(self):
+        now = time.time()
+        def write(name, size, age):
+            path = os.path.join(self.report_root, name)
+            with open(path, 'wb') as f:
+                f.write(b'x' * size)
+            os.utime(path, (now - age, now - age))
+        write('a' * 40 + '.pdf', 10, 8 * 24 * 3600)
+        write('b' * 40 + '.pdf', 10, 300)
+        write('c' * 40 + '.pdf', 10, 200)
+        write('d' * 40 + '.pdf', 10, 100)
+        write('tmpabc.pdf', 10, 60)
+        self.assertEqual(reports.prune_reports(max_age=7 * 24 * 3600, max_bytes=25, now=now), 2)
+        self.assertEqual(sorted(os.listdir(self.report_root)), ['c' * 40 + '.pdf', 'd' * 40 + '.pdf', 'tmpabc.pdf'])
+
+    def test_chunked_report(self):
+        self.create_events(5)
+        data = {'event_type': '-1', 'dateInit': '2000-01-01 00:00', 'dateFinal': '2100-01-01 00:00'}
+        parts = list(reports.report_html_parts('1', self.user, data, chunk_size=2))
+        self.assertEqual(len(parts), 3)
+        self.assertEqual([u'Generado por' in part for part in parts], [True, False, False])
+        with override_settings(REPORT_PDF_CHUNK_SIZE=2):
+            path = reports.build_report('1', self.user, data)
+        with open(path, 'rb') as report:
+            self.assertEqual(PdfFileReader(report).getNumPages(), 3)
+        # Los PDF parciales se borran despues de unirlos
+        self.assertEqual(os.listdir(self.report_root), [os.path.basename(path)])
+
+class EventRollupTestCase(ReportDataMixin, TestCase):
+    '''
+    Pruebas de los acumulados de eventos y de los resumenes
+    '''
+    def post_events(self, count, **kwargs):
+        batch = []
+        for i in range(count):
+            sensor = self.sensors[i % len(self.sensors)]
+            data = {'description': 'Lectura', 'value': '1.00', 'type': '3', 'is_critical': False, 'is_fatal': False, 'property': sensor.property_id, 'sensor': sensor.id}
+            data.update(kwargs)
+            batch.append(data)
+        response = self.client.post('/api/events/', json.dumps(batch), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+    def summary(self, url, **params):
+        params.setdefault('dateInit', '2000-01-01')
+        params.setdefault('dateFinal', '2100-01-01')
+        return json.loads(self.client.get(url, params).content)
+
+    def test_incremental_rollups(self):
+        self.post_events(6)
+        self.post_events(3, type='0')
+        self.client.post('/api/events/', json.dumps({'description': 'Lectura', 'value': '1.00', 'type': '0', 'property': self.sensors[0].property_id, 'sensor': self.sensors[0].id}), content_type='application/json')
+        self.assertEqual(sum(EventRollupDay.objects.values_list('count', flat=True)), 10)
+        self.assertEqual(EventRollupDay.objects.get(property_id=self.sensors[0].property_id, type='0').count, 2)
+        self.assertEqual(EventRollupHour.objects.filter(type='3').count(), 3)
+
+    def test_rebuild_matches_incremental(self):
+        self.post_events(7)
+        incremental = sorted(EventRollupHour.objects.values_list('property_id', 'bucket', 'type', 'count'))
+        self.assertEqual(rollups.rebuild(), 7)
+        self.assertEqual(sorted(EventRollupHour.objects.values_list('property_id', 'bucket', 'type', 'count')), incremental)
+
+    def test_summary_endpoints(self):
+        self.post_events(6)
+        rows = self.summary('/watchapp/event_summary_constructor/')
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(set(r['count'] for r in rows), set([2]))
+        rows = self.summary('/watchapp/event_summary_constructor/', granularity='hour', property=self.sensors[1].property_id)
+        self.assertEqual([r['property'] for r in rows], ['Apto 1'])
+        self.assertEqual(self.client.get('/watchapp/event_summary_constructor/', {'dateInit': 'x'}).status_code, 400)
+        response = self.client.get('/watchapp/event_summary_constructor/', {'dateInit': '2000-01-01', 'dateFinal': '2100-01-01', 'property': 'abc'})
+        self.assertEqual(response.status_code, 400)
+        # El propietario solo ve sus inmuebles
+        self.client.login(username='apto0', password='secret')
+        rows = self.summary('/watchapp/event_summary_owner/')
+        self.assertEqual([r['property'] for r in rows], ['Apto 0'])
+
+    def test_summary_query_count_does_not_grow_with_events(self):
+        self.post_events(3)
+        with CaptureQueriesContext(connection) as few:
+            self.summary('/watchapp/event_summary_constructor/')
+        self.post_events(30)
+        with CaptureQueriesContext(connection) as many:
+            self.summary('/watchapp/event_summary_constructor/')
+        self.assertEqual(len(few), len(many))
+
+class EventArchiveTestCase(ReportDataMixin, TestCase):
+    '''
+    Pruebas del archivo de eventos (archive_events) y de los reportes que lo incluyen
+    '''
+    def setUp(self):
+        super(EventArchiveTestCase, self).setUp()
+        self.create_events(6)
+        old = timezone.now() - datetime.timedelta(days=400)
+        Event.objects.filter(pk__in=list(Event.objects.order_by('pk').values_list('pk', flat=True)[:4])).update(date=old)
+        rollups.rebuild()
+
+    def report(self, date_init, date_final='2100-01-01 00:00'):
+        body = json.dumps({'event_type': '-1', 'dateInit': date_init, 'dateFinal': date_final})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/watchapp/get_event_admin_all_property/', body, content_type='application/json')
+        return json.loads(response.content), [q['sql'] for q in queries if 'watchapp_eventarchive' in q['sql']]
+
+    def test_archive_command_moves_old_events(self):
+        ids = sorted(Event.objects.values_list('pk', flat=True))
+        call_command('archive_events', older_than=365, batch_size=3, stdout=StringIO())
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertEqual(sorted(EventArchive.objects.values_list('pk', flat=True)), ids[:4])
+        # Los acumulados no cambian y se pueden reconstruir con los eventos archivados
+        self.assertEqual(sum(EventRollupDay.objects.values_list('count', flat=True)), 6)
+        self.assertEqual(rollups.rebuild(), 6)
+
+    def test_reports_include_archive_only_when_needed(self):
+        before = self.report('2000-01-01 00:00')[0]
+        archive.archive_events(archive.cutoff(365))
+        rows, archive_queries = self.report('2000-01-01 00:00')
+        self.assertEqual(sorted(rows), sorted(before))
+        self.assertTrue(len(archive_queries) > 1)
+        recent = (timezone.now() - datetime.timedelta(days=30)).strftime('%Y-%m-%d %H:%M')
+        rows, archive_queries = self.report(recent)
+        self.assertEqual(len(rows), 2)
+        # Solo se consulta la fecha del ultimo evento archivado
+        self.assertEqual(len(archive_queries), 1)
+        cache_key, count = reports.report_fingerprint('1', self.user, {'event_type': '-1', 'dateInit': '2000-01-01 00:00', 'dateFinal': '2100-01-01 00:00'})
+        self.assertEqual(count, 6)
+
+class ListHandler(logging.Handler):
+    '''
+    Handler de logging que guarda los registros, para revisar los mensajes en las pruebas
+    '''
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class RequestMetricsTestCase(ReportDataMixin, TestCase):
+    '''
+    Pruebas del middleware de metricas y de la vista de metricas
+    '''
+    def setUp(self):
+        super(RequestMetricsTestCase, self).setUp()
+        metrics.store.reset()
+        self.create_events(3)
+
+    def test_metrics_by_view(self):
+        response, count = self.report_queries()
+        self.report_queries()
+        self.assertEqual(self.client.get('/watchapp/metrics/').status_code, 302)
+        User.objects.create_superuser('admin', 'admin@mail.co', 'secret')
+        self.client.login(username='admin', password='secret')
+        response = self.client.get('/watchapp/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode('utf-8')
+        self.assertIn('watchapp_request_duration_seconds_count{view="get_event_admin_all_property"} 2', body)
+        self.assertIn('watchapp_request_queries_bucket{view="get_event_admin_all_property",le="+Inf"} 2', body)
+        self.assertIn('watchapp_responses_total{view="get_event_admin_all_property",code="200"} 2', body)
+        # El numero de consultas registrado es el de la peticion
+        queries_sum = [line for line in body.splitlines() if line.startswith('watchapp_request_queries_sum{view="get_event_admin_all_property"}')][0]
+        self.assertEqual(float(queries_sum.split()[-1]), 2 * count)
+
+    @override_settings(METRICS_SLOW_REQUEST_SECONDS=0, METRICS_SLOW_QUERIES=2)
+    def test_slow_request_log(self):
+        handler = ListHandler()
+        logger = logging.getLogger('watchapp.metrics')
+        logger.addHandler(handler)
+        try:
+            self.report_queries()
+        finally:
+            logger.removeHandler(handler)
+        message = handler.records[-1].getMessage()
+        self.assertIn('vista=get_event_admin_all_property', message)
+        self.assertEqual(len(message.splitlines()), 3)
+        self.assertIn('SELECT', message.splitlines()[1])
+        self.assertNotIn('PARAMS', message)
+
+    def test_sql_template_hides_parameters(self):
+        self.assertEqual(metrics.sql_template("QUERY = u'SELECT * FROM \"django_session\" WHERE session_key = %s' - PARAMS = (u'kfevutyk7jt4',)"),
+                         'SELECT * FROM "django_session" WHERE session_key = %s')
+        self.assertEqual(metrics.sql_template("SELECT * FROM t1 WHERE key = 'kfe''vu' AND id = 10 LIMIT 21"),
+                         'SELECT * FROM t1 WHERE key = ? AND id = ? LIMIT ?')
+
+    def test_streaming_response_is_measured(self):
+        params = {'event_type': '-1', 'dateInit': '2000-01-01 00:00', 'dateFinal': '2100-01-01 00:00'}
+        response = self.client.get('/watchapp/export_event_admin_all_property/', params)
+        self.assertNotIn('export_event_admin_all_property', metrics.store.views)
+        self.assertEqual(len(json.loads(b''.join(response.streaming_content))), 3)
+        histograms = metrics.store.views['export_event_admin_all_property']
+        self.assertEqual(histograms['duration'].count, 1)
+        self.assertTrue(histograms['queries'].sum > 0)
+
+class CountingStream(StringIO):
+    '''
+    StringIO que cuenta las escrituras
+    '''
+    writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        StringIO.write(self, text)
+
+class LogPipeTestCase(TestCase):
+    '''
+    Pruebas del log asincrono de watchapp.logpipe
+    '''
+    def setUp(self):
+        self.stream = CountingStream()
+        self.target = logpipe.BatchStreamHandler(self.stream)
+        self.target.setFormatter(logpipe.JSONFormatter())
+        self.target.set_name('logpipe-test')
+        self.queue = logpipe.QueueHandler(['logpipe-test'], batch_size=50, flush_interval=0.05)
+        self.queue.addFilter(logpipe.SamplingFilter(every=3))
+        self.logger = logging.getLogger('watchapp.tests.logpipe')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.queue)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.queue)
+        self.queue.listener.stop()
+        self.target.close()
+
+    def test_batched_json_records(self):
+        for i in range(9):
+            self.logger.debug('lectura %s', i)
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            self.logger.exception('fallo', extra={'property_id': 7})
+        self.queue.flush()
+        records = [json.loads(line) for line in self.stream.getvalue().splitlines()]
+        self.assertEqual([r['message'] for r in records], ['lectura 0', 'lectura 3', 'lectura 6', 'fallo'])
+        self.assertEqual((records[-1]['level'], records[-1]['property_id']), ('ERROR', 7))
+        self.assertIn('ZeroDivisionError', records[-1]['exception'])
+        self.assertEqual(self.stream.writes, 1)
+        self.assertNotEqual(self.queue.listener.thread.ident, threading.current_thread().ident)
+
+    def test_full_queue_drops_records(self):
+        self.queue.queue = self.queue.listener.queue = Queue.Queue(2)
+        self.queue.pid = os.getpid()
+        for i in range(5):
+            self.logger.warning('aviso %s', i)
+        self.assertEqual(self.queue.dropped, 3)
+        self.queue.listener.start()
+        self.queue.flush()
+        messages = [json.loads(line)['message'] for line in self.stream.getvalue().splitlines()]
+        self.assertEqual(messages, ['aviso 0', 'aviso 1', 'Cola de log llena: 3 registros descartados'])
+
+    def test_settings_logging_writes_logfile(self):
+        # El logfile de settings.LOGGING solo lo referencia la cola, no debe liberarse despues de dictConfig
+        gc.collect()
+        queue = logging._handlers['queue']
+        logfile = [h for h in queue.listener.handlers() if isinstance(h, logpipe.BatchRotatingFileHandler)]
+        self.assertEqual(len(logfile), 1)
+        marker = 'prueba del logfile %s' % uuid.uuid4().hex
+        logging.getLogger('watchapp.views').warning(marker)
+        queue.flush()
+        with open(logfile[0].baseFilename) as f:
+            self.assertIn(marker, f.read())
+
+class GroupAccessTestCase(TestCase):
+    '''
+    Pruebas del cache de grupos de watchapp.access en las vistas protegidas por grupo
+    '''
+    # Vista: consultas con el cache de grupos caliente (sesion, usuario y las propias de la vista)
+    USUARIOS_VIEWS = {'/watchapp/users_home/': 5, '/watchapp/rpt_owner_property/': 4, '/watchapp/update_profile/': 6}
+    CONSTRUCTORAS_VIEWS = {'/watchapp/constructora_home/': 2, '/watchapp/rpt_admin_all_property/': 2,
+                           '/watchapp/rpt_admin_all_property_by_owner/': 5, '/watchapp/admin_file_upload/': 2}
+
+    def setUp(self):
+        cache.clear()
+        self.owner = create_property_with_owner()[0].properties_as_owner.get().user
+        self.owner.groups.add(Group.objects.get_or_create(name='usuarios')[0])
+        self.constructora = create_constructora_user()[0]
+
+    def group_queries(self, queries):
+        return [q for q in queries if 'auth_group' in q['sql']]
+
+    def assert_view_queries(self, views):
+        for url, expected in views.items():
+            self.client.get(url)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertEqual(self.group_queries(queries), [], url)
+            self.assertEqual(len(queries), expected, url)
+
+    def test_usuarios_views(self):
+        self.client.login(username='apto101', password='secret')
+        self.assert_view_queries(self.USUARIOS_VIEWS)
+
+    def test_constructoras_views(self):
+        self.client.login(username='constructora', password='secret')
+        self.assert_view_queries(self.CONSTRUCTORAS_VIEWS)
+
+    def test_groups_loaded_once_and_invalidated(self):
+        self.client.login(username='constructora', password='secret')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/watchapp/login_success/')
+        # login_success y base.html consultan los grupos una sola vez
+        self.assertEqual(len(self.group_queries(queries)), 1)
+        self.assertEqual(self.client.get('/watchapp/constructora_home/').status_code, 200)
+        self.constructora.groups.clear()
+        self.assertEqual(self.client.get('/watchapp/constructora_home/').status_code, 302)
+        Group.objects.get(name='constructoras').user_set.add(self.constructora)
+        self.assertEqual(self.client.get('/watchapp/constructora_home/').status_code, 200)
+
+    @override_settings(CACHE_INVALIDATION_INTERVAL=3600)
+    def test_groups_invalidated_in_other_processes(self):
+        self.client.login(username='constructora', password='secret')
+        invalidation.poller.reset()
+        invalidation.poller.poll(force=True)
+        self.assertEqual(self.client.get('/watchapp/constructora_home/').status_code, 200)
+        # El cambio lo hace otro proceso: solo llega a este por CacheInvalidation
+        handlers, invalidation.handlers = invalidation.handlers, {}
+        try:
+            Group.objects.get(name='constructoras').user_set.remove(self.constructora)
+        finally:
+            invalidation.handlers = handlers
+        self.assertEqual(self.client.get('/watchapp/constructora_home/').status_code, 200)
+        invalidation.poller.poll(force=True)
+        self.assertEqual(self.client.get('/watchapp/constructora_home/').status_code, 302)
+
+class UserPropertiesTestCase(TestCase):
+    '''
+    Pruebas de los inmuebles por usuario (propertys_by_User / access.user_properties)
+    '''
+    def setUp(self):
+        cache.clear()
+        self.property = create_property_with_owner()[0]
+        self.profile = self.property.properties_as_owner.get()
+        self.user = self.profile.user
+        self.other = Property.objects.create(name='Apto 202', address='Calle 1')
+
+    def test_single_query_and_cache(self):
+        self.profile.properties_as_resident.add(self.property, self.other)
+        with self.assertNumQueries(1):
+            properties = access.user_properties(self.user)
+        # El inmueble donde es propietario y residente aparece una sola vez
+        self.assertEqual(properties, [self.property, self.other])
+        with self.assertNumQueries(0):
+            access.user_properties(self.user)
+
+    def test_invalidated_on_m2m_changes(self):
+        self.assertEqual(access.user_properties(self.user), [self.property])
+        self.other.properties_as_resident.add(self.profile)
+        self.assertEqual(access.user_properties(self.user), [self.property, self.other])
+        self.profile.properties_as_owner.remove(self.property)
+        self.assertEqual(access.user_properties(self.user), [self.other])
+        self.other.properties_as_resident.clear()
+        self.assertEqual(access.user_properties(self.user), [])
+        # Los cambios se publican para los caches de los demas procesos
+        self.assertTrue(CacheInvalidation.objects.filter(scope=access.USER_PROPERTIES, object_id=self.user.id).exists())
+
+    def test_sensor_status_page(self):
+        self.client.login(username='apto101', password='secret')
+        response = self.client.get('/watchapp/sensorstatus/')
+        self.assertContains(response, '<option value="%d">Apto 101</option>' % self.property.id)
+
+@override_settings(SENSOR_FLUSH_INTERVAL=0)
+class PropertyStreamTestCase(TestCase):
+    '''
+    Pruebas del stream de Server-Sent Events por inmueble y del broker local
+    '''
+    def setUp(self):
+        cache.clear()
+        self.property, self.sensor = create_property_with_owner()
+        self.client.login(username='apto101', password='secret')
+
+    def open_stream(self):
+        response = self.client.get('/watchapp/property_stream/%d/' % self.property.id)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = iter(response.streaming_content)
+        self.assertTrue(next(content).startswith('retry:'))
+        return response, content
+
+    def test_sensor_update_and_event_are_pushed(self):
+        response, content = self.open_stream()
+        self.assertEqual(stream.broker.count(self.property.id), 1)
+        self.client.get('/watchapp/update_sensor/', {'sensor_id': self.sensor.id, 'value': '5'})
+        message = next(content)
+        self.assertTrue(message.startswith('event: sensor\n'))
+        self.assertEqual(json.loads(message.split('data: ')[1])['valueDisplay'], 'On')
+        event = {'description': 'Lectura', 'value': '1.00', 'type': '3', 'property': self.property.id, 'sensor': self.sensor.id}
+        self.client.post('/api/events/', json.dumps([event, event]), content_type='application/json')
+        self.assertTrue(next(content).startswith('event: event\n'))
+        self.assertTrue(next(content).startswith('event: event\n'))
+        response.close()
+        self.assertEqual(stream.broker.count(self.property.id), 0)
+
+    def test_other_users_property_is_forbidden(self):
+        other = Property.objects.create(name='Apto 202', address='Calle 1')
+        response = self.client.get('/watchapp/property_stream/%d/' % other.id)
+        self.assertEqual(response.status_code, 403)
+
+    def test_slow_subscriber_does_not_block_publisher(self):
+        broker = stream.Broker()
+        subscription = broker.subscribe(1, maxsize=2)
+        self.assertEqual([broker.publish(1, 'sensor', {'n': n}) for n in range(3)], [1, 1, 0])
+        self.assertEqual(subscription.dropped, 1)
+        self.assertEqual(broker.publish(2, 'sensor', {}), 0)
+
+    @override_settings(SSE_HEARTBEAT=0.01, SSE_MAX_DURATION=0.05)
+    def test_keepalive_and_max_duration(self):
+        response, content = self.open_stream()
+        messages = list(content)
+        self.assertTrue(messages)
+        self.assertEqual(set(messages), set([': keepalive\n\n']))
+        self.assertEqual(stream.broker.count(self.property.id), 0)
+
+class SensorStateTestCase(TestCase):
+    '''
+    Pruebas del cache de estado de sensores con escritura diferida
+    '''
+    def setUp(self):
+        self.property, self.sensor = create_property_with_owner()
+        self.lamp = Sensor.objects.create(code='l-2', description='Lampara', type='1', property=self.property, value='1')
+        self.state = sensor_state.SensorStateCache(flush_interval=60, ttl=60, start_thread=False)
+
+    def test_reads_are_served_from_cache(self):
+        with self.assertNumQueries(1):
+            self.state.sensors(self.property.id)
+            sensors = self.state.sensors(self.property.id)
+        self.assertEqual([s.id for s in sensors], [self.sensor.id, self.lamp.id])
+
+    def test_burst_is_coalesced_into_one_write(self):
+        self.state.sensors(self.property.id)
+        with self.assertNumQueries(0):
+            for value in ('2', '3', '4', '5'):
+                self.state.update(self.lamp.id, value)
+                self.state.update(self.sensor.id, value)
+        self.assertEqual(Sensor.objects.get(pk=self.lamp.id).value, '1')
+        self.assertEqual([s.value for s in self.state.sensors(self.property.id)], ['5', '5'])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.state.flush(), 2)
+        # Un solo UPDATE de la columna value para los dos sensores con el mismo valor
+        self.assertEqual(len(queries), 1)
+        self.assertIn('SET "value"', queries[0]['sql'])
+        self.assertEqual(set(Sensor.objects.values_list('value', flat=True)), set(['5']))
+
+    def test_alarm_sensors_are_written_synchronously(self):
+        door = Sensor.objects.create(code='p-3', description='Puerta', type='0', property=self.property, value='1')
+        self.state.sensors(self.property.id)
+        with CaptureQueriesContext(connection) as queries:
+            self.state.update(door.id, '5')
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('description', queries[0]['sql'])
+        self.assertEqual(Sensor.objects.get(pk=door.id).value, '5')
+        self.state.update(self.lamp.id, '3', sync=True)
+        self.assertEqual(Sensor.objects.get(pk=self.lamp.id).value, '3')
+
+    def test_pending_values_survive_reload(self):
+        self.state.update(self.lamp.id, '4')
+        # Un cambio de otro campo invalida el inmueble en el cache del proceso
+        self.state.invalidate(self.property.id)
+        self.assertEqual([s.value for s in self.state.sensors(self.property.id)], ['1', '4'])
+
+@override_settings(SENSOR_FLUSH_INTERVAL=0)
+class PropertySceneTestCase(TestCase):
+    '''
+    Pruebas de los comandos por lote a los actuadores (escenas)
+    '''
+    def setUp(self):
+        cache.clear()
+        self.property, self.sensor = create_property_with_owner()
+        self.lamps = [Sensor.objects.create(code='l-%d' % i, description='Lampara %d' % i, type='1', property=self.property, value='5') for i in range(4)]
+        self.client.login(username='apto101', password='secret')
+
+    def post(self, data):
+        return self.client.post('/watchapp/property_scene/%d/' % self.property.id, json.dumps(data), content_type='application/json')
+
+    def test_scene_uses_one_update_and_bulk_events(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post({'scene': 'all_off'})
+        self.assertEqual(json.loads(response.content)['updated'], 4)
+        sql = [q['sql'] for q in queries]
+        self.assertEqual(len([q for q in sql if 'UPDATE "watchapp_sensor"' in q]), 1)
+        self.assertEqual(len([q for q in sql if 'INSERT INTO "watchapp_event"' in q]), 1)
+        self.assertEqual(set(Sensor.objects.filter(type='1').values_list('value', flat=True)), set(['1']))
+        self.assertEqual(Event.objects.filter(type='4').count(), 4)
+        # El sensor que no es actuador no cambia
+        self.assertEqual(Sensor.objects.get(pk=self.sensor.id).value, '1')
+
+    def test_commands_one_update_per_value(self):
+        commands = [{'sensor_id': self.lamps[0].id, 'value': '1'}, [self.lamps[1].id, '3'], [self.lamps[2].id, '3'], [self.lamps[3].id, '5']]
+        with CaptureQueriesContext(connection) as queries:
+            body = json.loads(self.post({'commands': commands}).content)
+        # La lampara 3 ya estaba en 5: sin UPDATE ni evento
+        self.assertEqual(body['updated'], 3)
+        self.assertEqual(len([q for q in queries if 'UPDATE "watchapp_sensor"' in q['sql']]), 2)
+        self.assertEqual(dict(Sensor.objects.filter(type='1').values_list('id', 'value')),
+                         {self.lamps[0].id: '1', self.lamps[1].id: '3', self.lamps[2].id: '3', self.lamps[3].id: '5'})
+
+    def test_invalid_commands_apply_nothing(self):
+        other = Property.objects.create(name='Apto 202', address='Calle 1')
+        foreign = Sensor.objects.create(code='l-9', description='Ajena', type='1', property=other, value='5')
+        commands = [[self.lamps[0].id, '1'], [self.lamps[1].id, '9'], [foreign.id, '1'], [self.sensor.id, '1']]
+        response = self.post({'commands': commands})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([e['index'] for e in json.loads(response.content)['errors']], [1, 2, 3])
+        self.assertEqual(Sensor.objects.get(pk=self.lamps[0].id).value, '5')
+        self.assertFalse(Event.objects.exists())
+        self.assertEqual(self.post({'scene': 'fiesta'}).status_code, 400)
+        response = self.client.post('/watchapp/property_scene/%d/' % other.id, json.dumps({'scene': 'all_off'}), content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_malformed_commands(self):
+        for data in ({'commands': [5]}, {'commands': [[self.lamps[0].id, '1'], 'x']}, {'commands': 5}, [[self.lamps[0].id, '1']]):
+            self.assertEqual(self.post(data).status_code, 400, data)
+        self.assertFalse(Event.objects.exists())
+
+    def test_failed_write_does_not_change_cached_state(self):
+        sensor_state.state.sensors(self.property.id)
+        record_events = rollups.record_events
+        def fail(events):
+            raise IOError('base de datos caida')
+        rollups.record_events = fail
+        try:
+            actuators = scenes.property_actuators(self.property.id)
+            self.assertRaises(IOError, scenes.apply_commands, self.property.id, actuators, {self.lamps[0].id: '1'})
+        finally:
+            rollups.record_events = record_events
+        self.assertEqual(sensor_state.state.get(self.lamps[0].id).value, '5')
+        self.assertEqual(Sensor.objects.get(pk=self.lamps[0].id).value, '5')
+
+class PropertyImportTestCase(TestCase):
+    '''
+    Pruebas de la importacion masiva de inmuebles (process_file / watchapp.importer)
+    '''
+    def setUp(self):
+        cache.clear()
+        self.property = create_property_with_owner()[0]
+        self.profile = self.property.properties_as_owner.get()
+        create_constructora_user()
+        self.client.login(username='constructora', password='secret')
+        self.import_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(IMPORT_ROOT=self.import_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.import_root)
+
+    def upload(self, lines):
+        upload = SimpleUploadedFile('inmuebles.csv', ''.join(lines))
+        return json.loads(self.client.post('/watchapp/process_file/', {'property_file': upload}).content)
+
+    def csv_lines(self, count, owner='apto101'):
+        return ['Torre %d,Calle %d,555,plano.png,%s\n' % (i, i, owner) for i in range(count)]
+
+    def test_row_report(self):
+        lines = self.csv_lines(2) + ['Apto 101,Calle 1,,,apto101\n', 'Torre 0,Calle 0,555,plano.png,apto101\n',
+                                     'Torre 9,Calle 9,555,plano.png,nadie\n', 'Incompleta,Calle\n', '\n']
+        job = self.upload(lines)
+        self.assertFalse(job['done'])
+        self.assertEqual(job['total_rows'], 7)
+        self.assertEqual(import_jobs.run_batch(1), 1)
+        body = json.loads(self.client.get(job['status_url']).content)
+        self.assertTrue(body['done'])
+        self.assertEqual((body['processed'], body['inserted'], body['skipped'], body['failed']), (6, 2, 2, 2))
+        self.assertEqual([(r['line'], r['status']) for r in body['issues']], [(3, 'skipped'), (4, 'skipped'), (5, 'failed'), (6, 'failed')])
+        # El archivo se borra al terminar
+        self.assertEqual(os.listdir(self.import_root), [])
+        self.assertEqual(set(self.profile.properties_as_owner.values_list('name', flat=True)), set(['Apto 101', 'Torre 0', 'Torre 1']))
+
+    def test_queries_per_chunk_do_not_grow_with_rows(self):
+        def import_queries(lines):
+            with CaptureQueriesContext(connection) as queries:
+                report = importer.import_properties(lines, chunk_size=1000)
+            return report, len([q for q in queries if 'SAVEPOINT' not in q['sql']])
+        report, few = import_queries(self.csv_lines(3))
+        self.assertEqual(report.counts[importer.INSERTED], 3)
+        report, many = import_queries(['%s,Calle,,,apto101\n' % i for i in range(150)])
+        self.assertEqual(report.counts[importer.INSERTED], 150)
+        self.assertEqual(few, many)
+
+    def test_owner_property_cache_is_invalidated(self):
+        user = self.profile.user
+        self.assertEqual(len(access.user_properties(user)), 1)
+        importer.import_properties(self.csv_lines(3), chunk_size=2)
+        self.assertEqual(len(access.user_properties(user)), 4)
+
+    def test_import_worker_invalidates_web_processes(self):
+        user = self.profile.user
+        invalidation.poller.reset()
+        invalidation.poller.poll(force=True)
+        self.assertEqual(len(access.user_properties(user)), 1)
+        sensor_state.state.sensors(self.property.id)
+        # Otro proceso (import_worker) no comparte la memoria de este, solo la base de datos
+        handlers, invalidation.handlers = invalidation.handlers, {}
+        try:
+            importer.import_properties(self.csv_lines(1) + ['SENSOR,Apto 101,m,,0,5-5\n'])
+        finally:
+            invalidation.handlers = handlers
+        self.assertEqual(len(access.user_properties(user)), 1)
+        self.assertEqual(invalidation.poller.poll(force=True), 2)
+        self.assertEqual(len(access.user_properties(user)), 2)
+        self.assertEqual(len(sensor_state.state.sensors(self.property.id)), 2)
+
+    def test_invalidations_committed_out_of_order(self):
+        applied = []
+        invalidation.register('prueba', applied.extend)
+        try:
+            invalidation.poller.reset()
+            invalidation.poller.poll(force=True)
+            last_id = CacheInvalidation.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            # Una peticion confirma su registro antes que el bloque de import_worker que tomo un id menor
+            CacheInvalidation.objects.create(id=last_id + 10, scope='prueba', object_id=1)
+            self.assertEqual(invalidation.poller.poll(force=True), 1)
+            CacheInvalidation.objects.create(id=last_id + 5, scope='prueba', object_id=2)
+            self.assertEqual(invalidation.poller.poll(force=True), 1)
+            self.assertEqual(invalidation.poller.poll(force=True), 0)
+            self.assertEqual(applied, [1, 2])
+        finally:
+            del invalidation.handlers['prueba']
+
+    def test_resume_from_last_committed_chunk(self):
+        job = self.upload(self.csv_lines(5))
+        import_chunk = importer.import_chunk
+        calls = []
+        def crash_on_second_chunk(chunk):
+            calls.append(chunk)
+            if len(calls) == 2:
+                raise SystemExit('worker caido')
+            return import_chunk(chunk)
+        importer.import_chunk = crash_on_second_chunk
+        try:
+            self.assertRaises(SystemExit, import_jobs.run_batch, 1, 2)
+        finally:
+            importer.import_chunk = import_chunk
+        stored = ImportJob.objects.get(pk=job['job_id'])
+        self.assertEqual((stored.status, stored.last_line, stored.inserted), (ImportJob.RUNNING, 2, 2))
+        # Mientras no venza el tiempo del trabajo otro worker no lo toma
+        self.assertEqual(import_jobs.run_batch(1, 2), 0)
+        ImportJob.objects.filter(pk=stored.pk).update(heartbeat=stored.heartbeat - datetime.timedelta(hours=1))
+        self.assertEqual(import_jobs.run_batch(1, 2), 1)
+        stored = ImportJob.objects.get(pk=job['job_id'])
+        self.assertEqual((stored.status, stored.processed, stored.inserted, stored.skipped), (ImportJob.DONE, 5, 5, 0))
+        self.assertEqual(Property.objects.filter(name__startswith='Torre').count(), 5)
+
+    def test_sensor_rows(self):
+        lines = self.csv_lines(1) + ['SENSOR,Torre 0,p,,0,10-20\n', 'sensor,Torre 0,l,Luz sala,1,30-40,1\n',
+                                     'SENSOR,Apto 101,m,Movimiento,0,5-5\n', 'SENSOR,Torre 0,p,Otra,0,10-20\n',
+                                     'SENSOR,Nadie,p,,0,1-1\n', 'SENSOR,Torre 0,x,,0,2-2\n']
+        report = importer.import_properties(lines)
+        self.assertEqual([r['status'] for r in report.rows], ['inserted'] * 4 + ['skipped', 'failed', 'failed'])
+        for result in report.rows[1:4]:
+            sensor = Sensor.objects.get(pk=result['sensor_id'])
+            self.assertEqual(sensor.code, result['code'])
+            self.assertEqual(sensor.code, sensor.code[0] + '-' + str(sensor.pk))
+        door, light = Sensor.objects.filter(property__name='Torre 0').order_by('id')
+        self.assertEqual((door.description, door.type, door.location_in_plan, door.is_discrete), ('Sensor de Puertas', '0', '10-20', False))
+        self.assertEqual((light.description, light.type, light.is_discrete), ('Luz sala', '1', True))
+        self.assertEqual(Sensor.objects.get(code='S-1').code, 'S-1')
+
+    def test_sensor_queries_do_not_grow_with_rows(self):
+        def import_queries(count):
+            lines = ['SENSOR,Apto 101,p,,0,%d-%d\n' % (count, i) for i in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                report = importer.import_properties(lines, chunk_size=1000)
+            self.assertEqual(report.counts[importer.INSERTED], count)
+            return len([q for q in queries if 'SAVEPOINT' not in q['sql']])
+        self.assertEqual(import_queries(3), import_queries(120))
+        self.assertEqual(Sensor.objects.filter(property=self.property, code__contains='-').count(), 124)
+
+    def test_concurrent_sensors_are_not_taken(self):
+        # Un sensor que set_position_ajax inserta mientras se importa el bloque, antes de asignarle el codigo
+        other = Property.objects.create(name='Apto 202', address='Calle 2')
+        bulk_create = Sensor.objects.bulk_create
+        def insert_concurrently(objs, *args, **kwargs):
+            created = bulk_create(objs, *args, **kwargs)
+            Sensor.objects.create(code='p', description='Ajeno', type='0', property=other, location_in_plan='5-5', value='1')
+            return created
+        Sensor.objects.bulk_create = insert_concurrently
+        try:
+            report = importer.import_properties(['SENSOR,Apto 101,p,,0,5-5\n', 'SENSOR,Apto 101,m,,0,6-6\n'])
+        finally:
+            del Sensor.objects.bulk_create
+        self.assertEqual(Sensor.objects.get(property=other).code, 'p')
+        for result in report.rows:
+            sensor = Sensor.objects.get(pk=result['sensor_id'])
+            self.assertEqual((sensor.property_id, sensor.code), (self.property.id, result['code']))
+            self.assertEqual(sensor.code, sensor.code[0] + '-' + str(sensor.pk))
+
+    def test_json_upload(self):
+        data = {'properties': [{'name': 'Torre A', 'address': 'Calle 5', 'fixed_phone': 555, 'plan': None, 'owner': 'apto101'}],
+                'sensors': [{'property': 'Torre A', 'code': 'h', 'type': '0', 'location_in_plan': '1-2'},
+                            {'property': 'Torre A', 'code': 'p', 'type': '3', 'location_in_plan': '1-3'}]}
+        upload = SimpleUploadedFile('inmuebles.json', json.dumps(data))
+        job = json.loads(self.client.post('/watchapp/process_file/', {'property_file': upload}).content)
+        self.assertEqual(job['total_rows'], 3)
+        import_jobs.run_batch(1)
+        body = json.loads(self.client.get(job['status_url']).content)
+        self.assertEqual((body['inserted'], body['failed']), (2, 1))
+        sensor = Sensor.objects.get(property__name='Torre A')
+        self.assertEqual((sensor.code, sensor.description), ('h-%d' % sensor.pk, 'Sensor de Humo'))
+        self.assertEqual(Property.objects.get(name='Torre A').fixed_phone, '555')
+
+    def test_set_position_ajax(self):
+        self.client.login(username='apto101', password='secret')
+        payload = {'property': 'Apto 101', 'code': 'mSensor', 'description': 'Movimiento', 'type': '0', 'location_in_plan': '3-4', 'is_discrete': 0}
+        with CaptureQueriesContext(connection) as queries:
+            body = json.loads(self.client.post('/watchapp/set_position_ajax/', json.dumps(payload), content_type='application/json').content)
+        sensor = Sensor.objects.get(pk=body['sensor_id'])
+        self.assertEqual((body['code'], sensor.code, sensor.is_discrete), ('m-%d' % sensor.pk, 'm-%d' % sensor.pk, False))
+        self.assertEqual(len([q for q in queries if 'watchapp_sensor' in q['sql'] and 'SAVEPOINT' not in q['sql']]), 2)
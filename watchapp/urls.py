@@ -19,10 +19,15 @@ urlpatterns = patterns('',
     url(r'^users_home/$', views.users_home, name='users_home'),
     url(r'^sensor_configuration/$', views.sensor_configuration, name='sensor_configuration'),
 	url(r'^update_sensor/$', views.update_sensor, name='update_sensor'),
+    # URL del stream (Server-Sent Events) de sensores y eventos de un inmueble
+    url(r'^property_stream/(?P<property_id>\d+)/$', views.property_stream, name='property_stream'),
+    # URL para cambiar varios actuadores de un inmueble (escena o lista de comandos)
+    url(r'^property_scene/(?P<property_id>\d+)/$', views.property_scene, name='property_scene'),
 	#URLs para funcionalidades de constructoras    
 	url(r'^constructora_home/$', views.constructora_home, name='constructora_home'),
     url(r'^admin_file_upload/$', views.admin_file_upload, name='admin_file_upload'),
     url(r'^process_file/$', views.process_file, name='process_file'),
+    url(r'^import_jobs/(?P<job_id>\d+)/$', views.import_job_status, name='import_job_status'),
 	#URL para crear un sensor en un plano
     url(r'^set_position_ajax/$', views.set_position_ajax, name='set_position_ajax'),
 	#URL para eliminar un sensor en un plano
@@ -40,6 +45,19 @@ urlpatterns = patterns('',
     url(r'^rpt_admin_all_property_by_owner/$', views.rpt_admin_all_property_by_owner, name='rpt_admin_all_property_by_owner'),
     url(r'^get_event_admin_all_property_by_owner/$', views.get_event_admin_all_property_by_owner, name='get_event_admin_all_property_by_owner'),
     url(r'^get_report_admin_all_property_by_owner/$', views.get_report_admin_all_property_by_owner, name='get_report_admin_all_property_by_owner'),
+    # URLs para los trabajos de reportes PDF que genera el comando report_worker
+    url(r'^report_jobs/$', views.submit_report_job, name='submit_report_job'),
+    url(r'^report_jobs/(?P<job_id>\d+)/$', views.report_job_status, name='report_job_status'),
+    url(r'^report_jobs/(?P<job_id>\d+)/download/$', views.report_job_download, name='report_job_download'),
+    # URLs para exportar los reportes de eventos en JSON o CSV (parametro format=json|csv)
+    url(r'^export_event_owner_property/$', views.export_event_owner_property, name='export_event_owner_property'),
+    url(r'^export_event_admin_all_property/$', views.export_event_admin_all_property, name='export_event_admin_all_property'),
+    url(r'^export_event_admin_all_property_by_owner/$', views.export_event_admin_all_property_by_owner, name='export_event_admin_all_property_by_owner'),
+    # URLs para los resumenes de eventos por hora o por dia (acumulados)
+    url(r'^event_summary_constructor/$', views.event_summary_constructor, name='event_summary_constructor'),
+    url(r'^event_summary_owner/$', views.event_summary_owner, name='event_summary_owner'),
+    # URL de las metricas de las peticiones (Prometheus), solo administradores
+    url(r'^metrics/$', views.request_metrics, name='request_metrics'),
     #url(r'^admin_file_upload/$', views.admin_file_upload, name='admin_file_upload'),
     url(r'^update_profile/$', views.update_profile, name='update_profile'),
 )
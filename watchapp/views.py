@@ -1,27 +1,28 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse, Http404
 from django.http.response import HttpResponseRedirect
-from django.shortcuts import render, redirect, render_to_response
+from django.shortcuts import render, redirect, render_to_response, get_object_or_404
 from django.core.urlresolvers import reverse, reverse_lazy
 from django.contrib import messages 
 from django.contrib.auth.models import User, Group
 from django.template.context import RequestContext
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.decorators import user_passes_test
+from django.contrib.admin.views.decorators import staff_member_required
+from watchapp.access import group_required, has_group, user_properties, CONSTRUCTORAS, USUARIOS
 from django.core.exceptions import ObjectDoesNotExist
 from forms import SignUpForm
-from watchapp.models import ConstructorCompany, Property, UserProfile, Sensor, Event
+from watchapp.models import ConstructorCompany, Property, UserProfile, Sensor, Event, ReportJob, ImportJob, notify_event
 from watchapp.serializers import EventSerializer
-from rest_framework import viewsets
+from watchapp import reports, report_jobs, rollups, stream, sensor_state, scenes, import_jobs, importer, metrics
+from rest_framework import viewsets, status
+from rest_framework.response import Response
+from django.db import transaction, connection
 import logging
 from django.views.decorators.csrf import csrf_exempt
 import json
-import ho.pisa as pisa
-import cStringIO as StringIO
-import cgi
+import os
 from django.template import RequestContext
 from django.template.loader import render_to_string
 import logging
-import sys
 import datetime
 from django.core import serializers
 import csv
@@ -82,9 +83,9 @@ def login_success(request):
     	@param request
     	@author Lorena Salamanca
     """    
-    if request.user.groups.filter(name="constructoras").exists():        
+    if has_group(request.user, CONSTRUCTORAS):        
         return HttpResponseRedirect(reverse('watchapp:constructora_home'))
-    elif request.user.groups.filter(name="usuarios").exists():       
+    elif has_group(request.user, USUARIOS):       
         return HttpResponseRedirect(reverse('watchapp:users_home'))
 
 
@@ -117,36 +118,35 @@ def sensor_configuration(request):
 @login_required()
 @csrf_exempt
 def set_position_ajax(request):
-        response_data = {}
-	data = json.loads(request.body) 
-        sensors = []
-        selected_property = Property.objects.get(name=data['property'])
-        sensor = Sensor(
-		code = data['code'],
-		description = data['description'],
-		type =  data['type'],
-		location_in_plan = data['location_in_plan'],
-		is_discrete = data['location_in_plan'],
-		property = selected_property,
-		value = '0'
+    """
+    Crea un sensor en el plano del inmueble. El codigo es el prefijo del tipo de sensor y el id, se guarda el sensor
+    y luego solo el codigo (sin volver a consultar el sensor)
+        @param request
+    """
+    data = json.loads(request.body)
+    selected_property = Property.objects.get(name=data['property'])
+    sensor = Sensor(
+        code = data['code'],
+        description = data['description'],
+        type = data['type'],
+        location_in_plan = data['location_in_plan'],
+        is_discrete = str(data.get('is_discrete', 0)) in ('1', 'true', 'True'),
+        property = selected_property,
+        value = importer.SENSOR_INITIAL_VALUE
+    )
+    sensor.save()
+    sensor.code = data['code'][0] + '-' + str(sensor.pk)
+    sensor.save(update_fields=['code'])
+    data = {}
+    data["sensor_id"] = sensor.id
+    data["code"] = sensor.code
+    data["location_in_plan"] = sensor.location_in_plan
+    data["description"] = sensor.description
+    data["type"] = sensor.type
+    return HttpResponse(
+            json.dumps(data),
+            content_type="application/json"
         )
-        sensor.save()
-	sensorUpdate=Sensor.objects.get(pk=sensor.pk)
-        typeSensor =data['code']
-        sensorUpdate.code = typeSensor[0]+'-'+str(sensor.pk);       
-	sensorUpdate.save()
-	sensors = property_sensors(request,selected_property.id) 
-	print 'Add ok'
-        data = {}
-        data["sensor_id"] = sensorUpdate.id
-        data["code"] = sensorUpdate.code
-        data["location_in_plan"] = sensorUpdate.location_in_plan
-        data["description"] = sensorUpdate.description
-        data["type"] = sensorUpdate.type
-        return HttpResponse(
-                json.dumps(data),
-                content_type="application/json"
-            )
 
 
 ####################### Vistas para borrar un sensor en un plano #######################
@@ -168,7 +168,7 @@ def delete_position_ajax(request):
 ####################### Vistas para propietarios / residentes #######################
 
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='usuarios').exists(), login_url='/watchapp/login/')
+@group_required(USUARIOS)
 def users_home(request):
     """
     Esta funcion tiene el contenido del home de usuarios (propietarios / residentes), 
@@ -200,7 +200,7 @@ def users_home(request):
         })
 
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='usuarios').exists(), login_url='/watchapp/login/')
+@group_required(USUARIOS)
 def change_secure_mode(request, property_id, asresident):
     """
     Esta funcion activa / desactiva el modo seguro de un inmueble
@@ -251,29 +251,20 @@ def property_sensors(request,property_id):
         @param request
         @author German Bernal
     """
-    log.debug("property_sensors: val: " + str(property_id))
-    sensors = Sensor.objects.filter(property_id=property_id)
+    log.debug("property_sensors: val: %s", property_id)
+    # Los valores se leen del cache de estado de sensores, incluye los cambios que aun no se han escrito
+    sensors = sensor_state.state.sensors(int(property_id))
     return sensors
 
 @login_required()
 def propertys_by_User(request):
     """
-    Esta funcion permite obtener las propiedad por usuario.
+    Esta funcion permite obtener las propiedad por usuario (como residente o propietario),
+    con una sola consulta y guardadas en cache por usuario (watchapp.access.user_properties).
         @param request
         @author German Bernal
     """    
-    propertyList = []
-    user = User.objects.filter(username=request.user.username)
-    userP = UserProfile.objects.get(user_id=user[0].id)
-    for p in userP.properties_as_resident.all():
-        property = Property.objects.get(pk=p.id)
-        if property not in propertyList:
-            propertyList.append(property)
-    for p in userP.properties_as_owner.all():
-        property = Property.objects.get(pk=p.id)
-        if property not in propertyList:
-            propertyList.append(property)
-    return propertyList
+    return user_properties(request.user)
 
 @login_required()
 def update_sensor(request):
@@ -282,28 +273,86 @@ def update_sensor(request):
         @param request
         @author German Bernal
     """
-    log.debug("update_sensor: val: " + "Entro a update_sensor")
+    log.debug("update_sensor: val: Entro a update_sensor")
     if request.method == 'GET':
         sensor_id = request.GET['sensor_id']
-        log.debug("update_sensor: Sensor val: " + str(sensor_id))
+        log.debug("update_sensor: Sensor val: %s", sensor_id)
         value = request.GET['value']
-        log.debug("update_sensor: value val: " + str(value))
-        sensor = Sensor.objects.get(pk=sensor_id)
-        sensor.value = value
-        sensor.save()
-        data = {}
-        data["sensor_id"] = sensor.id
-        data["code"] = sensor.code
-        data["location_in_plan"] = sensor.location_in_plan
-        data["value"] = sensor.value
-        data["valueDisplay"] = sensor.get_value_display()
-        log.debug("update_sensor: value val: " + str(data))
+        log.debug("update_sensor: value val: %s", value)
+        # El cambio queda en el cache y se escribe en la base de datos en el siguiente flush (ver sensor_state)
+        sensor = sensor_state.state.update(sensor_id, value)
+        stream.publish_sensor(sensor)
+        data = stream.sensor_data(sensor)
+        log.debug("update_sensor: value val: %s", data)
         return HttpResponse(
                 json.dumps(data),
                 content_type="application/json"
             )
 
 
+@login_required()
+def property_stream(request, property_id):
+    """
+    Stream de Server-Sent Events con los cambios de valor de los sensores y los eventos nuevos de un inmueble
+    del usuario autenticado (propietario o residente)
+        @param request
+        @param property_id
+    """
+    property_id = int(property_id)
+    if property_id not in [p.id for p in user_properties(request.user)]:
+        return HttpResponse("No tiene permisos de acceso.", status=403)
+    subscription = stream.broker.subscribe(property_id)
+    # La conexion a la base de datos no se usa mientras el stream esta abierto
+    if not connection.in_atomic_block:
+        connection.close()
+    response = StreamingHttpResponse(stream.stream(subscription), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required()
+@csrf_exempt
+def property_scene(request, property_id):
+    """
+    Cambia varios actuadores de un inmueble del usuario en una sola peticion. Recibe por POST un json con
+    una escena predefinida {"scene": "all_off"} o una lista de comandos
+    {"commands": [{"sensor_id": 1, "value": "5"}, ...]} (tambien se aceptan pares [sensor_id, value]).
+    Si algun comando no es valido no se aplica ninguno.
+        @param request
+        @param property_id
+    """
+    property_id = int(property_id)
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+    if property_id not in [p.id for p in user_properties(request.user)]:
+        return HttpResponse("No tiene permisos de acceso.", status=403)
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return HttpResponse(json.dumps({"message": "JSON no valido"}), content_type="application/json", status=400)
+    if not isinstance(data, dict) or not isinstance(data.get('commands', []), list):
+        return HttpResponse(json.dumps({"message": "Comandos no validos"}), content_type="application/json", status=400)
+    actuators = scenes.property_actuators(property_id)
+    if 'scene' in data:
+        commands = scenes.scene_commands(actuators.values(), data['scene'])
+        if commands is None:
+            return HttpResponse(json.dumps({"message": "Escena no valida"}), content_type="application/json", status=400)
+    else:
+        commands = []
+        for command in data.get('commands', []):
+            if isinstance(command, dict):
+                commands.append((command.get('sensor_id'), command.get('value')))
+            elif isinstance(command, (list, tuple)):
+                commands.append(tuple(command[:2]) if len(command) >= 2 else (None, None))
+            else:
+                return HttpResponse(json.dumps({"message": "Comando no valido: %s" % json.dumps(command)}), content_type="application/json", status=400)
+    changes, errors = scenes.validate_commands(actuators, commands)
+    if errors or ('scene' not in data and not commands):
+        return HttpResponse(json.dumps({"message": "Comandos no validos", "errors": errors}), content_type="application/json", status=400)
+    sensors = scenes.apply_commands(property_id, actuators, changes)
+    return HttpResponse(json.dumps({"updated": len(sensors), "sensors": [stream.sensor_data(sensor) for sensor in sensors]}),
+                        content_type="application/json")
+
 @login_required()
 def update_value(request, property_id, asresident):
     """
@@ -311,9 +360,9 @@ def update_value(request, property_id, asresident):
         @param request
         @author German Bernal
     """
-    log.debug("update_value: val: " + "Entro a update_value")
-    log.debug("update_value: Property val: " + str(property_id))
-    log.debug("update_value: asresident val: " + str(asresident))
+    log.debug("update_value: val: Entro a update_value")
+    log.debug("update_value: Property val: %s", property_id)
+    log.debug("update_value: asresident val: %s", asresident)
     if request.method == 'GET':
         selected_property = Property.objects.get(pk=property_id)
         sensors = property_sensors(request,selected_property.id)
@@ -327,40 +376,119 @@ def update_value(request, property_id, asresident):
 ####################### Vista para rest_framework #######################
 
 class EventViewSet(viewsets.ModelViewSet):
-   """
-   Esta funcion es el API endpoint que permite hacer peticiones GET / POST a eventos.
-	     @param viewsets
-		 @author Lorena Salamanca
-   """
-   queryset = Event.objects.all()
-   serializer_class = EventSerializer
+    """
+    Esta funcion es el API endpoint que permite hacer peticiones GET / POST a eventos.
+    Un POST con un arreglo JSON se procesa como un lote de eventos.
+        @param viewsets
+        @author Lorena Salamanca
+    """
+    queryset = Event.objects.all()
+    serializer_class = EventSerializer
+
+    def create(self, request, *args, **kwargs):
+        if isinstance(request.data, list):
+            return self.create_batch(request)
+        return super(EventViewSet, self).create(request, *args, **kwargs)
+
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            event = serializer.save()
+            rollups.record_events([event])
+        stream.publish_events([event])
+
+    def create_batch(self, request):
+        """
+        Valida el lote completo con EventSerializer resolviendo sensores y propiedades con una
+        sola consulta cada uno, e inserta los eventos validos con bulk_create en una transaccion.
+        Retorna el resultado de cada elemento para que el gateway reenvie solo los que fallaron.
+            @param request
+        """
+        items = request.data
+        if len(items) == 0:
+            return Response({"created": 0, "failed": 0, "results": []}, status=status.HTTP_400_BAD_REQUEST)
+        context = self.get_serializer_context()
+        context['prefetched'] = {
+            'sensor': Sensor.objects.in_bulk(batch_primary_keys(items, 'sensor')),
+            'property': Property.objects.in_bulk(batch_primary_keys(items, 'property')),
+        }
+        events = []
+        results = []
+        for index, item in enumerate(items):
+            serializer = EventSerializer(data=item, context=context)
+            if serializer.is_valid():
+                events.append(Event(**serializer.validated_data))
+                results.append({"index": index, "status": "created"})
+            else:
+                results.append({"index": index, "status": "invalid", "errors": serializer.errors})
+        if events:
+            with transaction.atomic():
+                Event.objects.bulk_create(events)
+                rollups.record_events(events)
+                # bulk_create no dispara post_save, las notificaciones se encolan explicitamente
+                for event in events:
+                    notify_event(event)
+            stream.publish_events(events)
+        failed = len(items) - len(events)
+        if failed == 0:
+            response_status = status.HTTP_201_CREATED
+        elif events:
+            response_status = 207  # Multi-Status
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({"created": len(events), "failed": failed, "results": results}, status=response_status)
+
+def batch_primary_keys(items, field):
+    """
+    Retorna las llaves primarias validas del campo indicado en un lote de eventos
+        @param items
+        @param field
+    """
+    keys = set()
+    for item in items:
+        try:
+            keys.add(int(item[field]))
+        except (KeyError, TypeError, ValueError):
+            pass
+    return list(keys)
 
 ####################### Inicio Vistas para el reporte de los eventos del inmueble del propietario #######################
 
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='usuarios').exists(), login_url='/watchapp/login/')
+@group_required(USUARIOS)
 def rpt_owner_property(request):
     """
     Vista Para inicializar la pagina del reporte de eventos del propietarioa
     	@param request
     	@author Ricardo Restrepo
     """    
-    if request.user.groups.filter(name="usuarios").exists():        
+    if has_group(request.user, USUARIOS):        
         return render(request, 'watchapp/rpt_owner_property.html', { "request": request, })
-    elif request.user.groups.filter(name="constructoras").exists():       
+    elif has_group(request.user, CONSTRUCTORAS):       
         return HttpResponse("No tiene permisos de acceso.")
 
-def generate_pdf(html):
+def pdf_response(path):
     """
-    Funcion para generar el archivo PDF y devolverlo mediante HttpResponse
-    	@param request
-    	@author Ricardo Restrepo
+    Funcion para devolver un archivo PDF del cache de reportes mediante HttpResponse
+    	@param path
     """ 
-    result = StringIO.StringIO()
-    pdf = pisa.pisaDocument(StringIO.StringIO(html.encode("UTF-8")), result)
-    if not pdf.err:
-        return HttpResponse(result.getvalue(), content_type='application/pdf')
-    return HttpResponse('Error al generar el PDF: %s' % cgi.escape(html))
+    with open(path, 'rb') as report:
+        return HttpResponse(report.read(), content_type='application/pdf')
+
+def report_pdf_response(kind, request):
+    """
+    PDF de un reporte con los parametros json enviados por ajax. Si esta en el cache de reportes se retorna; si no,
+    se crea un trabajo de report_worker y se retorna su estado (202) para consultarlo en report_jobs/<id>/.
+    La conversion a PDF no se hace en el worker web: con gevent ocuparia el proceso y detendria todas sus peticiones.
+        @param kind ReportJob.KIND_CHOICES
+        @param request
+    """
+    data = json.loads(request.body)
+    job = report_jobs.submit(kind, request.user, data)
+    if job.status == ReportJob.EMPTY:
+        return HttpResponse("0")
+    if job.status == ReportJob.DONE:
+        return pdf_response(reports.report_path(job.cache_key))
+    return HttpResponse(json.dumps(report_job_data(job)), content_type="application/json", status=202)
 
 @login_required()
 @csrf_exempt
@@ -375,33 +503,7 @@ def get_report_owner_property(request):
     	@param request
     	@author Ricardo Restrepo
     """   
-    # Array de eventos
-    events = []
-    #Parametros json enviados por ajax
-    data = json.loads(request.body) 
-    print data['dateInit']
-    pData=""
-
-    if data['property']=='0':
-        # Consultamos todos los inmuebles de un propietario
-        properties = request.user.userprofile.properties_as_owner.all()
-        # Consultamos todos los eventos de todos los inmuebles de un propietario
-        events = Event.objects.filter(property__in=properties, date__range=[data['dateInit'], data['dateFinal']])
-        pData="Todas"
-    else:
-        # Consultamos la propiedad
-        selected_property = Property.objects.get(name=data['property'])  
-        pData=data['property']
-        # Consultamos los eventos de la propiedad
-        events = Event.objects.filter(property_id=selected_property.id,date__range=[data['dateInit'], data['dateFinal']])
-
-
-    if(len(events)==0): return HttpResponse("0")
-
-    # Recuperamos el html del template del reporte
-    html = render_to_string('watchapp/template_rpt_owner_property.html', {'pagesize':'A4', 'Events':events, 'property':str(pData), 'dateInit':str(data['dateInit']).split(' ')[0],'dateFinal':str(data['dateFinal']).split(' ')[0] }, context_instance=RequestContext(request))
-    # Convertimos el html  a pdf    
-    return generate_pdf(html)
+    return report_pdf_response('0', request)
 
 class PisaHandler(logging.Handler):
     """
@@ -410,7 +512,7 @@ class PisaHandler(logging.Handler):
     	@author Ricardo Restrepo
     """  
     def emit(self, record):
-        print >> sys.stderr, record
+        log.warning("ho.pisa: %s", record.getMessage())
 
 logging.getLogger("ho.pisa").addHandler(PisaHandler())
 
@@ -422,50 +524,17 @@ def get_event_owner_property(request):
     	@param request
     	@author Ricardo Restrepo
     """   
-    # Array de eventos
-    events = []
     #Parametros json enviados por ajax
     data = json.loads(request.body) 
-    print data
-    if data['property']=='0':
-        # Consultamos todos los inmuebles de un propietario
-        properties = request.user.userprofile.properties_as_owner.all()
-        # Consultamos todos los eventos de todos los inmuebles de un propietario
-        events = Event.objects.filter(property__in=properties, date__range=[data['dateInit'], data['dateFinal']])
-    else:
-        # Consultamos la propiedad
-        selected_property = Property.objects.get(name=data['property'])  
-        # Consultamos los eventos de la propiedad
-        events = Event.objects.filter(property_id=selected_property.id,date__range=[data['dateInit'], data['dateFinal']])
-
-    if(len(events)==0): 
+    events, pData = reports.owner_property_events(request.user, data)
+    dataEvents = reports.event_rows(events)
+    if(len(dataEvents)==0): 
         return HttpResponse("0")
-    else:
-	# Collecion de eventos
-	dataEvents=[]
-	# Recorremos todos los eventos
-	for e in events:
-                dataE = {}	
-		dataE["date"] = str(e.date.date())
-		dataE["description"] = str(e.description.encode('utf8'))
-		dataE["type"] = str(e.get_type_display())
-		if (e.is_critical): 
-		     dataE["is_critical"] = "Si" 
-		else: 
-		     dataE["is_critical"] ="No"
-		if (e.is_fatal): 
-		     dataE["is_fatal"] = "Si" 
-		else: 
-		     dataE["is_fatal"] = "No"
-		dataE["property"] = e.property.name.encode('utf8')
-		dataE["sensor"] = str(e.sensor.description.encode('utf8'))
-		# Agregamos el evento a la coleccion
-		dataEvents.append(dataE)
-	# Retornamos los eventos en formato JSON
-        return HttpResponse(
-                json.dumps(dataEvents),
-                content_type="application/json"
-            )
+    # Retornamos los eventos en formato JSON
+    return HttpResponse(
+            json.dumps(dataEvents),
+            content_type="application/json"
+        )
 ####################### Fin Vistas para el reporte de los eventos del inmueble del propietario #######################
 
 
@@ -495,7 +564,7 @@ def get_owner_reports(request):
 ####################### Vistas para constructoras #######################
 
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='constructoras').exists(), login_url='/watchapp/login/')
+@group_required(CONSTRUCTORAS)
 def constructora_home(request):
     """
     Esta funcion tiene el contenido del home de constructoras, 
@@ -508,7 +577,7 @@ def constructora_home(request):
     })
 
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='constructoras').exists(), login_url='/watchapp/login/')
+@group_required(CONSTRUCTORAS)
 def rpt_admin_all_property(request):
     """
     Vista temporal mockups
@@ -519,7 +588,7 @@ def rpt_admin_all_property(request):
 
 
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='constructoras').exists(), login_url='/watchapp/login/')
+@group_required(CONSTRUCTORAS)
 def admin_file_upload(request):
     """
     Vista temporal mockups
@@ -527,16 +596,17 @@ def admin_file_upload(request):
         @author Ricardo Restrepo
     """ 
     log.debug("admin_file_upload: entro!! ")
-    if request.user.groups.filter(name="constructoras").exists():
+    if has_group(request.user, CONSTRUCTORAS):
         return render(request, 'watchapp/admin_file_upload.html', { "request": request, })
-    elif request.user.groups.filter(name="usuarios").exists():       
+    elif has_group(request.user, USUARIOS):       
         return HttpResponse("No tiene permisos de acceso.")
 
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='constructoras').exists(), login_url='/watchapp/login/')
+@group_required(CONSTRUCTORAS)
 def process_file(request):
     """
-    Esta funcion procesa el archivo que contiene las propiedades a configurar
+    Esta funcion recibe el archivo que contiene las propiedades a configurar, lo guarda en disco y crea un
+    trabajo de importacion que procesa el comando import_worker. Retorna el id del trabajo para consultar su avance.
         @param request
         @author German Bernal
     """ 
@@ -544,34 +614,20 @@ def process_file(request):
     response_data["valid"] = True;
     try:
         log.debug("process_file: entro!! ")
-        if request.user.groups.filter(name="constructoras").exists():
-            #return HttpResponse("Entro a la funcion.")
-            log.debug("process_file: entro if ")
-            log.debug("process_file: entro if: Request: " + str(request))
-            log.debug("process_file: entro if: Files " + str(request.FILES))
+        if has_group(request.user, CONSTRUCTORAS):
+            if len(request.FILES) == 0:
+                response_data["valid"] = False;
+                response_data["message"] = "El archivo no tiene datos"
             for key in request.FILES:
                 log.debug("process_file: file: " + key)
-                log.debug('process_file: Structure is Valid: ' + str(validate_data_structure(request.FILES[key],4)))
-                row_count = sum(1 for row in request.FILES[key])
-                valid_structure = validate_data_structure(request.FILES[key],5)
-                isvalid = True if row_count > 0 and valid_structure else False
-                if isvalid:
-                    res = uploadres = upload_propertys(request.FILES[key])
-                    if res["upload_status"] == "failed":
-                        response_data["valid"] = False;
-                    response_data["message"] = res["message"]
-                else:
-                    response_data["valid"] = False;
-                    if not valid_structure > 0:
-                        response_data["message"] = "El archivo tiene una estructura no valida!!"
-                    elif not row_count > 0:
-                        response_data["message"] = "El archivo no tiene datos"
-                    break
+                job = import_jobs.submit(request.user, request.FILES[key])
+                response_data.update(import_job_data(job))
+                response_data["message"] = "Archivo recibido, importando inmuebles..."
             return HttpResponse(
                     json.dumps(response_data),
                     content_type="application/json"
                 )
-        elif request.user.groups.filter(name="usuarios").exists():       
+        elif has_group(request.user, USUARIOS):       
             return HttpResponse("No tiene permisos de acceso.")
     except Exception as inst:
         log.debug("process_file: error: " + str(inst))
@@ -582,65 +638,31 @@ def process_file(request):
                     content_type="application/json"
                 )
 
+def import_job_data(job):
+    data = {"job_id": job.id, "status": job.get_status_display(), "done": job.status == ImportJob.DONE,
+            "failed_job": job.status == ImportJob.FAILED, "error": job.error, "total_rows": job.total_rows,
+            "processed": job.processed, "inserted": job.inserted, "skipped": job.skipped, "failed": job.failed,
+            "status_url": reverse('watchapp:import_job_status', args=[job.id])}
+    if job.status in (ImportJob.DONE, ImportJob.FAILED):
+        data["issues"] = json.loads(job.issues)
+    return data
 
-def upload_propertys(file):
+@login_required()
+@group_required(CONSTRUCTORAS)
+def import_job_status(request, job_id):
     """
-    Esta funcion crea las propiedades de un archivo
+    Avance de un trabajo de importacion de inmuebles del usuario autenticado
         @param request
-        @author German Bernal
-    """ 
-    result = {}
-    property_inserted = False
-    property_exists = False
-    reader = csv.reader(file, delimiter = ',')
-    for row in reader:
-        log.debug("upload_propertys: row: " + str(row))
-        log.debug("upload_propertys: row - len: " + str(len(row)))
-        prop = Property.objects.filter(name = row[0].strip(),address = row[1].strip(), fixed_phone = row[2].strip(),plan =row[3].strip())
-        log.debug("upload_propertys: prop count: " + str(len(prop)))
-        if len(prop) == 0:
-            user = User.objects.filter(username=row[4].strip())
-            if len(user) > 0: 
-                property = Property(name = row[0].strip(),address = row[1].strip(), fixed_phone = row[2].strip(),plan =row[3].strip())
-                property.save()
-                userP = UserProfile.objects.get(user_id=user[0].id)
-                userP.properties_as_owner.add(property);
-                property_inserted = True
-        else:
-            property_exists = True
-    file.close()
-    if property_inserted and not property_exists:
-        result["upload_status"] = "complete";
-        result["message"] = "Propiedades registradas.";
-    elif property_inserted and property_exists:
-        result["upload_status"] = "partial";
-        result["message"] = "Carga Parcial. Algunas de las propiedades ya estan registradas o el propietario no existe";
-    else:
-        result["upload_status"] = "failed";
-        result["message"] = "Las propiedades ya estan registradas en el sistema o los propietarios no estan registrados";
-    return result
-
-def validate_data_structure(file,col_count):
+        @param job_id
     """
-    Esta funcion valida la estructura de un archivo
-        @param request
-        @author German Bernal
-    """ 
-    isvalid = True
-    reader = csv.reader(file, delimiter = ',')
-    for row in reader:
-        log.debug("validate_structure_data: row: " + str(row))
-        log.debug("validate_structure_data: row count: " + str(len(row)))
-        if len(row) < col_count:
-            isvalid = False
-            break
-    return isvalid
+    job = get_object_or_404(ImportJob, pk=job_id, user=request.user)
+    return HttpResponse(json.dumps(import_job_data(job)), content_type="application/json")
 
 
 ####################### Reportes para Constructora #######################
 		
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='constructoras').exists(), login_url='/watchapp/login/')
+@group_required(CONSTRUCTORAS)
 @csrf_exempt
 def get_report_admin_all_property(request):
     """
@@ -648,61 +670,12 @@ def get_report_admin_all_property(request):
     	@param request
     	@author Lorena Salamanca
     """   
-    # Array de eventos
-    events = []
-    #Parametros json enviados por ajax
-    data = json.loads(request.body) 
-    pData=""
-
-    # Consultamos todos los inmuebles de un propietario
-    constructora = ConstructorCompany.objects.get(user_id=request.user.userprofile.id)
-    properties = Property.objects.filter(constructor_company_id=constructora.id)
-    print data['event_type']
-    if data['event_type']=='-1':
-        # Consultamos todos los eventos de todos los inmuebles de un propietario
-        events = Event.objects.filter(property__in=properties, date__range=[data['dateInit'], data['dateFinal']])
-        pData="Todos"
-    else:
-        # Consultamos la propiedad
-        events = Event.objects.filter(property__in=properties, date__range=[data['dateInit'], data['dateFinal']], type=data['event_type'])
-        pData=data['event_type']
-        if data['event_type']=='0': pData = 'Disparo de alarma'
-        if data['event_type']=='1': pData = 'Activar alarma'
-        if data['event_type']=='2': pData = 'Desactivar alarma'
-        if data['event_type']=='3': pData = 'Alerta en sensor'
-        if data['event_type']=='4': pData = 'Cambio actuador'
+    return report_pdf_response('1', request)
+	
 	
-    if(len(events)==0): return HttpResponse("0")
-    # Collecion de eventos
-    dataEvents=[]
-    # Recorremos todos los eventos
-    for e in events:
-        dataE = {}	
-        dataE["date"] = str(e.date.date())
-        dataE["type"] = str(e.get_type_display())
-        dataE["description"] = str(e.description.encode('utf8'))
-        if (e.is_critical): 
-        	dataE["is_critical"] = "Si" 
-        else: 
-        	dataE["is_critical"] ="No"
-        if (e.is_fatal): 
-        	dataE["is_fatal"] = "Si" 
-        else: 
-        	dataE["is_fatal"] = "No"
-        dataE["property"] = e.property.name.encode('utf8')
-        dataE["sensor"] = str(e.sensor.description.encode('utf8'))
-        dataE["propietario"] = str(e.property.properties_as_owner.all()[0].user.first_name.encode('utf8')) + ' ' + str(e.property.properties_as_owner.all()[0].user.last_name.encode('utf8'))
-        # Agregamos el evento a la coleccion
-        dataEvents.append(dataE)
-    # Recuperamos el html del template del reporte
-    print dataEvents
-    print 'pdata' + pData
-    html = render_to_string('watchapp/template_rpt_admin_all_property.html', {'pagesize':'A4', 'sdf':dataEvents, 'event_type':str(pData), 'dateInit':str(data['dateInit']).split(' ')[0],'dateFinal':str(data['dateFinal']).split(' ')[0] }, context_instance=RequestContext(request))
-    # Convertimos el html  a pdf    
-    return generate_pdf(html)
 	
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='constructoras').exists(), login_url='/watchapp/login/')
+@group_required(CONSTRUCTORAS)
 @csrf_exempt
 def get_event_admin_all_property(request):
     """
@@ -710,52 +683,20 @@ def get_event_admin_all_property(request):
     	@param request
     	@author Ricardo Restrepo
     """   
-    # Array de eventos
-    events = []
     #Parametros json enviados por ajax
     data = json.loads(request.body) 
-    constructora = ConstructorCompany.objects.get(user_id=request.user.userprofile.id)
-    properties = Property.objects.filter(constructor_company_id=constructora.id)
-    print data['event_type']
-    if data['event_type']=='-1':
-        # Consultamos todos los eventos de todos los inmuebles de un propietario
-        events = Event.objects.filter(property__in=properties, date__range=[data['dateInit'], data['dateFinal']])
-    else:
-        # Consultamos la propiedad
-        events = Event.objects.filter(property__in=properties, date__range=[data['dateInit'], data['dateFinal']], type=data['event_type'])
-
-    if(len(events)==0): 
+    events, pData = reports.constructor_events(request.user, data)
+    dataEvents = reports.event_rows(events, with_owner=True)
+    if(len(dataEvents)==0): 
         return HttpResponse("0")
-    else:
-	# Collecion de eventos
-	dataEvents=[]
-	# Recorremos todos los eventos
-	for e in events:
-		dataE = {}	
-		dataE["date"] = str(e.date.date())
-		dataE["type"] = str(e.get_type_display())
-		dataE["description"] = str(e.description.encode('utf8'))
-		if (e.is_critical): 
-		     dataE["is_critical"] = "Si" 
-		else: 
-		     dataE["is_critical"] ="No"
-		if (e.is_fatal): 
-		     dataE["is_fatal"] = "Si" 
-		else: 
-		     dataE["is_fatal"] = "No"
-		dataE["property"] = e.property.name.encode('utf8')
-		dataE["sensor"] = str(e.sensor.description.encode('utf8'))
-		dataE["propietario"] = str(e.property.properties_as_owner.all()[0].user.first_name.encode('utf8')) + ' ' + str(e.property.properties_as_owner.all()[0].user.last_name.encode('utf8'))
-		# Agregamos el evento a la coleccion
-		dataEvents.append(dataE)
-	# Retornamos los eventos en formato JSON
-        return HttpResponse(
-                json.dumps(dataEvents),
-                content_type="application/json"
-            )
+    # Retornamos los eventos en formato JSON
+    return HttpResponse(
+            json.dumps(dataEvents),
+            content_type="application/json"
+        )
 
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='usuarios').exists(), login_url='/watchapp/login/')
+@group_required(USUARIOS)
 def update_profile(request):
     """
     Vista temporal mockups
@@ -790,16 +731,16 @@ def update_profile(request):
 	return render(request, 'watchapp/update_profile.html', { "form": form, "actualizado":False})
 
 
-    if request.user.groups.filter(name="usuarios").exists():        
+    if has_group(request.user, USUARIOS):        
         return render(request, 'watchapp/update_profile.html', { "request": request, "form": form, "actualizado":False})
-    elif request.user.groups.filter(name="constructoras").exists():       
+    elif has_group(request.user, CONSTRUCTORAS):       
         return HttpResponse("No tiene permisos de acceso.")
 
 
 ####################### Reporte Todos los eventos de la constructora por propietario #######################
 
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='constructoras').exists(), login_url='/watchapp/login/')
+@group_required(CONSTRUCTORAS)
 def rpt_admin_all_property_by_owner(request):
     """
     Vista reporte todos los eventos de la constructora por propietario
@@ -818,7 +759,7 @@ def rpt_admin_all_property_by_owner(request):
     return render(request, 'watchapp/rpt_admin_all_property_by_owner.html', { "request": request, "owners": owners_set, })
 	
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='constructoras').exists(), login_url='/watchapp/login/')
+@group_required(CONSTRUCTORAS)
 @csrf_exempt
 def get_event_admin_all_property_by_owner(request):
     """
@@ -826,54 +767,21 @@ def get_event_admin_all_property_by_owner(request):
     	@param request
     	@author Ricardo Restrepo
     """   
-    # Array de eventos
-    events = []
     #Parametros json enviados por ajax
     data = json.loads(request.body) 
-    constructora = ConstructorCompany.objects.get(user_id=request.user.userprofile.id)
-    print data['owners_select']
-    if data['owners_select']=='0':
-        properties = Property.objects.filter(constructor_company_id=constructora.id)
-        events = Event.objects.filter(property__in=properties, date__range=[data['dateInit'], data['dateFinal']])
-    else:
-        owner_name= data['owners_select'].split( );
-        owner_id = User.objects.get(first_name=owner_name[0])
-        properties = Property.objects.filter(constructor_company_id=constructora.id, properties_as_owner=owner_id)
-        events = Event.objects.filter(property__in=properties, date__range=[data['dateInit'], data['dateFinal']])
-
-    if(len(events)==0): 
+    events, pData = reports.constructor_owner_events(request.user, data)
+    owner = None if data['owners_select']=='0' else data['owners_select']
+    dataEvents = reports.event_rows(events, with_owner=True, owner=owner)
+    if(len(dataEvents)==0): 
         return HttpResponse("0")
-    else:
-	# Collecion de eventos
-	dataEvents=[]
-	# Recorremos todos los eventos
-	for e in events:
-		dataE = {}	
-		dataE["date"] = str(e.date.date())
-		dataE["type"] = str(e.get_type_display())
-		dataE["description"] = str(e.description.encode('utf8'))
-		if (e.is_critical): 
-		     dataE["is_critical"] = "Si" 
-		else: 
-		     dataE["is_critical"] ="No"
-		if (e.is_fatal): 
-		     dataE["is_fatal"] = "Si" 
-		else: 
-		     dataE["is_fatal"] = "No"
-		dataE["property"] = e.property.name.encode('utf8')
-		dataE["sensor"] = str(e.sensor.description.encode('utf8'))
-		if data['owners_select']=='0' : dataE["propietario"] = str(e.property.properties_as_owner.all()[0].user.first_name.encode('utf8')) + ' ' + str(e.property.properties_as_owner.all()[0].user.last_name.encode('utf8'))
-		else : dataE["propietario"] = data['owners_select']
-		# Agregamos el evento a la coleccion
-		dataEvents.append(dataE)
-	    # Retornamos los eventos en formato JSON
-        return HttpResponse(
-                json.dumps(dataEvents),
-                content_type="application/json"
-            )
+    # Retornamos los eventos en formato JSON
+    return HttpResponse(
+            json.dumps(dataEvents),
+            content_type="application/json"
+        )
 
 @login_required()
-@user_passes_test(lambda u: u.groups.filter(name='constructoras').exists(), login_url='/watchapp/login/')
+@group_required(CONSTRUCTORAS)
 @csrf_exempt
 def get_report_admin_all_property_by_owner(request):
     """
@@ -881,57 +789,178 @@ def get_report_admin_all_property_by_owner(request):
     	@param request
     	@author Lorena Salamanca
     """   
-    # Array de eventos
-    events = []
-    #Parametros json enviados por ajax
-    data = json.loads(request.body) 
-    pData=""
+    return report_pdf_response('2', request)
 
-    # Consultamos todos los inmuebles de un propietario
-    constructora = ConstructorCompany.objects.get(user_id=request.user.userprofile.id)
-    properties = Property.objects.filter(constructor_company_id=constructora.id)
-    if data['owners_select']=='0':
-        properties = Property.objects.filter(constructor_company_id=constructora.id)
-        events = Event.objects.filter(property__in=properties, date__range=[data['dateInit'], data['dateFinal']])
-        pData = "Todos"
-    else:
-        owner_name= data['owners_select'].split( );
-        owner_id = User.objects.get(first_name=owner_name[0])
-        properties = Property.objects.filter(constructor_company_id=constructora.id, properties_as_owner=owner_id)
-        events = Event.objects.filter(property__in=properties, date__range=[data['dateInit'], data['dateFinal']])
-        pData=data['owners_select']
-	
-    if(len(events)==0): return HttpResponse("0")
-    # Collecion de eventos
-    dataEvents=[]
-    # Recorremos todos los eventos
-    for e in events:
-        dataE = {}	
-        dataE["date"] = str(e.date.date())
-        dataE["type"] = str(e.get_type_display())
-        dataE["description"] = str(e.description.encode('utf8'))
-        if (e.is_critical): 
-        	dataE["is_critical"] = "Si" 
-        else: 
-        	dataE["is_critical"] ="No"
-        if (e.is_fatal): 
-        	dataE["is_fatal"] = "Si" 
-        else: 
-        	dataE["is_fatal"] = "No"
-        dataE["property"] = e.property.name.encode('utf8')
-        dataE["sensor"] = str(e.sensor.description.encode('utf8'))
-        if data['owners_select']=='0' : dataE["propietario"] = str(e.property.properties_as_owner.all()[0].user.first_name.encode('utf8')) + ' ' + str(e.property.properties_as_owner.all()[0].user.last_name.encode('utf8'))
-        else : dataE["propietario"] = data['owners_select']
-        # Agregamos el evento a la coleccion
-        dataEvents.append(dataE)
-    # Recuperamos el html del template del reporte
-    print "va a invocar el pdf"
-    html = render_to_string('watchapp/template_rpt_admin_all_property_by_owner.html', {'pagesize':'A4', 'events':dataEvents, 'event_type':str(pData), 'dateInit':str(data['dateInit']).split(' ')[0],'dateFinal':str(data['dateFinal']).split(' ')[0] }, context_instance=RequestContext(request))
-    # Convertimos el html  a pdf    
-    return generate_pdf(html)
+####################### Exportacion de reportes de eventos (JSON / CSV por streaming) #######################
+
+def report_params(request):
+    """
+    Parametros de un reporte: json en el cuerpo del POST (como las vistas get_event_*) o en el querystring del GET
+        @param request
+    """
+    if request.method == 'POST' and request.body:
+        return json.loads(request.body)
+    return request.GET.dict()
+
+def export_response(rows, data, with_owner, filename):
+    """
+    Respuesta por streaming de las filas de un reporte en formato json (por defecto) o csv (format=csv)
+        @param rows generador de filas
+        @param data parametros del reporte
+        @param with_owner
+        @param filename nombre del archivo csv
+    """
+    if data.get('format', 'json') == 'csv':
+        response = StreamingHttpResponse(reports.stream_csv(rows, reports.report_columns(with_owner)), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="%s.csv"' % filename
+        return response
+    return StreamingHttpResponse(reports.stream_json(rows), content_type='application/json')
+
+@login_required()
+@csrf_exempt
+def export_event_owner_property(request):
+    """
+    Exporta los eventos de los inmuebles del propietario sin cargarlos todos en memoria
+        @param request
+    """
+    data = report_params(request)
+    events, pData = reports.owner_property_events(request.user, data)
+    return export_response(reports.iter_event_rows(events), data, False, 'eventos_propietario')
+
+@login_required()
+@group_required(CONSTRUCTORAS)
+@csrf_exempt
+def export_event_admin_all_property(request):
+    """
+    Exporta los eventos de los inmuebles de la constructora sin cargarlos todos en memoria
+        @param request
+    """
+    data = report_params(request)
+    events, pData = reports.constructor_events(request.user, data)
+    return export_response(reports.iter_event_rows(events, with_owner=True), data, True, 'eventos_constructora')
+
+@login_required()
+@group_required(CONSTRUCTORAS)
+@csrf_exempt
+def export_event_admin_all_property_by_owner(request):
+    """
+    Exporta los eventos de la constructora por propietario sin cargarlos todos en memoria
+        @param request
+    """
+    data = report_params(request)
+    events, pData = reports.constructor_owner_events(request.user, data)
+    owner = None if data['owners_select']=='0' else data['owners_select']
+    return export_response(reports.iter_event_rows(events, with_owner=True, owner=owner), data, True, 'eventos_propietarios')
+
+####################### Resumenes de eventos desde los acumulados (EventRollupHour / EventRollupDay) #######################
+
+def summary_response(request, properties):
+    """
+    Resumen de eventos de los inmuebles dados. Parametros en el querystring o json del POST:
+    dateInit, dateFinal, granularity (day|hour, por defecto day), property (id, opcional), event_type (opcional)
+        @param request
+        @param properties queryset de los inmuebles a los que el usuario tiene acceso
+    """
+    data = report_params(request)
+    granularity = data.get('granularity', 'day')
+    date_init = rollups.parse_date_param(data.get('dateInit'))
+    date_final = rollups.parse_date_param(data.get('dateFinal'))
+    valid = granularity in rollups.GRANULARITIES and date_init is not None and date_final is not None
+    try:
+        property_id = int(data['property']) if data.get('property') else None
+    except (TypeError, ValueError):
+        valid = False
+    if not valid:
+        return HttpResponse(json.dumps({"message": "Parametros no validos"}), content_type="application/json", status=400)
+    if property_id is not None:
+        properties = properties.filter(pk=property_id)
+    event_type = data.get('event_type')
+    if event_type in (None, '', '-1'):
+        event_type = None
+    rows = rollups.summary(properties, granularity, date_init, date_final, event_type)
+    return HttpResponse(json.dumps(rows), content_type="application/json")
+
+@login_required()
+@group_required(CONSTRUCTORAS)
+@csrf_exempt
+def event_summary_constructor(request):
+    """
+    Numero de eventos por periodo, inmueble, tipo y critico/fatal de los inmuebles de la constructora
+        @param request
+    """
+    return summary_response(request, reports.constructor_properties(request.user))
+
+@login_required()
+@csrf_exempt
+def event_summary_owner(request):
+    """
+    Numero de eventos por periodo, inmueble, tipo y critico/fatal de los inmuebles del propietario
+        @param request
+    """
+    return summary_response(request, request.user.userprofile.properties_as_owner.all())
+
+####################### Trabajos de reportes PDF (los genera el comando report_worker) #######################
+
+def report_job_data(job):
+    data = {"job_id": job.id, "status": job.get_status_display(), "done": job.status == ReportJob.DONE,
+            "empty": job.status == ReportJob.EMPTY, "failed": job.status == ReportJob.FAILED}
+    if job.status == ReportJob.DONE:
+        data["download_url"] = reverse('watchapp:report_job_download', args=[job.id])
+    return data
+
+@login_required()
+@csrf_exempt
+def submit_report_job(request):
+    """
+    Crea un trabajo de reporte PDF. Recibe por POST el json del reporte con el tipo en 'kind'
+    (ReportJob.KIND_CHOICES) y retorna el id del trabajo para consultar su estado.
+        @param request
+    """
+    data = json.loads(request.body)
+    kind = data.get('kind')
+    if kind not in reports.REPORT_PARAMS:
+        return HttpResponse(json.dumps({"message": "Tipo de reporte no valido"}), content_type="application/json", status=400)
+    if kind != '0' and not has_group(request.user, CONSTRUCTORAS):
+        return HttpResponse("No tiene permisos de acceso.", status=403)
+    job = report_jobs.submit(kind, request.user, data)
+    return HttpResponse(json.dumps(report_job_data(job)), content_type="application/json", status=201)
+
+@login_required()
+def report_job_status(request, job_id):
+    """
+    Estado de un trabajo de reporte del usuario autenticado
+        @param request
+        @param job_id
+    """
+    job = get_object_or_404(ReportJob, pk=job_id, user=request.user)
+    return HttpResponse(json.dumps(report_job_data(job)), content_type="application/json")
+
+@login_required()
+def report_job_download(request, job_id):
+    """
+    Descarga el PDF de un trabajo de reporte terminado
+        @param request
+        @param job_id
+    """
+    job = get_object_or_404(ReportJob, pk=job_id, user=request.user, status=ReportJob.DONE)
+    path = reports.report_path(job.cache_key)
+    if not os.path.exists(path):
+        raise Http404
+    return pdf_response(path)
+
+####################### Metricas de las peticiones #######################
+
+@staff_member_required
+def request_metrics(request):
+    """
+    Metricas de las peticiones por vista (watchapp.metrics) en el formato de texto de Prometheus, solo para
+    administradores
+        @param request
+    """
+    return HttpResponse(metrics.store.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 def handle_uploaded_file(f, id):
-	print(f.name)
+	log.debug("handle_uploaded_file: file: %s", f.name)
 	with open('smarthome/static/images/fredy.jpg', 'wb+') as destination:
 		for chunk in f.chunks():
 			destination.write(chunk)